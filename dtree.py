@@ -4,22 +4,60 @@ Algorithms for building and using a decision tree for classification or regressi
 """
 from __future__ import print_function
 
-from collections import defaultdict
+import abc
+from array import array
+import bisect
+import bz2
+from collections import defaultdict, deque, Counter, OrderedDict
 from decimal import Decimal
 from pprint import pprint
 import copy
 import csv
+import gzip
+import io
+import itertools
 import math
 from math import pi
+import multiprocessing
 import os
 import random
 import re
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 import six
 from six.moves import cPickle as pickle
 from six import iteritems, iterkeys, itervalues, string_types
 
+try:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    asyncio = None
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 VERSION = (1, 0, 0)
 __version__ = '.'.join(map(str, VERSION))
 
@@ -80,7 +118,33 @@ ATTR_TYPE_NOMINAL = NOM = 'nominal'
 ATTR_TYPE_DISCRETE = DIS = 'discrete'
 ATTR_TYPE_CONTINUOUS = CON = 'continuous'
 ATTR_MODE_CLASS = CLS = 'class'
-ATTR_HEADER_PATTERN = re.compile("([^,:]+):(nominal|discrete|continuous)(?::(class))?")
+ATTR_MODE_WEIGHT = WGT = 'weight'
+# The function converting raw values of each attribute type.
+ATTR_TYPE_CONVERTERS = {
+    ATTR_TYPE_DISCRETE: int,
+    ATTR_TYPE_CONTINUOUS: float,
+}
+
+# The number of rows sampled when inferring a schema.
+INFER_SAMPLE_SIZE = 100
+
+# Compressed files are parsed in a producer thread, which hands chunks of
+# READ_CHUNK_SIZE rows to the reader through a queue of at most
+# READ_QUEUE_SIZE chunks.
+COMPRESSED_EXTENSIONS = ('.gz', '.bz2', '.xz', '.zst')
+READ_CHUNK_SIZE = 1000
+READ_QUEUE_SIZE = 8
+
+ATTR_HEADER_PATTERN = re.compile(
+    "([^,:]+):(nominal|discrete|continuous)(?::(class|weight))?")
+
+def get_weight(record, weight_attr):
+    """
+    Returns the sample weight of the given record, defaulting to 1.
+    """
+    if weight_attr is None:
+        return 1.0
+    return record.get(weight_attr, 1.0)
 
 def get_mean(seq):
     """
@@ -117,16 +181,7 @@ def erfcc(x):
     """
     Complementary error function.
     """
-    z = abs(x)
-    t = 1. / (1. + 0.5*z)
-    r = t * math.exp(-z*z-1.26551223+t*(1.00002368+t*(.37409196+
-        t*(.09678418+t*(-.18628806+t*(.27886807+
-        t*(-1.13520398+t*(1.48851587+t*(-.82215223+
-        t*.17087277)))))))))
-    if (x >= 0.):
-        return r
-    else:
-        return 2. - r
+    return math.erfc(x)
 
 def normcdf(x, mu, sigma):
     """
@@ -142,6 +197,47 @@ def normcdf(x, mu, sigma):
         y = 1.0
     return y
 
+def normcdf_many(xs, mu, sigma):
+    """
+    Returns an array of normcdf() evaluated at each value in xs, where mu and
+    sigma are either numbers shared by all values, or sequences giving the
+    distribution of each value.
+    
+    Empty distributions, with a mean of None, give NaN.
+    """
+    erfc = math.erfc
+    ret = array('d', xs)
+    n = len(ret)
+    if isinstance(mu, (list, tuple, array)):
+        mus = mu
+    else:
+        mus = itertools.repeat(mu, n)
+    if isinstance(sigma, (list, tuple, array)):
+        scales = [
+            None if s is None else -1/(s*math.sqrt(2.0)) for s in sigma]
+    else:
+        scales = itertools.repeat(
+            None if sigma is None else -1/(sigma*math.sqrt(2.0)), n)
+    for i, m, scale in zip(range(n), mus, scales):
+        if m is None:
+            ret[i] = float('nan')
+            continue
+        y = 0.5*erfc((ret[i] - m)*scale)
+        ret[i] = 1.0 if y > 1.0 else y
+    return ret
+
+def get_probabilities_lt(dists, xs):
+    """
+    Returns an array of the probability of each CDist's random variable
+    being less than the given value, or each corresponding value in xs.
+    """
+    if not isinstance(xs, (list, tuple, array)):
+        xs = [xs]*len(dists)
+    return normcdf_many(
+        xs,
+        [d.mean for d in dists],
+        [d.standard_deviation for d in dists])
+
 def normpdf(x, mu, sigma):
     """
     Describes the relative likelihood that a real-valued random variable X will
@@ -173,9 +269,12 @@ class DDist(object):
     Incrementally tracks the probability distribution of discrete elements.
     """
     
-    def __init__(self, seq=None):
+    def __init__(self, seq=None, weights=None):
         self.clear()
-        if seq:
+        if seq and weights is not None:
+            for k, weight in zip(seq, weights):
+                self.add(k, weight)
+        elif seq:
             for k in seq:
                 self.counts[k] += 1
                 self.total += 1
@@ -215,6 +314,7 @@ class DDist(object):
     def add(self, k, count=1):
         """
         Increments the count for the given element.
+        The count may be a fractional sample weight.
         """
         self.counts[k] += count
         self.total += count
@@ -279,12 +379,17 @@ class DDist(object):
 class CDist(object):
     """
     Incrementally tracks the probability distribution of continuous numbers.
+    
+    The mean is kept as a running mean rather than a sum of samples, so it
+    doesn't lose precision over long streams. Distributions tracked
+    separately can be combined with merge() or +, giving the same result as
+    tracking all their samples in one.
     """
     
-    def __init__(self, seq=None, mean=None, var=None, stdev=None):
+    def __init__(self, seq=None, mean=None, var=None, stdev=None, weights=None):
         self.clear()
         if mean is not None:
-            self.mean_sum = mean
+            self.running_mean = mean
             self.mean_count = 1
         if var is not None:
             self.last_variance = var
@@ -292,31 +397,106 @@ class CDist(object):
         if stdev is not None:
             self.last_variance = stdev**2
             self.mean_count = 1
-        if seq:
+        if seq and weights is not None:
+            for n, weight in zip(seq, weights):
+                self.add(n, weight)
+        elif seq:
             for n in seq:
                 self += n
     
     def clear(self):
-        self.mean_sum = 0
+        self.running_mean = 0
         self.mean_count = 0
         self.last_variance = 0
     
     def copy(self):
         return copy.deepcopy(self)
     
+    def __setstate__(self, state):
+        state = dict(state)
+        if 'mean_sum' in state:
+            # Distributions pickled by earlier versions kept the sum of
+            # samples instead of the running mean.
+            mean_sum = state.pop('mean_sum')
+            count = state.get('mean_count', 0)
+            state['running_mean'] = mean_sum/float(count) if count else 0
+        self.__dict__.update(state)
+    
     def __repr__(self):
         return "<%s mean=%s variance=%s>" \
             % (type(self).__name__, self.mean, self.variance)
     
     def __iadd__(self, value):
         last_mean = self.mean
-        self.mean_sum += value
         self.mean_count += 1
-        if last_mean is not None:
+        if last_mean is None:
+            self.running_mean = value
+        else:
+            self.running_mean += (value - last_mean)/float(self.mean_count)
             self.last_variance = self.last_variance \
                 + (value  - last_mean)*(value - self.mean)
         return self
     
+    def add(self, value, weight=1):
+        """
+        Adds a sample with the given weight, so that the mean and variance
+        are those of the weighted samples.
+        """
+        if weight == 1:
+            self += value
+            return
+        if not weight:
+            return
+        last_mean = self.mean
+        self.mean_count += weight
+        if last_mean is None:
+            self.running_mean = value
+        else:
+            self.running_mean += \
+                weight*(value - last_mean)/float(self.mean_count)
+            self.last_variance = self.last_variance \
+                + weight*(value - last_mean)*(value - self.mean)
+    
+    def merge(self, other):
+        """
+        Adds all the samples of another distribution to this one, using the
+        parallel variance formula of Chan et al.
+        """
+        n_a = self.mean_count
+        n_b = other.mean_count
+        if not n_b:
+            return self
+        if not n_a:
+            self.running_mean = other.running_mean
+            self.mean_count = n_b
+            self.last_variance = other.last_variance
+            return self
+        delta = other.running_mean - self.running_mean
+        n = n_a + n_b
+        self.running_mean += delta*n_b/float(n)
+        self.last_variance += other.last_variance \
+            + delta**2*n_a*n_b/float(n)
+        self.mean_count = n
+        return self
+    
+    def __add__(self, other):
+        if not isinstance(other, CDist):
+            return NotImplemented
+        return self.copy().merge(other)
+    
+    def __radd__(self, other):
+        # Allows sum() over distributions.
+        if other == 0:
+            return self.copy()
+        return NotImplemented
+    
+    @property
+    def mean_sum(self):
+        """
+        The sum of all samples.
+        """
+        return self.running_mean*self.mean_count
+    
     @property
     def count(self):
         """
@@ -327,7 +507,7 @@ class CDist(object):
     @property
     def mean(self):
         if self.mean_count:
-            return self.mean_sum/float(self.mean_count)
+            return self.running_mean
     
     @property
     def variance(self):
@@ -350,6 +530,23 @@ class CDist(object):
             return
         return normdist(x=x, mu=self.mean, sigma=self.standard_deviation)
     
+    def probabilities_lt(self, xs):
+        """
+        Returns an array of the probability of a random variable being less
+        than each of the given values.
+        """
+        return normcdf_many(xs, self.mean, self.standard_deviation)
+    
+    def probabilities_gt(self, xs):
+        """
+        Returns an array of the probability of a random variable being
+        greater than each of the given values.
+        """
+        ret = self.probabilities_lt(xs)
+        for i, p in enumerate(ret):
+            ret[i] = 1 - p
+        return ret
+    
     def probability_in(self, a, b):
         """
         Returns the probability of a random variable falling between the given
@@ -371,7 +568,93 @@ class CDist(object):
         p = normdist(x=x, mu=self.mean, sigma=self.standard_deviation)
         return 1-p
 
-def entropy(data, class_attr=None, method=DEFAULT_DISCRETE_METRIC):
+def _subtract_cdist(total, part):
+    """
+    Returns the distribution of the samples in total that are not in part,
+    where part's samples are a subset of total's.
+    """
+    n = total.mean_count - part.mean_count
+    ret = CDist()
+    if n <= 0:
+        return ret
+    ret.mean_count = n
+    ret.running_mean = (total.mean_sum - part.mean_sum)/float(n)
+    ret.last_variance = total.last_variance
+    if part.mean_count:
+        # Reverse the parallel variance combination of the two subsets.
+        delta = part.mean - ret.mean
+        ret.last_variance -= part.last_variance \
+            + delta**2*n*part.mean_count/float(total.mean_count)
+    ret.last_variance = max(0, ret.last_variance)
+    return ret
+
+def _merge_nested(target, source):
+    """
+    Adds the counts and distributions in the nested dicts of source to
+    those of target.
+    """
+    for k, v in iteritems(source):
+        if isinstance(v, dict):
+            _merge_nested(target[k], v)
+        elif isinstance(v, CDist):
+            target[k].merge(v)
+        else:
+            target[k] += v
+
+def _subtract_nested(total, part):
+    """
+    Returns a copy of the nested dicts of counts and distributions in total,
+    minus those in part, omitting empty entries.
+    """
+    ret = type(total)() if not isinstance(total, defaultdict) \
+        else defaultdict(total.default_factory)
+    for k, v in iteritems(total):
+        if isinstance(v, dict):
+            v = _subtract_nested(v, part.get(k, {}))
+            if not v:
+                continue
+        elif isinstance(v, CDist):
+            v = _subtract_cdist(v, part[k]) if k in part else v.copy()
+            if not v.count:
+                continue
+        else:
+            v = v - part.get(k, 0)
+            if not v:
+                continue
+        ret[k] = v
+    return ret
+
+def _subtract_stats(stats, last):
+    """
+    Returns the node statistics gained since an earlier copy of them,
+    as returned by Node.get_stats().
+    """
+    if last is None or stats['n'] < last['n']:
+        # The node is new, or was replaced, since the earlier copy.
+        return stats
+    ret = dict(stats)
+    ret['n'] = stats['n'] - last['n']
+    ret['class_cdist'] = _subtract_cdist(
+        stats['class_cdist'], last['class_cdist'])
+    for key in (
+        'class_counts',
+        'attr_value_counts',
+        'attr_value_count_totals',
+        'attr_class_value_counts',
+        'attr_value_cdist',
+        'attr_class_count_totals',
+        'attr_cdist_totals'):
+        ret[key] = _subtract_nested(stats[key], last[key])
+    if stats['attr_name'] == last['attr_name']:
+        ret['branch_counts'] = _subtract_nested(
+            stats['branch_counts'], last['branch_counts'])
+        ret['branches'] = dict(
+            (av, _subtract_stats(branch, last['branches'].get(av)))
+            for av, branch in iteritems(stats['branches']))
+    return ret
+
+def entropy(data, class_attr=None, method=DEFAULT_DISCRETE_METRIC,
+    weight_attr=None):
     """
     Calculates the entropy of the attribute attr in given data set data.
     
@@ -380,6 +663,8 @@ def entropy(data, class_attr=None, method=DEFAULT_DISCRETE_METRIC):
         if dict, treated as value counts of the given attribute name
         if list, treated as a raw list from which the value counts will be generated
     attr<string> := the name of the class attribute
+    weight_attr<string> := the name of the attribute holding each record's
+        sample weight
     """
     assert (class_attr is None and isinstance(data, dict)) \
         or (class_attr is not None and isinstance(data, list))
@@ -390,7 +675,7 @@ def entropy(data, class_attr=None, method=DEFAULT_DISCRETE_METRIC):
         for record in data:
             # Note: A missing attribute is treated like an attribute with a value
             # of None, representing the attribute is "irrelevant".
-            counts[record.get(class_attr)] += 1.0
+            counts[record.get(class_attr)] += get_weight(record, weight_attr)
     len_data = float(sum(cnt for _, cnt in iteritems(counts)))
     n = max(2, len(counts))
     total = float(sum(counts.values()))
@@ -412,7 +697,7 @@ def entropy(data, class_attr=None, method=DEFAULT_DISCRETE_METRIC):
         raise
 
 def entropy_variance(data, class_attr=None,
-    method=DEFAULT_CONTINUOUS_METRIC):
+    method=DEFAULT_CONTINUOUS_METRIC, weight_attr=None):
     """
     Calculates the variance fo a continuous class attribute, to be used as an
     entropy metric.
@@ -422,13 +707,19 @@ def entropy_variance(data, class_attr=None,
         or (class_attr is not None and isinstance(data, list))
     if isinstance(data, dict):
         lst = data
+    elif weight_attr is not None:
+        return CDist(
+            seq=[record.get(class_attr) for record in data],
+            weights=[get_weight(record, weight_attr) for record in data]
+        ).variance
     else:
         lst = [record.get(class_attr) for record in data]
     return get_variance(lst)
 
 def get_gain(data, attr, class_attr,
     method=DEFAULT_DISCRETE_METRIC,
-    only_sub=0, prefer_fewer_values=False, entropy_func=None):
+    only_sub=0, prefer_fewer_values=False, entropy_func=None, default=None,
+    weight_attr=None):
     """
     Calculates the information gain (reduction in entropy) that would
     result by splitting the data on the chosen attribute (attr).
@@ -439,6 +730,11 @@ def get_gain(data, attr, class_attr,
         unique values. If multiple attributes have the same gain, but one has
         slightly fewer attributes, this will cause the one with fewer
         attributes to be preferred.
+    
+    default := The value assumed for records missing the attribute.
+    
+    weight_attr := The name of the attribute holding each record's sample
+        weight.
     """
     entropy_func = entropy_func or entropy
     val_freq = defaultdict(float)
@@ -446,14 +742,15 @@ def get_gain(data, attr, class_attr,
 
     # Calculate the frequency of each of the values in the target attribute
     for record in data:
-        val_freq[record.get(attr)] += 1.0
+        val_freq[record.get(attr, default)] += get_weight(record, weight_attr)
 
     # Calculate the sum of the entropy for each subset of records weighted
     # by their probability of occuring in the training set.
     for val in val_freq.keys():
         val_prob = val_freq[val] / sum(val_freq.values())
-        data_subset = [record for record in data if record.get(attr) == val]
-        e = entropy_func(data_subset, class_attr, method=method)
+        data_subset = [record for record in data if record.get(attr, default) == val]
+        e = entropy_func(data_subset, class_attr, method=method,
+            weight_attr=weight_attr)
         subset_entropy += val_prob * e
         
     if only_sub:
@@ -461,7 +758,8 @@ def get_gain(data, attr, class_attr,
 
     # Subtract the entropy of the chosen attribute from the entropy of the
     # whole data set with respect to the target attribute (and return it)
-    main_entropy = entropy_func(data, class_attr, method=method)
+    main_entropy = entropy_func(data, class_attr, method=method,
+        weight_attr=weight_attr)
     
     # Prefer gains on attributes with fewer values.
     if prefer_fewer_values:
@@ -527,22 +825,51 @@ def get_values(data, attr):
     """
     return unique([record[attr] for record in data])
 
-def choose_attribute(data, attributes, class_attr, fitness, method):
+def get_max_feature_count(max_features, n):
+    """
+    Returns the number of attributes, out of n, to consider at each split.
+    
+    max_features may be None for all attributes, an integer count,
+    a float fraction, or 'sqrt' or 'log2' of n.
+    """
+    if max_features is None:
+        return n
+    elif max_features == 'sqrt':
+        k = int(math.sqrt(n))
+    elif max_features == 'log2':
+        k = int(math.log(max(1, n), 2))
+    elif isinstance(max_features, float):
+        k = int(max_features*n)
+    else:
+        k = int(max_features)
+    return max(1, min(n, k))
+
+def choose_attribute(data, attributes, class_attr, fitness, method,
+    defaults=None, weight_attr=None):
     """
     Cycles through all the attributes and returns the attribute with the
     highest information gain (or lowest entropy).
+    
+    If given, defaults is a dict of {attr_name:value} giving the value
+    assumed for records missing an attribute, and weight_attr is the name of
+    the attribute holding each record's sample weight.
     """
+    defaults = defaults or {}
     best = (-1e999999, None)
     for attr in attributes:
         if attr == class_attr:
             continue
-        gain = fitness(data, attr, class_attr, method=method)
+        gain = fitness(data, attr, class_attr, method=method,
+            default=defaults.get(attr), weight_attr=weight_attr)
         best = max(best, (gain, attr))
     return best[1]
 
 def is_continuous(v):
     return isinstance(v, (float, Decimal))
 
+def _is_numeric(v):
+    return isinstance(v, (int, float, Decimal)) and not isinstance(v, bool)
+
 def create_decision_tree(data, attributes, class_attr, fitness_func, wrapper, **kwargs):
     """
     Returns a new decision tree based on the examples given.
@@ -550,20 +877,35 @@ def create_decision_tree(data, attributes, class_attr, fitness_func, wrapper, **
     
     split_attr = kwargs.get('split_attr', None)
     split_val = kwargs.get('split_val', None)
+    depth = kwargs.get('depth', 0)
     
     node = None
     data = list(data) if isinstance(data, Data) else data
+    schema = wrapper.data
+    defaults = None
+    if schema.sparse:
+        defaults = dict(
+            (attr, schema.get_default_value(attr)) for attr in attributes)
+    weight_attr = schema.weight_attribute_name
+    weights = None
+    if weight_attr is not None:
+        weights = [get_weight(r, weight_attr) for r in data]
     if wrapper.is_continuous_class:
-        stop_value = CDist(seq=[r[class_attr] for r in data])
+        stop_value = CDist(seq=[r[class_attr] for r in data], weights=weights)
         # For a continuous class case, stop if all the remaining records have
         # a variance below the given threshold.
         stop = wrapper.leaf_threshold is not None \
             and stop_value.variance <= wrapper.leaf_threshold
     else:
-        stop_value = DDist(seq=[r[class_attr] for r in data])
+        stop_value = DDist(seq=[r[class_attr] for r in data], weights=weights)
         # For a discrete class, stop if all remaining records have the same
         # classification.
         stop = len(stop_value.counts) <= 1
+    
+    # Stop if the tree has reached its size limits.
+    max_depth = wrapper.max_depth
+    stop = stop or len(data) < wrapper.min_samples_split \
+        or (max_depth is not None and depth >= max_depth)
 
     if not data or (len(attributes) - 1) <= 0:
         # If the dataset is empty or the attributes list is empty, return the
@@ -582,34 +924,60 @@ def create_decision_tree(data, attributes, class_attr, fitness_func, wrapper, **
         # Choose the next best attribute to best classify our data
         best = choose_attribute(
             data,
-            attributes,
+            wrapper.sample_attributes(attributes),
             class_attr,
             fitness_func,
-            method=wrapper.metric)
+            method=wrapper.metric,
+            defaults=defaults,
+            weight_attr=weight_attr)
+        
+        subsets = [] # [(val, records)]
+        for val in unique([schema.get_value(r, best) for r in data]):
+            subsets.append(
+                (val, [r for r in data if schema.get_value(r, best) == val]))
+        
+        # Don't split if a branch would have too few samples, or if the
+        # branches would exceed the maximum number of leaves, counting every
+        # branch still waiting to be built as at least one leaf.
+        unbuilt_count = wrapper._unbuilt_branch_count
+        subset_weights = [
+            sum(get_weight(r, weight_attr) for r in subset)
+            for _, subset in subsets]
+        if min(subset_weights) < wrapper.min_samples_leaf \
+        or (wrapper.max_leaf_count is not None and wrapper.leaf_count \
+        + unbuilt_count + len(subsets) > wrapper.max_leaf_count):
+            wrapper.leaf_count += 1
+            return stop_value
 
         # Create a new decision tree/node with the best attribute and an empty
         # dictionary object--we'll fill that up next.
 #        tree = {best:{}}
-        node = Node(tree=wrapper, attr_name=best)
+        node = Node(tree=wrapper, attr_name=best, depth=depth)
         node.n += len(data)
+        node._dist = stop_value
 
         # Create a new decision tree/sub-node for each of the values in the
         # best attribute field
-        for val in get_values(data, best):
+        wrapper._unbuilt_branch_count = unbuilt_count + len(subsets)
+        for (val, subset), subset_weight in zip(subsets, subset_weights):
+            node._count_branch(val, subset_weight)
+            wrapper._unbuilt_branch_count -= 1
             # Create a subtree for the current value under the "best" field
             subtree = create_decision_tree(
-                [r for r in data if r[best] == val],
+                subset,
                 [attr for attr in attributes if attr != best],
                 class_attr,
                 fitness_func,
                 split_attr=best,
                 split_val=val,
+                depth=depth+1,
                 wrapper=wrapper)
 
             # Add the new subtree to the empty dictionary object in our new
             # tree/node we just created.
             if isinstance(subtree, Node):
                 node._branches[val] = subtree
+                node._index_value(val)
             elif isinstance(subtree, (CDist, DDist)):
                 node.set_leaf_dist(attr_value=val, dist=subtree)
             else:
@@ -617,15 +985,130 @@ def create_decision_tree(data, attributes, class_attr, fitness_func, wrapper, **
 
     return node
 
+def open_data_file(filename):
+    """
+    Opens a CSV file for reading, transparently decompressing gzip, bzip2,
+    xz and, if the zstandard package is installed, zstd files according to
+    their extension.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.gz':
+        return gzip.open(filename, 'rb' if six.PY2 else 'rt')
+    elif ext == '.bz2':
+        if six.PY2:
+            return bz2.BZ2File(filename)
+        return bz2.open(filename, 'rt')
+    elif ext == '.xz':
+        assert lzma is not None, "Reading xz files requires lzma."
+        return lzma.open(filename, 'rt')
+    elif ext == '.zst':
+        assert zstandard is not None, \
+            "Reading zstd files requires the zstandard package."
+        return io.TextIOWrapper(
+            zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb')))
+    return open(filename)
+
+def _iter_csv(filename):
+    """
+    Iterates over the rows of a CSV file, closing it once the rows are
+    exhausted or the iterator is discarded.
+    """
+    with open(filename) as fin:
+        for row in csv.reader(fin):
+            yield row
+
+def iter_csv_threaded(filename, chunk_size=READ_CHUNK_SIZE,
+    queue_size=READ_QUEUE_SIZE):
+    """
+    Iterates over the rows of a CSV file that are decompressed and parsed
+    by a producer thread, so the consumer's work overlaps with reading.
+    """
+    chunks = six.moves.queue.Queue(queue_size)
+    stop = threading.Event()
+    
+    def put(item):
+        # Wait for room in the queue unless the consumer stopped reading.
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except six.moves.queue.Full:
+                pass
+    
+    def produce():
+        try:
+            with open_data_file(filename) as fin:
+                rows = csv.reader(fin)
+                while not stop.is_set():
+                    chunk = list(itertools.islice(rows, chunk_size))
+                    put(chunk)
+                    if not chunk:
+                        return
+        except Exception as e: # pylint: disable=broad-except
+            put(e)
+    
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                return
+            for row in chunk:
+                yield row
+    finally:
+        stop.set()
+
+def _infer_type(values):
+    """
+    Returns the narrowest attribute type holding all the given values,
+    which are either raw strings or already converted.
+    """
+    attr_type = ATTR_TYPE_DISCRETE
+    for value in values:
+        if isinstance(value, bool) or not isinstance(
+            value, (string_types, int, float, Decimal)):
+            return ATTR_TYPE_NOMINAL
+        if attr_type == ATTR_TYPE_DISCRETE:
+            if isinstance(value, int):
+                continue
+            if isinstance(value, string_types):
+                try:
+                    int(value)
+                    continue
+                except ValueError:
+                    pass
+            attr_type = ATTR_TYPE_CONTINUOUS
+        try:
+            float(value)
+        except ValueError:
+            return ATTR_TYPE_NOMINAL
+    return attr_type
+
 class Data(object):
     """
     Parses, validates and iterates over tabular data in a file
     or an generic iterator.
     
     This does not store the actual data rows. It only stores the row schema.
+    
+    In sparse mode, attributes missing from a row take an implicit default
+    value, and attributes equal to that default are dropped from each row,
+    so wide and mostly-empty rows are never expanded into dense dicts.
     """
     
-    def __init__(self, inp, order=None, types=None, modes=None):
+    def __init__(self, inp, order=None, types=None, modes=None,
+        sparse=False, sparse_default=None):
+        
+        # If true, absent attributes take an implicit default value.
+        self.sparse = sparse
+        
+        # The implicit value of absent attributes in sparse mode,
+        # either a single value or a dict of {attr_name:value}.
+        self.sparse_default = sparse_default
         
         self.header_types = types or {} # {attr_name:type}
         self.header_modes = modes or {} # {attr_name:mode}
@@ -655,14 +1138,79 @@ class Data(object):
             self.data = inp
         
         self._class_attr_name = None
+        self._weight_attr_name = None
+        self._clear_compiled_schema()
         if self.header_modes:
             for k, v in iteritems(self.header_modes):
-                if v != CLS:
-                    continue
-                self._class_attr_name = k
-                break
+                if v == WGT:
+                    self._weight_attr_name = k
+                elif v == CLS:
+                    self._class_attr_name = k
             assert self._class_attr_name, "No class attribute specified."
     
+    def __setstate__(self, state):
+        # Data pickled by earlier versions lacks the attributes added since,
+        # which take their defaults.
+        self.sparse = False
+        self.sparse_default = None
+        self._weight_attr_name = None
+        self._clear_compiled_schema()
+        self.__dict__.update(state)
+    
+    @classmethod
+    def infer(cls, inp, order=None, class_attr=None, weight_attr=None,
+        sample_size=INFER_SAMPLE_SIZE, **kwargs):
+        """
+        Returns a Data instance whose attribute types are inferred from the
+        first rows of a CSV file with a plain header of names, or of a list
+        of rows.
+        
+        Columns whose sampled values are all integers are discrete. Other
+        numeric columns are continuous if they're the class attribute, and
+        nominal otherwise. The weight attribute is always continuous, and the
+        class attribute defaults to the last column.
+        """
+        if isinstance(inp, string_types):
+            with open_data_file(inp) as fin:
+                rows = csv.reader(fin)
+                header = next(rows)
+                order = [
+                    ATTR_HEADER_PATTERN.sub(r'\1', el).strip() for el in header]
+                sample = list(itertools.islice(rows, sample_size))
+        else:
+            order = order or getattr(inp, 'columns', None)
+            rows = iter(inp)
+            sample = list(itertools.islice(rows, sample_size))
+            if rows is inp:
+                # The input can only be iterated once, so the sampled rows
+                # are put back in front of the rest.
+                inp = itertools.chain(sample, rows)
+            if sample and isinstance(sample[0], dict) and not order:
+                order = []
+                for row in sample:
+                    order.extend(name for name in row if name not in order)
+        if isinstance(order, string_types):
+            order = order.split(',')
+        assert order, "No attribute order specified."
+        sample = [
+            row if isinstance(row, dict) else dict(zip(order, row))
+            for row in sample if row
+        ]
+        class_attr = class_attr or order[-1]
+        
+        types = {}
+        for name in order:
+            values = [row[name] for row in sample if row.get(name) != '']
+            types[name] = _infer_type(values)
+            if types[name] == ATTR_TYPE_CONTINUOUS \
+            and name not in (class_attr, weight_attr):
+                types[name] = ATTR_TYPE_NOMINAL
+        modes = {class_attr: CLS}
+        if weight_attr is not None:
+            types[weight_attr] = ATTR_TYPE_CONTINUOUS
+            modes[weight_attr] = WGT
+        return cls(inp, order=order, types=types, modes=modes, **kwargs)
+    
     def copy_no_data(self):
         """
         Returns a copy of the object without any data.
@@ -671,11 +1219,25 @@ class Data(object):
             [],
             order=list(self.header_modes),
             types=self.header_types.copy(),
-            modes=self.header_modes.copy())
+            modes=self.header_modes.copy(),
+            sparse=self.sparse,
+            sparse_default=self.sparse_default)
     
     def __len__(self):
         if self.filename:
-            return max(0, open(self.filename).read().strip().count('\n'))
+            # Counts the line breaks between the first and last non-blank
+            # lines, one per row after the header, streaming the file rather
+            # than decompressing it into memory.
+            first = last = None
+            with open_data_file(self.filename) as fin:
+                for i, line in enumerate(fin):
+                    if line.strip():
+                        if first is None:
+                            first = i
+                        last = i
+            if first is None:
+                return 0
+            return last - first
         elif hasattr(self.data, '__len__'):
             return len(self.data)
 
@@ -684,12 +1246,24 @@ class Data(object):
         return self._class_attr_name
 
     @property
-    def attribute_names(self):
+    def weight_attribute_name(self):
+        """
+        The name of the attribute holding each record's sample weight,
+        or None if all records are weighted equally.
+        """
         self._read_header()
-        return [
-            n for n in iterkeys(self.header_types)
-            if n != self._class_attr_name
-        ]
+        return self._weight_attr_name
+
+    def get_weight(self, record):
+        """
+        Returns the sample weight of the given record.
+        """
+        return get_weight(record, self.weight_attribute_name)
+
+    @property
+    def attribute_names(self):
+        self._compile_schema()
+        return list(self._attribute_names)
 
     def get_attribute_type(self, name):
         if not self.header_types:
@@ -698,9 +1272,53 @@ class Data(object):
 
     @property
     def is_continuous_class(self):
+        if self._is_continuous_class is None:
+            self._compile_schema()
+        return self._is_continuous_class
+
+    def _clear_compiled_schema(self):
+        # The converter of each attribute, {attr_name:callable or None},
+        # or None if the schema hasn't been compiled.
+        self._converters = None
+        self._attribute_names = None
+        self._is_continuous_class = None
+
+    def _compile_schema(self):
+        """
+        Freezes the schema on first use, caching the converter of each
+        attribute and the type of the class, so rows and nodes don't
+        re-check the header types.
+        """
+        if self._converters is not None:
+            return
         self._read_header()
-        return self.get_attribute_type(self._class_attr_name) \
-            == ATTR_TYPE_CONTINUOUS
+        self._attribute_names = tuple(
+            n for n in iterkeys(self.header_types)
+            if n != self._class_attr_name and n != self._weight_attr_name
+        )
+        self._is_continuous_class = \
+            self.header_types.get(self._class_attr_name) == ATTR_TYPE_CONTINUOUS
+        self._converters = dict(
+            (name, ATTR_TYPE_CONVERTERS.get(attr_type))
+            for name, attr_type in iteritems(self.header_types))
+
+    def get_default_value(self, name):
+        """
+        Returns the implicit value of the given attribute when it's missing
+        from a sparse row.
+        """
+        if isinstance(self.sparse_default, dict):
+            return self.sparse_default.get(name)
+        return self.sparse_default
+
+    def get_value(self, record, name):
+        """
+        Returns the value of the given attribute in the record, falling back
+        to the implicit default in sparse mode.
+        """
+        if self.sparse:
+            return record.get(name, self.get_default_value(name))
+        return record[name]
 
     def is_valid(self, name, value):
         """
@@ -725,11 +1343,13 @@ class Data(object):
         """
         if not self.filename or self.header_types:
             return
-        rows = csv.reader(open(self.filename))
-        #header = rows.next()
-        header = next(rows)
+        with open_data_file(self.filename) as fin:
+            rows = csv.reader(fin)
+            #header = rows.next()
+            header = next(rows)
         self.header_types = {} # {attr_name:type}
         self._class_attr_name = None
+        self._weight_attr_name = None
         self.header_order = [] # [attr_name,...]
         for el in header:
             matches = ATTR_HEADER_PATTERN.findall(el)
@@ -742,6 +1362,10 @@ class Data(object):
                 assert self._class_attr_name is None, \
                     "Multiple class attributes are not supported."
                 self._class_attr_name = el_name
+            elif el_mode == ATTR_MODE_WEIGHT:
+                assert self._weight_attr_name is None, \
+                    "Multiple weight attributes are not supported."
+                self._weight_attr_name = el_name
             else:
                 assert self.header_types[el_name] != ATTR_TYPE_CONTINUOUS, \
                     "Non-class continuous attributes are not supported."
@@ -750,6 +1374,9 @@ class Data(object):
     def validate_row(self, row):
         """
         Ensure each element in the row matches the schema.
+        
+        In sparse mode, elements equal to their attribute's default value
+        are omitted.
         """
         clean_row = {}
         if isinstance(row, (tuple, list)):
@@ -760,19 +1387,28 @@ class Data(object):
         else:
             assert isinstance(row, dict)
             itr = iteritems(row)
+        if self._converters is None:
+            self._compile_schema()
+        converters = self._converters
         for el_name, el_value in itr:
-            if self.header_types[el_name] == ATTR_TYPE_DISCRETE:
-                clean_row[el_name] = int(el_value)
-            elif self.header_types[el_name] == ATTR_TYPE_CONTINUOUS:
-                clean_row[el_name] = float(el_value)
-            else:
-                clean_row[el_name] = el_value
+            convert = converters[el_name]
+            clean_row[el_name] = el_value if convert is None \
+                else convert(el_value)
+        if self.sparse:
+            for el_name in list(clean_row):
+                if el_name != self._class_attr_name \
+                and el_name != self._weight_attr_name \
+                and clean_row[el_name] == self.get_default_value(el_name):
+                    del clean_row[el_name]
         return clean_row
 
     def _get_iterator(self):
         if self.filename:
             self._read_header()
-            itr = csv.reader(open(self.filename))
+            if self.filename.lower().endswith(COMPRESSED_EXTENSIONS):
+                itr = iter_csv_threaded(self.filename)
+            else:
+                itr = _iter_csv(self.filename)
             next(itr) # Skip header.
             return itr
         return self.data
@@ -782,6 +1418,24 @@ class Data(object):
             if not row:
                 continue
             yield self.validate_row(row)
+    
+    def iter_batches(self, batch_size=None):
+        """
+        Iterates over lists of validated rows, fetched in bulk from the
+        source if it supports it, for use with Tree.train_many().
+        """
+        source = self.data
+        if batch_size is None and isinstance(source, DataSource):
+            for batch in source.iter_batches():
+                yield [self.validate_row(row) for row in batch if row]
+            return
+        itr = iter(self)
+        batch_size = batch_size or DataSource.batch_size
+        while True:
+            batch = list(itertools.islice(itr, batch_size))
+            if not batch:
+                return
+            yield batch
             
     def split(self, ratio=0.5, leave_one_out=False):
         """
@@ -816,11 +1470,350 @@ class Data(object):
                 b.data.append(row)
         return a, b
 
+    def stream_split(self, ratio=0.5, seed=0):
+        """
+        Returns two lazy views of the data, split according to the given
+        ratio by a seeded hash of each row's index.
+        
+        Unlike split(), no rows are copied. Each view re-streams this data
+        on iteration, so the same seed always produces the same split.
+        """
+        return (
+            DataView(self, lo=0.0, hi=ratio, seed=seed),
+            DataView(self, lo=ratio, hi=1.0, seed=seed),
+        )
+
+    def kfold(self, k=10, seed=0):
+        """
+        Iterates over k lazy (train, test) view pairs for cross-validation.
+        
+        Each row is assigned to exactly one test fold by a seeded hash of
+        its index, and is in the train view of every other fold.
+        """
+        assert k >= 2, "At least two folds are required."
+        for fold in six.moves.range(k):
+            yield self.get_fold(fold, k=k, seed=seed)
+
+    def get_fold(self, fold, k=10, seed=0):
+        """
+        Returns the lazy (train, test) view pair of a single fold, as
+        iterated by kfold().
+        """
+        assert 0 <= fold < k, "Invalid fold: %s" % (fold,)
+        lo, hi = fold/float(k), (fold + 1)/float(k)
+        return (
+            DataView(self, lo=lo, hi=hi, seed=seed, invert=True),
+            DataView(self, lo=lo, hi=hi, seed=seed),
+        )
+
+_HASH_MASK = (1 << 64) - 1
+
+def hash_index(index, seed=0):
+    """
+    Deterministically maps a row index to a pseudo-random number in [0, 1),
+    using the SplitMix64 finalizer.
+    """
+    h = ((index + 1)*0x9E3779B97F4A7C15 + seed*0xBF58476D1CE4E5B9) & _HASH_MASK
+    h = ((h ^ (h >> 30))*0xBF58476D1CE4E5B9) & _HASH_MASK
+    h = ((h ^ (h >> 27))*0x94D049BB133111EB) & _HASH_MASK
+    h ^= h >> 31
+    return h/float(1 << 64)
+
+class DataView(Data):
+    """
+    A lazy subset of another Data instance's rows.
+    
+    Rows are selected either by an explicit array of row indexes, which may
+    contain duplicates, or by hashing each row's index into [0, 1) and
+    keeping those that fall within [lo, hi), or outside it if invert is true.
+    
+    The source's rows are never copied. When the source is held in memory,
+    the selected indexes are computed once and rows are fetched by index.
+    Otherwise the source is re-streamed on every iteration, yielding rows
+    in source order.
+    """
+    
+    def __init__(self, source, lo=0.0, hi=1.0, seed=0, invert=False, indexes=None):
+        assert isinstance(source, Data)
+        source._read_header()
+        self.source = source
+        self.lo = lo
+        self.hi = hi
+        self.seed = seed
+        self.invert = invert
+        
+        # Share the source's schema.
+        self.header_types = source.header_types
+        self.header_modes = source.header_modes
+        self.header_order = source.header_order
+        self.sparse = source.sparse
+        self.sparse_default = source.sparse_default
+        self._class_attr_name = source._class_attr_name
+        self._weight_attr_name = source._weight_attr_name
+        self._clear_compiled_schema()
+        self.filename = None
+        self.data = None
+        
+        # Resolve the row indexes up front if the source rows can be
+        # accessed directly.
+        self.indexes = None
+        self._index_counts = None
+        if indexes is not None:
+            self.indexes = array('L', indexes)
+        elif self._is_indexable:
+            self.indexes = array('L', [
+                i for i in six.moves.range(len(self.source.data))
+                if self.contains(i)
+            ])
+        if self.indexes is not None and not self._is_indexable:
+            self._index_counts = Counter(self.indexes)
+    
+    @property
+    def _is_indexable(self):
+        data = self.source.data
+        return hasattr(data, '__getitem__') and hasattr(data, '__len__')
+    
+    def contains(self, index):
+        """
+        Returns true if the source row with the given index is in this view.
+        """
+        if self.indexes is not None:
+            if self._index_counts is None:
+                self._index_counts = Counter(self.indexes)
+            return index in self._index_counts
+        inside = self.lo <= hash_index(index, self.seed) < self.hi
+        return inside != self.invert
+    
+    def copy_no_data(self):
+        return self.source.copy_no_data()
+    
+    def __len__(self):
+        if self.indexes is not None:
+            return len(self.indexes)
+        return sum(1 for _ in self._get_iterator())
+    
+    def _get_iterator(self):
+        if self.indexes is not None and self._is_indexable:
+            rows = self.source.data
+            return (rows[i] for i in self.indexes)
+        if self.indexes is None \
+        and isinstance(self.source.data, DataSource) \
+        and self.source.data.can_filter_range:
+            # Let the source skip the rows outside the view.
+            return iter(self.source.data.filter_range(
+                self.lo, self.hi, seed=self.seed, invert=self.invert))
+        return self._stream()
+    
+    def _stream(self):
+        for i, row in enumerate(self.source._get_iterator()):
+            if not row:
+                continue
+            if self._index_counts is not None:
+                for _ in six.moves.range(self._index_counts.get(i, 0)):
+                    yield row
+            elif self.contains(i):
+                yield row
+
+@six.add_metaclass(abc.ABCMeta)
+class DataSource(object):
+    """
+    A source of rows fetched in bulk, which Data can read from in place of
+    a file or a list.
+    
+    Subclasses implement iter_batches(), yielding lists of rows, each either
+    a tuple in the order of the source's columns or a dict.
+    """
+    
+    # The number of rows fetched at once.
+    batch_size = 1000
+    
+    # The names of the source's columns, if known.
+    columns = None
+    
+    # If true, filter_range() can select a stream split inside the source.
+    can_filter_range = False
+    
+    @abc.abstractmethod
+    def iter_batches(self):
+        """
+        Iterates over lists of the source's rows.
+        """
+    
+    def filter_range(self, lo, hi, seed=0, invert=False):
+        """
+        Returns a copy of the source selecting only the rows whose hashed
+        index falls within [lo, hi), or outside it if invert is true.
+        
+        Sources that set can_filter_range override this.
+        """
+        assert self.can_filter_range, \
+            "%s can't filter a stream split." % (type(self).__name__,)
+    
+    def __iter__(self):
+        for batch in self.iter_batches():
+            for row in batch:
+                yield row
+
+class IteratorSource(DataSource):
+    """
+    Reads rows in chunks from an iterable, or from a callable returning a
+    new iterator over the rows each time the source is read.
+    """
+    
+    def __init__(self, rows, batch_size=1000, columns=None):
+        self.rows = rows
+        self.batch_size = batch_size
+        self.columns = columns
+    
+    def iter_batches(self):
+        rows = self.rows
+        itr = iter(rows() if callable(rows) else rows)
+        while True:
+            batch = list(itertools.islice(itr, self.batch_size))
+            if not batch:
+                return
+            yield batch
+
+def _sqlite_in_range(key, lo, hi, seed, invert):
+    """
+    Returns true if the row with the given integer key is selected by a
+    stream split, treating keys from 1 as row indexes from 0.
+    """
+    inside = lo <= hash_index(key - 1, seed) < hi
+    return inside != bool(invert)
+
+class SQLiteSource(DataSource):
+    """
+    Reads the rows of a SQLite table or query with fetchmany().
+    
+    Stream splits are filtered inside SQLite by hashing an integer key
+    column, the rowid by default. When a table's rowids run from 1 without
+    gaps, a split selects the same rows as a split of the rows in memory.
+    
+    The connection is opened on first use and shared with the copies made
+    for stream splits. close(), or leaving a with block, closes it.
+    """
+    
+    can_filter_range = True
+    
+    def __init__(self, database, table=None, query=None, params=(),
+        batch_size=1000, key='rowid'):
+        assert sqlite3 is not None, "SQLite is not available."
+        assert (table is None) != (query is None), \
+            "Either a table or a query must be given."
+        assert table is not None or key != 'rowid', \
+            "A key column must be given to split a query."
+        self.database = database
+        self.table = table
+        self.query = query
+        self.params = tuple(params)
+        self.batch_size = batch_size
+        self.key = key
+        # The stream split to select, as (lo, hi, seed, invert).
+        self.range = None
+        self._connection = None
+        self._columns = None
+    
+    def __getstate__(self):
+        # Connections can't be pickled, so each process opens its own.
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+    
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.database)
+            self._connection.create_function(
+                '_dtree_in_range', 5, _sqlite_in_range)
+        return self._connection
+    
+    def _get_sql(self):
+        """
+        Returns the query selecting the source's rows, and its parameters.
+        """
+        if self.table is not None:
+            sql = 'SELECT * FROM "%s"' % self.table.replace('"', '""')
+        else:
+            sql = 'SELECT * FROM (%s)' % self.query
+        params = self.params
+        if self.range is not None:
+            sql += ' WHERE _dtree_in_range("%s", ?, ?, ?, ?)' \
+                % self.key.replace('"', '""')
+            params += tuple(self.range)
+        return sql, params
+    
+    @property
+    def columns(self):
+        if self._columns is None:
+            sql, params = self._get_sql()
+            cursor = self.connection.execute(
+                'SELECT * FROM (%s) LIMIT 0' % sql, params)
+            self._columns = [column[0] for column in cursor.description]
+        return self._columns
+    
+    def __len__(self):
+        sql, params = self._get_sql()
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM (%s)' % sql, params).fetchone()[0]
+    
+    def filter_range(self, lo, hi, seed=0, invert=False):
+        ret = copy.copy(self)
+        ret.range = (lo, hi, seed, int(invert))
+        return ret
+    
+    def iter_batches(self):
+        sql, params = self._get_sql()
+        cursor = self.connection.cursor()
+        cursor.arraysize = self.batch_size
+        cursor.execute(sql, params)
+        try:
+            while True:
+                batch = cursor.fetchmany(self.batch_size)
+                if not batch:
+                    return
+                yield batch
+        finally:
+            cursor.close()
+
+# Missing value policies, applied when a query record has a value the
+# tree has never seen at a node.
+
+# Follow the branch of the nearest numeric value.
 USE_NEAREST = 'use_nearest'
+
+# Follow the branch of the value seen most frequently at the node.
+USE_MOST_FREQUENT = 'use_most_frequent'
+
+# Stop and predict using the class distribution of all samples at the node.
+USE_NODE_DIST = 'use_node_dist'
+
+# Follow every branch and weight their predictions by the frequency of each
+# branch's value, as in C4.5.
+USE_WEIGHTED = 'use_weighted'
+
 MISSING_VALUE_POLICIES = set([
     USE_NEAREST,
+    USE_MOST_FREQUENT,
+    USE_NODE_DIST,
+    USE_WEIGHTED,
 ])
 
+# The maximum number of unseen values whose nearest known value is cached
+# at each node.
+NEAREST_CACHE_SIZE = 32
+
 def _get_dd_int():
     return defaultdict(int)
 
@@ -833,16 +1826,243 @@ def _get_dd_cdist():
 class NodeNotReadyToPredict(Exception):
     pass
 
-class Node(object):
+def get_prediction_error(prediction, actual_value):
+    """
+    Returns the absolute error of a CDist prediction's mean, or 1 if a DDist
+    prediction's best class is wrong and 0 otherwise.
+    """
+    if isinstance(prediction, CDist):
+        if prediction.mean is None:
+            return
+        return abs(prediction.mean - actual_value)
+    return int(prediction.best != actual_value)
+
+# The smallest probability used for log-loss, bounding the loss of a
+# confident wrong prediction.
+LOG_LOSS_EPSILON = 1e-15
+
+# The number of records predicted together when evaluating a model.
+EVALUATE_BATCH_SIZE = 1000
+
+class Evaluation(object):
+    """
+    Accumulates metrics of a model's predictions in a single pass.
+    
+    For a discrete class, these are the accuracy, the confusion matrix,
+    per-class precision and recall, and the log-loss of the predicted
+    probabilities. For a continuous class, these are the mean absolute
+    error and the root mean squared error.
+    """
+    
+    def __init__(self, is_continuous_class):
+        self.is_continuous_class = is_continuous_class
+        
+        # The total weight of all predictions.
+        self.count = 0
+        
+        # Discrete metrics.
+        self.accuracy = CDist()
+        # {actual_value:{predicted_value:count}}
+        self.confusion_matrix = defaultdict(_get_dd_int)
+        self.log_loss = CDist()
+        
+        # Continuous metrics.
+        self.absolute_error = CDist()
+        self.squared_error = CDist()
+    
+    def add(self, prediction, actual_value, weight=1):
+        """
+        Records the prediction of a record with the given actual class value.
+        """
+        self.count += weight
+        if self.is_continuous_class:
+            error = prediction.mean - actual_value
+            self.absolute_error.add(abs(error), weight)
+            self.squared_error.add(error*error, weight)
+            return
+        best = prediction.best
+        self.accuracy.add(best == actual_value, weight)
+        self.confusion_matrix[actual_value][best] += weight
+        prob = 0.0
+        if prediction.total:
+            prob = prediction.counts.get(actual_value, 0)/float(prediction.total)
+        self.log_loss.add(-math.log(max(prob, LOG_LOSS_EPSILON)), weight)
+    
+    @property
+    def score(self):
+        """
+        The distribution of accuracy for a discrete class, or of absolute
+        error for a continuous class, as returned by test().
+        """
+        if self.is_continuous_class:
+            return self.absolute_error
+        return self.accuracy
+    
+    @property
+    def mae(self):
+        return self.absolute_error.mean
+    
+    @property
+    def rmse(self):
+        if self.squared_error.mean is None:
+            return
+        return math.sqrt(self.squared_error.mean)
+    
+    @property
+    def classes(self):
+        """
+        The actual and predicted class values seen.
+        """
+        ret = set(self.confusion_matrix)
+        for counts in itervalues(self.confusion_matrix):
+            ret.update(counts)
+        return ret
+    
+    def precision(self, cls_value):
+        """
+        Returns the fraction of predictions of the class value that were
+        correct, or None if it was never predicted.
+        """
+        predicted = sum(
+            counts.get(cls_value, 0)
+            for counts in itervalues(self.confusion_matrix))
+        if not predicted:
+            return
+        return self.confusion_matrix.get(cls_value, {}).get(cls_value, 0) \
+            /float(predicted)
+    
+    def recall(self, cls_value):
+        """
+        Returns the fraction of records of the class value that were
+        predicted correctly, or None if there were none.
+        """
+        counts = self.confusion_matrix.get(cls_value, {})
+        actual = sum(itervalues(counts))
+        if not actual:
+            return
+        return counts.get(cls_value, 0)/float(actual)
+
+def evaluate(model, data):
+    """
+    Returns the Evaluation of the model's predictions on the data, predicting
+    batches of records together.
+    Records the model can't make a prediction for are skipped.
+    """
+    class_attr = model.data.class_attribute_name
+    weight_attr = model.data.weight_attribute_name
+    evaluation = Evaluation(model.data.is_continuous_class)
+    itr = iter(data)
+    while True:
+        records = list(itertools.islice(itr, EVALUATE_BATCH_SIZE))
+        if not records:
+            break
+        for record, prediction in zip(records, model.predict_many(records)):
+            if prediction is None:
+                continue
+            evaluation.add(prediction, record[class_attr],
+                get_weight(record, weight_attr))
+    return evaluation
+
+class PredictionCache(object):
+    """
+    A bounded cache of predictions, evicting the least recently used.
+    
+    Concurrent lookups and insertions never corrupt the cache, but a lookup
+    racing another for the same key may miss, and the hits and misses
+    counters are not locked, so they are only approximate when the cache is
+    shared between threads.
+    """
+    
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self):
+        return len(self._items)
+    
+    def get(self, key):
+        """
+        Returns the cached prediction for the key, or None.
+        """
+        value = self._items.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return
+        self._items[key] = value
+        self.hits += 1
+        return value
+    
+    def set(self, key, value):
+        items = self._items
+        items[key] = value
+        while len(items) > self.size:
+            try:
+                items.popitem(last=False)
+            except KeyError:
+                break
+    
+    def clear(self):
+        self._items.clear()
+
+class ErrorWindow(object):
+    """
+    Tracks a sliding window of recent prediction errors, split into an older
+    and a newer half, to detect when the error has risen.
+    """
+    
+    def __init__(self, size):
+        self.size = size
+        self.old = deque()
+        self.new = deque()
+        self.old_sum = 0.0
+        self.new_sum = 0.0
+        # The largest error seen, bounding the range of errors.
+        self.max_error = 0.0
+    
+    def add(self, error):
+        self.max_error = max(self.max_error, error)
+        self.new.append(error)
+        self.new_sum += error
+        if len(self.new) > self.size//2:
+            error = self.new.popleft()
+            self.new_sum -= error
+            self.old.append(error)
+            self.old_sum += error
+            if len(self.old) > self.size//2:
+                self.old_sum -= self.old.popleft()
+    
+    def clear(self):
+        self.old.clear()
+        self.new.clear()
+        self.old_sum = self.new_sum = 0.0
+    
+    def has_drifted(self, delta):
+        """
+        Returns true if the mean error of the newer half exceeds that of the
+        older half by more than the ADWIN bound for the given confidence.
+        """
+        n0, n1 = len(self.old), len(self.new)
+        if not n0 or n0 + n1 < self.size:
+            return False
+        m = 1/(1./n0 + 1./n1)
+        epsilon = self.max_error*math.sqrt(math.log(4./delta)/(2*m))
+        return self.new_sum/n1 - self.old_sum/n0 > epsilon
+
+class Node(object):
     """
     Represents a specific split or branch in the tree.
     """
     
-    def __init__(self, tree, attr_name=None):
+    def __init__(self, tree, attr_name=None, depth=0):
         
         # The number of samples this node has been trained on.
         self.n = 0
         
+        # The number of splits between the root and this node.
+        self.depth = depth
+        
         # A reference to the container tree instance.
         self._tree = tree
         
@@ -874,7 +2094,88 @@ class Node(object):
         self._attr_value_cdist = defaultdict(_get_dd_cdist)
         self._class_cdist = CDist()
         
+        #### Sparse values.
+        
+        # Class statistics summed over all explicitly stored values of each
+        # attribute, from which the statistics of a sparse attribute's
+        # implicit default value are derived.
+        # {attr_name:{class_value:count}}
+        self._attr_class_count_totals = defaultdict(_get_dd_int)
+        # {attr_name:CDist}
+        self._attr_cdist_totals = defaultdict(CDist)
+        
+        #### Cached entropy terms.
+        
+        # The unpenalized entropy of each attribute value, weighted by the
+        # value's count, so an attribute's subset entropy can be calculated
+        # without revisiting all of its values.
+        # {attr_name:{attr_value:count*entropy}}
+        self._attr_value_entropy_terms = defaultdict(dict)
+        # {attr_name:sum of entropy terms}
+        self._attr_entropy_term_sums = defaultdict(float)
+        # The attribute/value pairs whose entropy terms are out of date.
+        # {(attr_name, attr_value)}
+        self._dirty_entropy_terms = set()
+        # The entropy of the class attribute, or None if out of date.
+        self._main_entropy = None
+        
         self._branches = {} # {v:Node}
+        
+        # The sorted numeric values of the splitting attribute, used to find
+        # the nearest known value of an unseen value.
+        self._sorted_values = []
+        
+        # The nearest known value of recently seen unknown values.
+        # {attr_value:nearest_value}
+        self._nearest_cache = {}
+        
+        # The number of samples routed down each value of the splitting
+        # attribute, and the most frequent such value.
+        # {attr_value:count}
+        self._branch_counts = defaultdict(int)
+        self._most_frequent_value = None
+        
+        # The class distribution of all samples at a node built in batch.
+        # Online nodes use their class statistics instead.
+        self._dist = None
+        
+        # The number of samples when this node was pruned back to a leaf, or
+        # None. A pruned node only splits again after splitting_n more.
+        self._pruned_n = None
+        
+        # The recent errors of this split node, and the subtree grown to
+        # replace it after they rise, when detecting concept drift.
+        # These are only created once the tree detects drift at this node.
+        self._error_window = None
+        self._alternate = None
+        # The errors of the alternate subtree and of this subtree on the
+        # samples seen since the alternate was started.
+        self._alternate_error = None
+        self._own_error = None
+    
+    def __setstate__(self, state):
+        # Nodes pickled by earlier versions lack the attributes added since,
+        # which take their defaults until the tree calls _upgrade().
+        Node.__init__(self, tree=None)
+        self.__dict__.update(state)
+    
+    def _upgrade(self, depth=0):
+        """
+        Rebuilds the derived state of this subtree that nodes pickled by
+        earlier versions lack.
+        """
+        self.depth = depth
+        for attr_name, values in iteritems(self._attr_value_counts):
+            for attr_value in values:
+                self._mark_dirty(attr_name, attr_value)
+        if self.attr_name and not self._branch_counts:
+            for attr_value in self.get_values(self.attr_name):
+                self._index_value(attr_value)
+                branch = self._branches.get(attr_value)
+                self._count_branch(attr_value, branch.n if branch is not None
+                    else self._get_value_count(self.attr_name, attr_value))
+        for branch in itervalues(self._branches):
+            branch._upgrade(depth + 1)
     
     def __getitem__(self, attr_name):
         assert attr_name == self.attr_name
@@ -883,7 +2184,7 @@ class Node(object):
             if value in branches:
                 continue
             elif self.tree.data.is_continuous_class:
-                branches[value] = self._attr_value_cdist[self.attr_name][value].copy()
+                branches[value] = self.get_value_cdist(self.attr_name, value)
             else:
                 branches[value] = self.get_value_ddist(self.attr_name, value)
         return branches
@@ -901,10 +2202,11 @@ class Node(object):
         # Otherwise, lookup the attribute value for this node in the
         # given record.
         attr = self.attr_name
-        attr_value = record[attr]
-        attr_values = self.get_values(attr)
-        if attr_value in attr_values:
+        attr_value = self.tree.data.get_value(record, attr)
+        if self.has_value(attr, attr_value):
             return attr_value
+        elif attr_value is not None and self._is_summarized(attr):
+            return self._get_summary_value(attr, attr_value)
         else:
             # The value of the attribute in the given record does not directly
             # map to any previously known values, so apply a missing value
@@ -919,30 +2221,254 @@ class Node(object):
                 assert self.tree.data.header_types[attr] \
                     in (ATTR_TYPE_DISCRETE, ATTR_TYPE_CONTINUOUS), \
                     "The use-nearest policy is invalid for nominal types."
-                nearest = (1e999999, None)
-                for _value in attr_values:
-                    nearest = min(
-                        nearest,
-                        (abs(_value - attr_value), _value))
-                _, nearest_value = nearest
-                return nearest_value
+                return self._get_nearest_value(attr_value)
+            elif policy == USE_MOST_FREQUENT:
+                return self._most_frequent_value
+            elif policy in (USE_NODE_DIST, USE_WEIGHTED):
+                # These are resolved by predict() without choosing a value.
+                return
             else:
                 raise Exception("Unknown missing value policy: %s" % (policy,))
 
+    def _get_nearest_value(self, attr_value):
+        """
+        Returns the known value of the splitting attribute with the smallest
+        Euclidean distance to the given value, preferring the smaller value
+        on a tie.
+        """
+        cache = self._nearest_cache
+        # Frozen nodes have no cache, so lookups never modify them.
+        if cache is not None:
+            nearest_value = cache.get(attr_value)
+            if nearest_value is not None:
+                return nearest_value
+        values = self._sorted_values
+        i = bisect.bisect_left(values, attr_value)
+        nearest = (1e999999, None)
+        for _value in values[max(0, i-1):i+1]:
+            nearest = min(nearest, (abs(_value - attr_value), _value))
+        _, nearest_value = nearest
+        if cache is None:
+            return nearest_value
+        # Rather than evicting individual entries, the cache is reset when
+        # full.
+        if len(cache) >= NEAREST_CACHE_SIZE:
+            cache.clear()
+        cache[attr_value] = nearest_value
+        return nearest_value
+
+    def _freeze(self):
+        """
+        Drops the caches of this subtree that prediction would update, so
+        a frozen snapshot is only read while predicting.
+        """
+        self._nearest_cache = None
+        for branch in itervalues(self._branches):
+            branch._freeze()
+
+    def _count_branch(self, attr_value, count=1):
+        """
+        Records samples routed down the given value of the splitting
+        attribute, keeping track of the most frequent value.
+        """
+        counts = self._branch_counts
+        counts[attr_value] += count
+        best = self._most_frequent_value
+        if best is None or counts[attr_value] > counts[best]:
+            self._most_frequent_value = attr_value
+
+    def _index_value(self, attr_value):
+        """
+        Records a known numeric value of the splitting attribute.
+        """
+        if not _is_numeric(attr_value):
+            return
+        values = self._sorted_values
+        i = bisect.bisect_left(values, attr_value)
+        if i < len(values) and values[i] == attr_value:
+            return
+        values.insert(i, attr_value)
+        self._nearest_cache.clear()
+
+    def _is_summarized(self, attr_name):
+        """
+        Returns true if the values of the given attribute are summarized
+        with a bounded number of bins.
+        """
+        return self.tree.numeric_summary_size is not None \
+            and self.tree.data.header_types.get(attr_name) \
+                == ATTR_TYPE_CONTINUOUS
+
+    def _get_summary_value(self, attr_name, attr_value):
+        """
+        Returns the bin of the splitting attribute nearest the given value,
+        if the attribute is summarized. Returns the value unchanged otherwise.
+        """
+        if attr_name != self.attr_name or not self._sorted_values \
+        or not _is_numeric(attr_value) or not self._is_summarized(attr_name):
+            return attr_value
+        return self._get_nearest_value(attr_value)
+
+    def _compress_values(self, attr_name):
+        """
+        Merges the closest adjacent bins of a summarized attribute until
+        there are no more than the tree's numeric_summary_size, as in the
+        streaming histogram of Ben-Haim and Tom-Tov.
+        """
+        size = self.tree.numeric_summary_size
+        counts = self._attr_value_counts[attr_name]
+        if len(counts) <= size:
+            return
+        values = sorted(v for v in counts if _is_numeric(v))
+        while len(values) > max(1, size):
+            i = min(
+                six.moves.range(len(values) - 1),
+                key=lambda i: values[i+1] - values[i])
+            values[i:i+2] = [
+                self._merge_values(attr_name, values[i], values[i+1])]
+
+    def _merge_values(self, attr_name, a, b):
+        """
+        Replaces the statistics of two values of an attribute with a single
+        bin at their weighted mean, returning the bin's value.
+        """
+        counts = self._attr_value_counts[attr_name]
+        count_a = counts.pop(a, 0)
+        count_b = counts.pop(b, 0)
+        total = count_a + count_b
+        if total:
+            merged = (a*count_a + b*count_b)/float(total)
+        else:
+            merged = (a + b)/2.0
+        counts[merged] += total
+        if self.is_continuous_class:
+            cdists = self._attr_value_cdist[attr_name]
+            cdist = cdists.pop(a, None) or CDist()
+            cdist.merge(cdists.pop(b, None) or CDist())
+            cdists[merged] = cdist
+        else:
+            class_counts = self._attr_class_value_counts[attr_name]
+            merged_counts = defaultdict(int)
+            for value in (a, b):
+                for cls_value, cls_count \
+                in iteritems(class_counts.pop(value, {})):
+                    merged_counts[cls_value] += cls_count
+            class_counts[merged] = merged_counts
+        # Drop the cached entropy terms of the replaced values.
+        terms = self._attr_value_entropy_terms[attr_name]
+        for value in (a, b):
+            self._attr_entropy_term_sums[attr_name] -= terms.pop(value, 0.0)
+            self._dirty_entropy_terms.discard((attr_name, value))
+        self._mark_dirty(attr_name, merged)
+        return merged
+
     @property
     def attributes(self):
         return iterkeys(self._attr_value_counts)
     
+    def has_value(self, attr_name, attr_value):
+        """
+        Returns true if the given attribute value has been seen at this node.
+        """
+        if attr_name == self.attr_name and attr_value in self._branches:
+            return True
+        if self._is_explicit_value(attr_name, attr_value):
+            return True
+        return self._is_implicit_default(attr_name, attr_value) \
+            and self._get_default_count(attr_name) > 0
+    
     def get_values(self, attr_name):
         """
         Retrieves the unique set of values seen for the given attribute
         at this node.
         """
-        ret = list(self._attr_value_cdist[attr_name].keys()) \
-            + list(self._attr_value_counts[attr_name].keys()) \
+        ret = list(self._attr_value_cdist.get(attr_name, {}).keys()) \
+            + list(self._attr_value_counts.get(attr_name, {}).keys()) \
             + list(self._branches.keys())
         ret = set(ret)
+        if self._get_default_count(attr_name):
+            ret.add(self.tree.data.get_default_value(attr_name))
         return ret
+
+    def _is_implicit_default(self, attr_name, attr_value):
+        """
+        Returns true if the given value is a sparse attribute's default,
+        whose statistics are derived rather than stored.
+        """
+        data = self.tree.data
+        return data.sparse \
+            and attr_value == data.get_default_value(attr_name) \
+            and not self._is_explicit_value(attr_name, attr_value)
+
+    def _is_explicit_value(self, attr_name, attr_value):
+        """
+        Returns true if statistics for the given attribute value are stored
+        at this node.
+        """
+        return attr_value in self._attr_value_counts.get(attr_name, ()) \
+            or attr_value in self._attr_value_cdist.get(attr_name, ())
+
+    def _get_default_count(self, attr_name):
+        """
+        Returns the number of samples that implicitly had the default value
+        for the given sparse attribute.
+        """
+        data = self.tree.data
+        if not data.sparse:
+            return 0
+        if self._is_explicit_value(attr_name, data.get_default_value(attr_name)):
+            return 0
+        # Only samples given to train() update the class statistics.
+        if data.is_continuous_class:
+            total = self._class_cdist.count
+        else:
+            total = self._class_ddist.total
+        return total - self._attr_value_count_totals.get(attr_name, 0)
+
+    def _get_value_count(self, attr_name, attr_value):
+        """
+        Returns the number of samples seen with the given attribute value.
+        """
+        if self._is_implicit_default(attr_name, attr_value):
+            return self._get_default_count(attr_name)
+        return self._attr_value_counts[attr_name].get(attr_value, 0)
+
+    def _get_attr_total(self, attr_name):
+        """
+        Returns the number of samples seen for the given attribute, including
+        those that implicitly had its default value.
+        """
+        return self._attr_value_count_totals.get(attr_name, 0) \
+            + self._get_default_count(attr_name)
+
+    def _get_value_class_counts(self, attr_name, attr_value):
+        """
+        Returns the class value counts of the given attribute value in the
+        form {class_value:count}.
+        """
+        if not self._is_implicit_default(attr_name, attr_value):
+            return self._attr_class_value_counts.get(attr_name, {}) \
+                .get(attr_value, {})
+        explicit_counts = self._attr_class_count_totals.get(attr_name, {})
+        counts = {}
+        for cls_value, cls_count in iteritems(self._class_ddist.counts):
+            cls_count -= explicit_counts.get(cls_value, 0)
+            if cls_count:
+                counts[cls_value] = cls_count
+        return counts
+
+    def get_value_cdist(self, attr_name, attr_value):
+        """
+        Returns the class value distribution of the given attribute value
+        for a continuous class.
+        """
+        if self._is_implicit_default(attr_name, attr_value):
+            return _subtract_cdist(
+                self._class_cdist, self._attr_cdist_totals.get(attr_name, CDist()))
+        cdist = self._attr_value_cdist.get(attr_name, {}).get(attr_value)
+        if cdist is None:
+            return CDist()
+        return cdist.copy()
     
     @property
     def is_continuous_class(self):
@@ -953,82 +2479,129 @@ class Node(object):
         Returns the name of the attribute with the highest gain.
         """
         best = (-1e999999, None)
-        for attr in self.attributes:
+        for attr in self.tree.sample_attributes(self.attributes):
             best = max(best, (self.get_gain(attr), attr))
         best_gain, best_attr = best
         return best_attr
 
-    def get_entropy(self, attr_name=None, attr_value=None):
+    def _get_raw_entropy(self, attr_name=None, attr_value=None):
         """
-        Calculates the entropy of a specific attribute/value combination.
+        Calculates the entropy of a specific attribute/value combination,
+        without any penalty for the attribute's number of unique values.
         """
-        is_con = self.tree.data.is_continuous_class
-        if is_con:
+        if self.tree.data.is_continuous_class:
             if attr_name is None:
                 # Calculate variance of class attribute.
-                var = self._class_cdist.variance
-            else:
-                # Calculate variance of the given attribute.
-                var = self._attr_value_cdist[attr_name][attr_value].variance
-            if self.tree.metric == VARIANCE1 or attr_name is None:
-                return var
-            elif self.tree.metric == VARIANCE2:
-                unique_value_count = len(self._attr_value_counts[attr_name])
-                attr_total = float(self._attr_value_count_totals[attr_name])
-                return var*(unique_value_count/attr_total)
+                return self._class_cdist.variance
+            # Calculate variance of the given attribute.
+            if self._is_implicit_default(attr_name, attr_value):
+                return self.get_value_cdist(attr_name, attr_value).variance
+            return self._attr_value_cdist[attr_name][attr_value].variance
+        if attr_name is None:
+            # The total number of times this attr/value pair has been seen.
+            total = float(self._class_ddist.total)
+            # The total number of times each class value has been seen for
+            # this attr/value pair.
+            counts = self._class_ddist.counts
         else:
-            if attr_name is None:
-                # The total number of times this attr/value pair has been seen.
-                total = float(self._class_ddist.total)
-                # The total number of times each class value has been seen for
-                # this attr/value pair.
-                counts = self._class_ddist.counts
-                # The total number of unique values seen for this attribute.
-                unique_value_count = len(self._class_ddist.counts)
-                # The total number of times this attribute has been seen.
-                attr_total = total
-            else:
-                total = float(self._attr_value_counts[attr_name][attr_value])
-                counts = self._attr_class_value_counts[attr_name][attr_value]
-                unique_value_count = len(self._attr_value_counts[attr_name])
-                attr_total = float(self._attr_value_count_totals[attr_name])
-            assert total, "There must be at least one non-zero count."
-            
-            n = max(2, len(counts))
-            if self._tree.metric == ENTROPY1:
-                # Traditional entropy.
-                return -sum(
-                    (count/total)*math.log(count/total, n)
-                    for count in itervalues(counts)
-                )
-            elif self._tree.metric == ENTROPY2:
-                # Modified entropy that down-weights universally unique values.
-                # e.g. If the number of unique attribute values equals the total
-                # count of the attribute, then it has the maximum amount of unique
-                # values.
-                return -sum(
-                    (count/total)*math.log(count/total, n)
-                    for count in itervalues(counts)
-                #) - ((len(counts)-1)/float(total))
-                ) + (unique_value_count/attr_total)
-            elif self._tree.metric == ENTROPY3:
-                # Modified entropy that down-weights universally unique values
-                # as well as features with large numbers of values.
-                return -sum(
-                    (count/total)*math.log(count/total, n)
-                    for count in itervalues(counts)
-                #) - 100*((len(counts)-1)/float(total))
-                ) + 100*(unique_value_count/attr_total)
-        
+            total = float(self._get_value_count(attr_name, attr_value))
+            counts = self._get_value_class_counts(attr_name, attr_value)
+        assert total, "There must be at least one non-zero count."
+        n = max(2, len(counts))
+        return -sum(
+            (count/total)*math.log(count/total, n)
+            for count in itervalues(counts)
+        )
+
+    def _get_entropy_penalty(self, attr_name=None):
+        """
+        Returns the ratio of unique values to total values used by the
+        modified metrics to down-weight universally unique values.
+        """
+        if attr_name is None:
+            # The total number of unique values seen for this attribute.
+            unique_value_count = len(self._class_ddist.counts)
+            # The total number of times this attribute has been seen.
+            attr_total = float(self._class_ddist.total)
+        else:
+            unique_value_count = len(self._attr_value_counts[attr_name])
+            if self._get_default_count(attr_name):
+                unique_value_count += 1
+            attr_total = float(self._get_attr_total(attr_name))
+        return unique_value_count/attr_total
+
+    def get_entropy(self, attr_name=None, attr_value=None):
+        """
+        Calculates the entropy of a specific attribute/value combination.
+        """
+        e = self._get_raw_entropy(attr_name, attr_value)
+        metric = self.tree.metric
+        if self.tree.data.is_continuous_class:
+            if metric == VARIANCE1 or attr_name is None:
+                return e
+            elif metric == VARIANCE2:
+                return e*self._get_entropy_penalty(attr_name)
+        elif metric == ENTROPY1:
+            # Traditional entropy.
+            return e
+        elif metric == ENTROPY2:
+            # Modified entropy that down-weights universally unique values.
+            # e.g. If the number of unique attribute values equals the total
+            # count of the attribute, then it has the maximum amount of unique
+            # values.
+            return e + self._get_entropy_penalty(attr_name)
+        elif metric == ENTROPY3:
+            # Modified entropy that down-weights universally unique values
+            # as well as features with large numbers of values.
+            return e + 100*self._get_entropy_penalty(attr_name)
+
+    def _mark_dirty(self, attr_name, attr_value):
+        """
+        Flags the cached entropy terms affected by a change in the counts of
+        the given attribute value.
+        """
+        self._dirty_entropy_terms.add((attr_name, attr_value))
+        self._main_entropy = None
+
+    def _refresh_entropy_terms(self):
+        """
+        Recalculates only the cached entropy terms whose counts have changed
+        since the last refresh.
+        """
+        if not self._dirty_entropy_terms:
+            return
+        for attr_name, attr_value in self._dirty_entropy_terms:
+            terms = self._attr_value_entropy_terms[attr_name]
+            count = self._attr_value_counts[attr_name].get(attr_value, 0)
+            term = 0.0
+            if count:
+                term = count*self._get_raw_entropy(attr_name, attr_value)
+            self._attr_entropy_term_sums[attr_name] += \
+                term - terms.get(attr_value, 0.0)
+            terms[attr_value] = term
+        self._dirty_entropy_terms.clear()
+
     def get_gain(self, attr_name):
         """
         Calculates the information gain from splitting on the given attribute.
         """
-        subset_entropy = 0.0
-        for value in iterkeys(self._attr_value_counts[attr_name]):
-            value_prob = self.get_value_prob(attr_name, value)
-            e = self.get_entropy(attr_name, value)
-            subset_entropy += value_prob * e
+        self._refresh_entropy_terms()
+        attr_total = self._get_attr_total(attr_name)
+        subset_entropy = self._attr_entropy_term_sums[attr_name]
+        default_count = self._get_default_count(attr_name)
+        if default_count:
+            # The implicit default's term changes with every sample, so it's
+            # derived on demand instead of cached.
+            subset_entropy += default_count*self._get_raw_entropy(
+                attr_name, self.tree.data.get_default_value(attr_name))
+        subset_entropy /= float(attr_total)
+        metric = self.tree.metric
+        if metric == VARIANCE2:
+            subset_entropy *= self._get_entropy_penalty(attr_name)
+        elif metric == ENTROPY2:
+            subset_entropy += self._get_entropy_penalty(attr_name)
+        elif metric == ENTROPY3:
+            subset_entropy += 100*self._get_entropy_penalty(attr_name)
         return (self.main_entropy - subset_entropy)
 
     def get_value_ddist(self, attr_name, attr_value):
@@ -1040,7 +2613,7 @@ class Node(object):
             "Discrete distributions are only maintained for " + \
             "discrete class types."
         ddist = DDist()
-        cls_counts = self._attr_class_value_counts[attr_name][attr_value]
+        cls_counts = self._get_value_class_counts(attr_name, attr_value)
         for cls_value, cls_count in iteritems(cls_counts):
             ddist.add(cls_value, count=cls_count)
         return ddist
@@ -1051,8 +2624,8 @@ class Node(object):
         """
         if attr_name not in self._attr_value_count_totals:
             return
-        n = self._attr_value_counts[attr_name][value]
-        d = self._attr_value_count_totals[attr_name]
+        n = self._get_value_count(attr_name, value)
+        d = self._get_attr_total(attr_name)
         return n/float(d)
 
     @property
@@ -1060,7 +2633,9 @@ class Node(object):
         """
         Calculates the overall entropy of the class attribute.
         """
-        return self.get_entropy()
+        if self._main_entropy is None:
+            self._main_entropy = self.get_entropy()
+        return self._main_entropy
     
     def predict(self, record, depth=0):
         """
@@ -1075,22 +2650,128 @@ class Node(object):
         # Lookup attribute value.
         attr_value = self._get_attribute_value_for_node(record)
         
-        # Propagate decision to leaf node.
+        if self.attr_name and attr_value is None \
+        and not self.has_value(self.attr_name, None):
+            # The value is unknown and the missing value policy doesn't
+            # map it to a known value.
+            policy = self.tree.missing_value_policy.get(self.attr_name)
+            if policy == USE_WEIGHTED:
+                return self._predict_weighted(record, depth=depth)
+            return self.get_node_dist()
+        
         if self.attr_name:
-            if attr_value in self._branches:
-                try:
-                    return self._branches[attr_value].predict(record, depth=depth+1)
-                except NodeNotReadyToPredict:
-                    #TODO:allow re-raise if user doesn't want an intermediate prediction?
-                    pass
+            return self._predict_value(attr_value, record, depth=depth)
+        return self.get_node_dist()
+
+    def can_predict(self, record):
+        """
+        Returns true if the record can be predicted, without this node
+        being untrained or the record having an unseen value for which no
+        missing value policy is set.
+        Returns false otherwise.
+        """
+        node = self
+        while node.ready_to_predict and node.attr_name:
+            attr = node.attr_name
+            attr_value = node.tree.data.get_value(record, attr)
+            if not node.has_value(attr, attr_value) \
+            and attr not in node.tree.missing_value_policy \
+            and (attr_value is None or not node._is_summarized(attr)):
+                return False
+            attr_value = node._get_attribute_value_for_node(record)
+            branch = node._branches.get(attr_value)
+            if attr_value is None or branch is None \
+            or not branch.ready_to_predict:
+                return True
+            node = branch
+        return node.ready_to_predict
+
+    def predict_many(self, records, indexes, results):
+        """
+        Stores the prediction of each record at the given indexes in
+        results, routing the records down each branch together, so each
+        leaf's distribution is calculated once and shared by all its records.
+        
+        Records with a value unknown at a node are predicted individually.
+        """
+        if not self.ready_to_predict:
+            raise NodeNotReadyToPredict
+        attr = self.attr_name
+        if not attr:
+            dist = self.get_node_dist()
+            for i in indexes:
+                results[i] = dist
+            return
+        data = self.tree.data
+        groups = defaultdict(list) # {attr_value:[index]}
+        for i in indexes:
+            attr_value = self._get_summary_value(
+                attr, data.get_value(records[i], attr))
+            if self.has_value(attr, attr_value):
+                groups[attr_value].append(i)
+            else:
+                results[i] = self.predict(records[i])
+        for attr_value, group in iteritems(groups):
+            branch = self._branches.get(attr_value)
+            if branch is not None and branch.ready_to_predict:
+                branch.predict_many(records, group, results)
+                continue
+            dist = self._get_value_dist(attr_value)
+            for i in group:
+                results[i] = dist
+
+    def _predict_value(self, attr_value, record, depth=0):
+        """
+        Returns the prediction for the given value of the splitting attribute.
+        """
+        # Propagate decision to leaf node.
+        if attr_value in self._branches:
+            try:
+                return self._branches[attr_value].predict(record, depth=depth+1)
+            except NodeNotReadyToPredict:
+                #TODO:allow re-raise if user doesn't want an intermediate prediction?
+                pass
                 
         # Otherwise make decision at current node.
-        if self.attr_name:
-            if self._tree.data.is_continuous_class:
-                return self._attr_value_cdist[self.attr_name][attr_value].copy()
-            else:
-#                return self._class_ddist.copy()
-                return self.get_value_ddist(self.attr_name, attr_value)
+        if self._tree.data.is_continuous_class:
+            return self.get_value_cdist(self.attr_name, attr_value)
+        else:
+            return self.get_value_ddist(self.attr_name, attr_value)
+
+    def _predict_weighted(self, record, depth=0):
+        """
+        Returns the predictions of all branches, weighted by the frequency of
+        each branch's value.
+        """
+        total = float(sum(itervalues(self._branch_counts)))
+        if self._tree.data.is_continuous_class:
+            # Combine the branch distributions into a single mixture.
+            mean = 0.0
+            moment = 0.0
+            for attr_value, count in iteritems(self._branch_counts):
+                dist = self._predict_value(attr_value, record, depth=depth)
+                if dist.mean is None:
+                    continue
+                weight = count/total
+                mean += weight*dist.mean
+                moment += weight*(dist.variance + dist.mean**2)
+            return CDist(mean=mean, var=max(0.0, moment - mean**2))
+        ddist = DDist()
+        for attr_value, count in iteritems(self._branch_counts):
+            dist = self._predict_value(attr_value, record, depth=depth)
+            if not dist.count:
+                continue
+            weight = count/total
+            for cls_value, cls_prob in dist.probs:
+                ddist.add(cls_value, cls_prob*weight)
+        return ddist
+
+    def get_node_dist(self):
+        """
+        Returns the class distribution of all samples seen at this node.
+        """
+        if self._dist is not None:
+            return self._dist.copy()
         elif self._tree.data.is_continuous_class:
             # Make decision at current node, which may be a true leaf node
             # or an incomplete branch in a tree currently being built.
@@ -1122,50 +2803,283 @@ class Node(object):
             and best_prob >= threshold:
                 return False
             
+        max_depth = self._tree.max_depth
         return self._tree.auto_grow \
             and not self.attr_name \
-            and self.n >= self._tree.splitting_n
+            and self.n >= self._tree.splitting_n \
+            and (self._pruned_n is None
+                or self.n - self._pruned_n >= self._tree.splitting_n) \
+            and self.n >= self._tree.min_samples_split \
+            and (max_depth is None or self.depth < max_depth)
 
-    def set_leaf_dist(self, attr_value, dist):
+    def _can_grow_branch(self):
         """
-        Sets the probability distribution at a leaf node.
+        Returns true if a branch can be added to this node for a value first
+        seen after the split, keeping the tree within its depth and leaf
+        count limits.
         """
-        assert self.attr_name
-        assert self.tree.data.is_valid(self.attr_name, attr_value), \
-            "Value %s is invalid for attribute %s." \
-                % (attr_value, self.attr_name)
-        if self.is_continuous_class:
-            assert isinstance(dist, CDist)
-            assert self.attr_name
-            self._attr_value_cdist[self.attr_name][attr_value] = dist.copy()
-#            self.n += dist.count
-        else:
-            assert isinstance(dist, DDist)
-            # {attr_name:{attr_value:count}}
-            self._attr_value_counts[self.attr_name][attr_value] += 1
-            # {attr_name:total}
-            self._attr_value_count_totals[self.attr_name] += 1
-            # {attr_name:{attr_value:{class_value:count}}}
-            for cls_value, cls_count in iteritems(dist.counts):
-                self._attr_class_value_counts[self.attr_name][attr_value] \
-                    [cls_value] += cls_count
-    
-    def to_dict(self):
-        if self.attr_name:
-            # Show a value's branch, whether it's a leaf or another node.
-            ret = {self.attr_name:{}} # {attr_name:{attr_value:dist or node}}
-            values = self.get_values(self.attr_name)
-            for attr_value in values:
-                if attr_value in self._branches:
-                    ret[self.attr_name][attr_value] = self._branches[attr_value].to_dict()
-                elif self._tree.data.is_continuous_class:
-                    ret[self.attr_name][attr_value] = \
-                        self._attr_value_cdist[self.attr_name][attr_value].copy()
-                else:
-                    ret[self.attr_name][attr_value] = \
-                        self.get_value_ddist(self.attr_name, attr_value)
-            return ret
-        elif self.tree.data.is_continuous_class:
+        max_leaf_count = self._tree.max_leaf_count
+        max_depth = self._tree.max_depth
+        return (max_leaf_count is None
+            or self._tree.leaf_count < max_leaf_count) \
+            and (max_depth is None or self.depth < max_depth)
+
+    def _get_training_route(self, attr_value):
+        """
+        Returns the value of the splitting attribute whose branch a training
+        sample with the given value follows.
+        
+        A value first seen after the split grows its own branch if the
+        tree's limits allow. Otherwise it follows the branch chosen by the
+        use-nearest missing value policy, or the most frequent branch.
+        """
+        if attr_value in self._branches \
+        or self.has_value(self.attr_name, attr_value) \
+        or self._can_grow_branch():
+            return attr_value
+        policy = self.tree.missing_value_policy.get(self.attr_name)
+        if policy == USE_NEAREST and _is_numeric(attr_value) \
+        and self._sorted_values:
+            return self._get_nearest_value(attr_value)
+        return self._most_frequent_value
+
+    def can_split_on(self, attr_name):
+        """
+        Returns true if splitting on the given attribute keeps the tree
+        within its leaf size and leaf count limits.
+        Returns false otherwise.
+        """
+        values = self.get_values(attr_name)
+        if not values:
+            return False
+        min_count = min(self._get_value_count(attr_name, v) for v in values)
+        if min_count < self._tree.min_samples_leaf:
+            return False
+        max_leaf_count = self._tree.max_leaf_count
+        # Splitting replaces this leaf with one leaf per value.
+        return max_leaf_count is None \
+            or self._tree.leaf_count - 1 + len(values) <= max_leaf_count
+
+    def get_leaf_count(self):
+        """
+        Returns the number of leaves in the subtree rooted at this node.
+        """
+        if not self.attr_name:
+            return 1
+        count = 0
+        for value in self.get_values(self.attr_name):
+            if value in self._branches:
+                count += self._branches[value].get_leaf_count()
+            else:
+                count += 1
+        return count
+
+    def _get_value_dist(self, attr_value):
+        """
+        Returns the class distribution stored at this node for the given
+        value of the splitting attribute.
+        """
+        if self.tree.data.is_continuous_class:
+            return self.get_value_cdist(self.attr_name, attr_value)
+        return self.get_value_ddist(self.attr_name, attr_value)
+
+    def _collapse(self, attr_value):
+        """
+        Replaces the branch of the given value with a leaf.
+        """
+        branch = self._branches[attr_value]
+        self.tree.leaf_count -= branch.get_leaf_count() - 1
+        branch._prune()
+
+    def _prune(self):
+        """
+        Turns this node into a leaf predicting from all its samples.
+        
+        The node is kept, so later samples train the leaf instead of growing
+        a new branch, and it only splits again after splitting_n more.
+        """
+        self.attr_name = None
+        self._branches = {}
+        self._sorted_values = []
+        self._nearest_cache = {}
+        self._branch_counts = defaultdict(int)
+        self._most_frequent_value = None
+        self._error_window = None
+        self._alternate = None
+        self._pruned_n = self.n
+
+    def _get_route(self, record):
+        """
+        Returns the value of the splitting attribute the record would follow,
+        or None if the record can't be routed to a single branch.
+        """
+        attr_value = self.tree.data.get_value(record, self.attr_name)
+        if self.has_value(self.attr_name, attr_value):
+            return attr_value
+        if self.tree.missing_value_policy.get(self.attr_name) \
+        in (USE_NEAREST, USE_MOST_FREQUENT):
+            return self._get_attribute_value_for_node(record)
+
+    def _get_error(self, dist, records):
+        """
+        Returns the misclassification count or total absolute error of
+        predicting the given records with the given distribution.
+        """
+        class_attr = self.tree.data.class_attribute_name
+        if self.tree.data.is_continuous_class:
+            if dist.mean is None:
+                return 0.0
+            return sum(abs(dist.mean - r[class_attr]) for r in records)
+        best = dist.best
+        return sum(1 for r in records if r[class_attr] != best)
+
+    def _prune_reduced_error(self, records):
+        """
+        Collapses every branch whose error on the given held-out records
+        is no lower than the error of replacing it with a leaf.
+        Returns the error of this node's subtree on the records after pruning.
+        """
+        routes = defaultdict(list) # {attr_value:[record]}
+        for record in records:
+            attr_value = self._get_route(record)
+            if attr_value is not None:
+                routes[attr_value].append(record)
+        error = 0.0
+        for attr_value in list(self._branches):
+            branch = self._branches[attr_value]
+            subset = routes.pop(attr_value, [])
+            leaf_error = self._get_error(branch.get_node_dist(), subset)
+            if not branch.attr_name:
+                error += leaf_error
+                continue
+            branch_error = branch._prune_reduced_error(subset)
+            if leaf_error <= branch_error:
+                self._collapse(attr_value)
+                branch_error = leaf_error
+            error += branch_error
+        for attr_value, subset in iteritems(routes):
+            error += self._get_error(self._get_value_dist(attr_value), subset)
+        return error
+
+    @staticmethod
+    def _get_training_error(dist):
+        """
+        Returns the misclassification count or sum of squared errors of the
+        samples forming the given distribution.
+        """
+        if isinstance(dist, CDist):
+            return dist.last_variance
+        if not dist.total:
+            return 0
+        return dist.total - max(itervalues(dist.counts))
+
+    def _prune_cost_complexity(self, alpha, total):
+        """
+        Collapses every branch whose training error reduction, relative to
+        the total sample count, is no greater than alpha per added leaf.
+        Returns the (error, leaf count) of this node's subtree after pruning.
+        """
+        error = 0.0
+        leaf_count = 0
+        for attr_value in self.get_values(self.attr_name):
+            if attr_value not in self._branches:
+                error += self._get_training_error(
+                    self._get_value_dist(attr_value))/total
+                leaf_count += 1
+                continue
+            branch = self._branches[attr_value]
+            leaf_error = self._get_training_error(branch.get_node_dist())/total
+            if branch.attr_name:
+                branch_error, branch_leaf_count = \
+                    branch._prune_cost_complexity(alpha, total)
+                if leaf_error + alpha <= branch_error + alpha*branch_leaf_count:
+                    self._collapse(attr_value)
+                    branch_error, branch_leaf_count = leaf_error, 1
+            else:
+                branch_error, branch_leaf_count = leaf_error, 1
+            error += branch_error
+            leaf_count += branch_leaf_count
+        return error, leaf_count
+
+    def get_depth(self):
+        """
+        Returns the number of splits on the longest path below this node.
+        """
+        if not self.attr_name:
+            return 0
+        return 1 + max([0] + [
+            branch.get_depth() for branch in itervalues(self._branches)
+        ])
+
+    def get_split_attributes(self):
+        """
+        Returns the set of attributes split on in the subtree rooted at this
+        node.
+        """
+        if not self.attr_name:
+            return set()
+        ret = set([self.attr_name])
+        for branch in itervalues(self._branches):
+            ret.update(branch.get_split_attributes())
+        return ret
+    
+    def get_node_count(self):
+        """
+        Returns the number of nodes and leaves in the subtree rooted at this
+        node.
+        """
+        if not self.attr_name:
+            return 1
+        count = 1
+        for value in self.get_values(self.attr_name):
+            if value in self._branches:
+                count += self._branches[value].get_node_count()
+            else:
+                count += 1
+        return count
+
+    def set_leaf_dist(self, attr_value, dist):
+        """
+        Sets the probability distribution at a leaf node.
+        """
+        assert self.attr_name
+        assert self.tree.data.is_valid(self.attr_name, attr_value), \
+            "Value %s is invalid for attribute %s." \
+                % (attr_value, self.attr_name)
+        if self.is_continuous_class:
+            assert isinstance(dist, CDist)
+            assert self.attr_name
+            self._attr_value_cdist[self.attr_name][attr_value] = dist.copy()
+#            self.n += dist.count
+        else:
+            assert isinstance(dist, DDist)
+            # {attr_name:{attr_value:count}}
+            self._attr_value_counts[self.attr_name][attr_value] += 1
+            # {attr_name:total}
+            self._attr_value_count_totals[self.attr_name] += 1
+            # {attr_name:{attr_value:{class_value:count}}}
+            for cls_value, cls_count in iteritems(dist.counts):
+                self._attr_class_value_counts[self.attr_name][attr_value] \
+                    [cls_value] += cls_count
+        self._mark_dirty(self.attr_name, attr_value)
+        self._index_value(attr_value)
+    
+    def to_dict(self):
+        if self.attr_name:
+            # Show a value's branch, whether it's a leaf or another node.
+            ret = {self.attr_name:{}} # {attr_name:{attr_value:dist or node}}
+            values = self.get_values(self.attr_name)
+            for attr_value in values:
+                if attr_value in self._branches:
+                    ret[self.attr_name][attr_value] = self._branches[attr_value].to_dict()
+                elif self._tree.data.is_continuous_class:
+                    ret[self.attr_name][attr_value] = \
+                        self.get_value_cdist(self.attr_name, attr_value)
+                else:
+                    ret[self.attr_name][attr_value] = \
+                        self.get_value_ddist(self.attr_name, attr_value)
+            return ret
+        elif self.tree.data.is_continuous_class:
             # Otherwise we're at a continuous leaf node.
             return self._class_cdist.copy()
         else:
@@ -1176,47 +3090,421 @@ class Node(object):
     def tree(self):
         return self._tree
 
-    def train(self, record):
+    def _track_drift(self, record, error, weight=1):
+        """
+        Records the tree's error on the given sample at this split node.
+        When the error rises, starts growing an alternate subtree on new
+        samples, and replaces this subtree with it once it's more accurate.
+        
+        Returns the alternate if it should replace this subtree, having
+        already been trained on the sample, or None otherwise.
+        """
+        tree = self.tree
+        if self._error_window is None:
+            self._error_window = ErrorWindow(tree.drift_window)
+        alternate = self._alternate
+        if alternate is None:
+            # The window detects change in the sample stream, so weights
+            # don't apply here.
+            self._error_window.add(error)
+            if self._error_window.has_drifted(tree.drift_delta):
+                self._alternate = Node(tree=tree, depth=self.depth)
+                self._alternate_error = CDist()
+                self._own_error = CDist()
+            return
+        
+        # Compare the alternate's error against this subtree's.
+        try:
+            alternate_error = get_prediction_error(
+                alternate.predict(record),
+                record[tree.data.class_attribute_name])
+        except NodeNotReadyToPredict:
+            alternate_error = None
+        if alternate_error is not None:
+            self._alternate_error.add(alternate_error, weight)
+            self._own_error.add(error, weight)
+        
+        # The alternate's leaves don't count towards the tree's limits until
+        # it's swapped in.
+        leaf_count = tree.leaf_count
+        replacement = alternate.train(record.copy(), weight=weight)
+        if replacement is not None:
+            self._alternate = alternate = replacement
+        tree.leaf_count = leaf_count
+        
+        if self._own_error.count >= tree.drift_window:
+            self._alternate = None
+            self._error_window.clear()
+            if self._alternate_error.mean < self._own_error.mean:
+                # Drop this subtree and its statistics for the alternate.
+                tree.leaf_count += \
+                    alternate.get_leaf_count() - self.get_leaf_count()
+                tree._split_attributes = None
+                return alternate
+
+    def _split(self):
+        """
+        Splits this node on the best attribute, if it's ready to.
+        Returns true if it split.
+        """
+        best_attr = None
+        if self.ready_to_split:
+            best_attr = self.get_best_splitting_attr()
+        if best_attr is None or not self.can_split_on(best_attr):
+            return False
+        self.attr_name = best_attr
+        self._pruned_n = None
+        self.tree._split_attributes = None
+        self.tree.leaf_count -= 1
+        for av in self.get_values(self.attr_name):
+            self._branches[av] = Node(tree=self.tree, depth=self.depth+1)
+            self._index_value(av)
+            self._count_branch(av, self._get_value_count(self.attr_name, av))
+            self.tree.leaf_count += 1
+        return True
+    
+    def get_stats(self):
+        """
+        Returns a copy of the additive training statistics of this node and
+        its branches, which can be pickled and merged into another tree.
+        """
+        return dict(
+            n=self.n,
+            attr_name=self.attr_name,
+            class_counts=dict(self._class_ddist.counts),
+            class_cdist=self._class_cdist.copy(),
+            attr_value_counts=copy.deepcopy(self._attr_value_counts),
+            attr_value_count_totals=copy.deepcopy(
+                self._attr_value_count_totals),
+            attr_class_value_counts=copy.deepcopy(
+                self._attr_class_value_counts),
+            attr_value_cdist=copy.deepcopy(self._attr_value_cdist),
+            attr_class_count_totals=copy.deepcopy(
+                self._attr_class_count_totals),
+            attr_cdist_totals=copy.deepcopy(self._attr_cdist_totals),
+            branch_counts=dict(self._branch_counts),
+            branches=dict(
+                (av, branch.get_stats())
+                for av, branch in iteritems(self._branches)),
+        )
+    
+    def _get_routed_stats(self, stats):
+        """
+        Returns the given statistics of another node with the values of this
+        node's summarized splitting attribute moved to their nearest bins.
+        """
+        attr = self.attr_name
+        if not attr or not self._sorted_values or not self._is_summarized(attr):
+            return stats
+        stats = dict(stats)
+        for key, factory in (
+            ('attr_value_counts', int),
+            ('attr_class_value_counts', _get_dd_int),
+            ('attr_value_cdist', CDist)):
+            values = stats[key].get(attr)
+            if not values:
+                continue
+            routed = defaultdict(factory)
+            for av, value in iteritems(values):
+                _merge_nested(
+                    routed, {self._get_summary_value(attr, av): value})
+            stats[key] = dict(stats[key])
+            stats[key][attr] = routed
+        return stats
+
+    def merge_stats(self, stats):
+        """
+        Adds the training statistics returned by get_stats() on a node of
+        another tree to this node, as if this node had been trained on the
+        same samples, and re-evaluates the split.
+        
+        The statistics of the other node's branches are only merged if
+        both nodes split on the same attribute. If that attribute is
+        summarized, the other node's bins are merged into the nearest of
+        this node's fixed bins.
+        """
+        stats = self._get_routed_stats(stats)
+        self.n += stats['n']
+        for cls_value, count in iteritems(stats['class_counts']):
+            self._class_ddist.add(cls_value, count)
+        self._class_cdist.merge(stats['class_cdist'])
+        _merge_nested(self._attr_value_counts, stats['attr_value_counts'])
+        _merge_nested(
+            self._attr_value_count_totals, stats['attr_value_count_totals'])
+        _merge_nested(
+            self._attr_class_value_counts, stats['attr_class_value_counts'])
+        _merge_nested(self._attr_value_cdist, stats['attr_value_cdist'])
+        _merge_nested(
+            self._attr_class_count_totals, stats['attr_class_count_totals'])
+        _merge_nested(self._attr_cdist_totals, stats['attr_cdist_totals'])
+        for attr_values in (
+            stats['attr_value_counts'], stats['attr_value_cdist']):
+            for an, values in iteritems(attr_values):
+                for av in values:
+                    self._mark_dirty(an, av)
+        if self.tree.numeric_summary_size is not None:
+            for an in list(self._attr_value_counts):
+                if an != self.attr_name and self._is_summarized(an):
+                    self._compress_values(an)
+        self._main_entropy = None
+        
+        just_split = self._split()
+        if not self.attr_name or self.attr_name != stats['attr_name']:
+            return
+        if not just_split:
+            # A new split already counted the samples down each branch.
+            for av, count in iteritems(stats['branch_counts']):
+                av = self._get_summary_value(self.attr_name, av)
+                self._index_value(av)
+                self._count_branch(av, count)
+        for av, branch_stats in iteritems(stats['branches']):
+            av = self._get_summary_value(self.attr_name, av)
+            if av not in self._branches:
+                self._branches[av] = Node(tree=self.tree, depth=self.depth+1)
+                self._index_value(av)
+                self.tree.leaf_count += 1
+            self._branches[av].merge_stats(branch_stats)
+    
+    def train(self, record, error=None, weight=1):
         """
         Incrementally update the statistics at this node.
+        
+        If given, error is the tree's prediction error on the record before
+        training, used to detect concept drift.
+        
+        The record counts as weight samples in all statistics.
+        
+        Returns the alternate subtree that should replace this node after
+        concept drift, or None.
         """
-        self.n += 1
-        class_attr = self.tree.data.class_attribute_name
+        if error is not None and self.attr_name:
+            alternate = self._track_drift(record, error, weight=weight)
+            if alternate is not None:
+                # The alternate was already trained on the record.
+                return alternate
+        self.n += weight
+        data = self.tree.data
+        class_attr = data.class_attribute_name
+        weight_attr = data.weight_attribute_name
         class_value = record[class_attr]
         
         # Update class statistics.
         is_con = self.tree.data.is_continuous_class
         if is_con:
             # For a continuous class.
-            self._class_cdist += class_value
+            self._class_cdist.add(class_value, weight)
         else:
             # For a discrete class.
-            self._class_ddist.add(class_value)
+            self._class_ddist.add(class_value, weight)
         
         # Update attribute statistics.
+        # In sparse mode, only explicitly set attributes are visited, and
+        # the statistics of their default values are derived on demand.
+        sparse = data.sparse
+        summarize = self.tree.numeric_summary_size is not None
         for an, av in iteritems(record):
-            if an == class_attr:
+            if an == class_attr or an == weight_attr:
                 continue
-            self._attr_value_counts[an][av] += 1
-            self._attr_value_count_totals[an] += 1
+            if summarize:
+                av = self._get_summary_value(an, av)
+            if an == self.attr_name:
+                av = self._get_training_route(av)
+            if sparse:
+                if av == data.get_default_value(an):
+                    continue
+                if is_con:
+                    self._attr_cdist_totals[an].add(class_value, weight)
+                else:
+                    self._attr_class_count_totals[an][class_value] += weight
+            self._attr_value_counts[an][av] += weight
+            self._attr_value_count_totals[an] += weight
             if is_con:
-                self._attr_value_cdist[an][av] += class_value
+                self._attr_value_cdist[an][av].add(class_value, weight)
             else:
-                self._attr_class_value_counts[an][av][class_value] += 1
+                self._attr_class_value_counts[an][av][class_value] += weight
+            self._mark_dirty(an, av)
+            if summarize and an != self.attr_name and self._is_summarized(an):
+                self._compress_values(an)
+        self._main_entropy = None
         
         # Decide if branch should split on an attribute.
-        if self.ready_to_split:
-            self.attr_name = self.get_best_splitting_attr()
-            self.tree.leaf_count -= 1
-            for av in self._attr_value_counts[self.attr_name]:
-                self._branches[av] = Node(tree=self.tree)
-                self.tree.leaf_count += 1
+        just_split = self._split()
             
         # If we've split, then propagate the update to appropriate sub-branch.
         if self.attr_name:
-            key = record[self.attr_name]
-            del record[self.attr_name]
-            self._branches[key].train(record)
+            key = self._get_training_route(self._get_summary_value(
+                self.attr_name, data.get_value(record, self.attr_name)))
+            self._index_value(key)
+            if not just_split:
+                self._count_branch(key, weight)
+            if key not in self._branches:
+                # Grow a branch for a value first seen after the split.
+                self._branches[key] = Node(tree=self.tree, depth=self.depth+1)
+                self.tree.leaf_count += 1
+            record.pop(self.attr_name, None)
+            replacement = self._branches[key].train(
+                record, error=error, weight=weight)
+            if replacement is not None:
+                self._branches[key] = replacement
+
+# The helpers shared by all generated prediction modules.
+_GENERATED_MODULE_HEADER = '''"""
+Predicts %(class_attr)s using a %(model)s generated by dtree.
+
+predict(record) returns %(returns)s.
+"""
+import bisect
+from decimal import Decimal
+
+def _nearest(value, values):
+    # The known value with the smallest distance to the given value,
+    # preferring the smaller value on a tie.
+    i = bisect.bisect_left(values, value)
+    nearest = (1e999999, None)
+    for _value in values[max(0, i-1):i+1]:
+        nearest = min(nearest, (abs(_value - value), _value))
+    return nearest[1]
+'''
+
+class _SourceWriter(object):
+    """
+    Accumulates the functions and constants of a generated Python module.
+    """
+    
+    def __init__(self):
+        self.lines = []
+        self.constants = []
+    
+    def constant(self, source):
+        """
+        Defines a module-level constant with the given source, returning
+        its name.
+        """
+        name = '_C%i' % len(self.constants)
+        self.constants.append('%s = %s' % (name, source))
+        return name
+    
+    def line(self, indent, text):
+        self.lines.append('    '*indent + text)
+    
+    def get_source(self, header):
+        return '\n'.join([header] + self.constants + [''] + self.lines) + '\n'
+
+def _get_dist_source(dist):
+    """
+    Returns the source of a distribution as plain data, either a dict of
+    {class_value:probability} or a tuple of (mean, variance).
+    """
+    if isinstance(dist, CDist):
+        return repr((dist.mean, dist.variance))
+    if not dist.count:
+        return '{}'
+    return repr(dict(dist.probs))
+
+def _write_node_source(node, writer, indent):
+    """
+    Writes the body of a generated function returning the prediction of
+    the subtree rooted at the given node, as nested comparisons and dict
+    lookups of constant distributions.
+    """
+    attr = node.attr_name
+    if not attr:
+        writer.line(indent,
+            'return %s' % writer.constant(_get_dist_source(node.get_node_dist())))
+        return
+    
+    tree = node.tree
+    data = tree.data
+    if data.sparse:
+        writer.line(indent, 'value = record.get(%r, %r)'
+            % (attr, data.get_default_value(attr)))
+    else:
+        writer.line(indent, 'value = record[%r]' % (attr,))
+    values = sorted(
+        (v for v in node.get_values(attr) if node.has_value(attr, v)),
+        key=repr)
+    
+    # Map unknown values as the missing value policy would.
+    writer.line(indent, 'if value not in %s:'
+        % writer.constant(repr(frozenset(values))))
+    policy = tree.missing_value_policy.get(attr)
+    assert policy != USE_WEIGHTED, \
+        "The weighted missing value policy is not supported in generated code."
+    sorted_values = writer.constant(repr(list(node._sorted_values)))
+    policy_indent = indent+1
+    if node._is_summarized(attr) and node._sorted_values:
+        # Numeric values are routed to the nearest bin of the summary.
+        writer.line(indent+1, 'if value is not None:')
+        writer.line(indent+2, 'value = _nearest(value, %s)' % sorted_values)
+        writer.line(indent+1, 'else:')
+        policy_indent = indent+2
+    if policy == USE_NEAREST:
+        writer.line(policy_indent, 'value = _nearest(value, %s)'
+            % sorted_values)
+    elif policy == USE_MOST_FREQUENT:
+        writer.line(policy_indent, 'value = %r' % (node._most_frequent_value,))
+    elif policy == USE_NODE_DIST:
+        writer.line(policy_indent, 'value = None')
+    else:
+        writer.line(policy_indent, 'raise ValueError(%r)'
+            % ("No missing value policy specified for attribute %s." % attr))
+    if policy is not None and None not in values:
+        node_dist = writer.constant(_get_dist_source(node.get_node_dist()))
+        writer.line(indent, 'if value is None:')
+        writer.line(indent+1, 'return %s' % node_dist)
+    
+    # Look up values whose branches are leaves, and descend into the others.
+    leaves = []
+    subtrees = []
+    for value in values:
+        branch = node._branches.get(value)
+        if branch is not None and branch.ready_to_predict:
+            subtrees.append((value, branch))
+        elif tree.data.is_continuous_class:
+            leaves.append((value, node.get_value_cdist(attr, value)))
+        else:
+            leaves.append((value, node.get_value_ddist(attr, value)))
+    if leaves:
+        lookup = writer.constant('{%s}' % ', '.join(
+            '%r: %s' % (value, _get_dist_source(dist))
+            for value, dist in leaves))
+        writer.line(indent, 'result = %s.get(value)' % lookup)
+        writer.line(indent, 'if result is not None:')
+        writer.line(indent+1, 'return result')
+    for i, (value, branch) in enumerate(subtrees):
+        writer.line(indent, '%s value == %r:' % ('elif' if i else 'if', value))
+        _write_node_source(branch, writer, indent+1)
+    if data.is_continuous_class:
+        writer.line(indent, 'return (None, None)')
+    else:
+        writer.line(indent, 'return {}')
+
+def _write_tree_source(tree, writer, name):
+    """
+    Writes a generated function with the given name returning the tree's
+    prediction.
+    """
+    root = tree.tree
+    assert isinstance(root, Node), "The tree has no nodes."
+    if not root.ready_to_predict:
+        raise NodeNotReadyToPredict
+    writer.line(0, 'def %s(record):' % name)
+    _write_node_source(root, writer, 1)
+    writer.line(0, '')
+
+def _get_returns_doc(data):
+    if data.is_continuous_class:
+        return 'a tuple of (mean, variance)'
+    return 'a dict of {class_value:probability}'
+
+def compile_predict(source):
+    """
+    Compiles the source of a generated prediction module in-process and
+    returns its predict function.
+    """
+    namespace = {}
+    six.exec_(compile(source, '<dtree>', 'exec'), namespace)
+    return namespace['predict']
 
 class Tree(object):
     """
@@ -1262,12 +3550,60 @@ class Tree(object):
             # A 100% probability is the default discrete stopping criteria.
             self.leaf_threshold = kwargs.get('leaf_threshold', 1.0)
             
-        # The total number of leaf nodes.
-        self.leaf_count = 0
+        # Limits on the size of the tree, applied both when building in
+        # batch and when growing incrementally. None means unlimited.
+        # The maximum number of splits between the root and any leaf.
+        self.max_depth = kwargs.get('max_depth', None)
+        # The maximum number of leaves.
+        self.max_leaf_count = kwargs.get('max_leaf_count', None)
+        # The minimum number of samples a node must have to be split.
+        self.min_samples_split = kwargs.get('min_samples_split', 2)
+        # The minimum number of samples each branch of a split must have.
+        self.min_samples_leaf = kwargs.get('min_samples_leaf', 1)
+            
+        # The total number of leaf nodes, starting with the unsplit root.
+        self.leaf_count = 1
+        
+        # The number of branches of a batch-built tree still waiting to be
+        # built, each counting as at least one leaf against max_leaf_count.
+        self._unbuilt_branch_count = 0
+        
+        # If set, each incrementally grown node summarizes the values of each
+        # continuous attribute with at most this many bins, instead of
+        # keeping statistics for every distinct value. Once a node splits on
+        # such an attribute, its bins are fixed and values are routed to the
+        # nearest one.
+        self.numeric_summary_size = kwargs.get('numeric_summary_size', None)
+        
+        # The number of randomly chosen attributes considered at each split.
+        # See get_max_feature_count() for the supported values.
+        self.max_features = kwargs.get('max_features', None)
+        
+        # The seed for choosing attributes at each split.
+        self._random = random.Random(kwargs.get('seed', None))
+        
+        # If true, split nodes in an incrementally grown tree track their
+        # error over a sliding window of drift_window samples. When the error
+        # rises, with confidence 1-drift_delta, they grow an alternate
+        # subtree on new samples and replace themselves with it if it's more
+        # accurate over the next drift_window samples.
+        self.drift_detection = kwargs.get('drift_detection', False)
+        self.drift_window = kwargs.get('drift_window', 200)
+        self.drift_delta = kwargs.get('drift_delta', 0.002)
         
         # The total number of samples trained on.
         self.sample_count = 0
         
+        # The statistics last returned by export_delta().
+        self._exported_stats = None
+        
+        # The maximum number of predictions cached, keyed on the values of
+        # the attributes the tree splits on. None disables the cache.
+        self.prediction_cache_size = kwargs.get('prediction_cache_size', None)
+        self._prediction_cache = None
+        # The sorted attributes split on, or None if out of date.
+        self._split_attributes = None
+        
         ### Used for forests.
         
         # The prediction accuracy on held-out samples.
@@ -1281,6 +3617,19 @@ class Tree(object):
         self._out_of_bag_mae = CDist()
         self._out_of_bag_mae_clean = True
     
+    def __setstate__(self, state):
+        # Trees pickled by earlier versions lack the settings added since,
+        # which take their defaults, and their nodes lack derived state.
+        # Trees sent back by build workers have no data, but are current.
+        upgrade = False
+        if state.get('_data') is not None:
+            defaults = Tree(state['_data']).__dict__
+            upgrade = any(name not in state for name in defaults)
+            self.__dict__.update(defaults)
+        self.__dict__.update(state)
+        if upgrade and isinstance(self._tree, Node):
+            self._tree._upgrade()
+    
     def __getitem__(self, attr_name):
         return self.tree[attr_name]
 
@@ -1299,29 +3648,139 @@ class Tree(object):
         t = cls(data=data, *args, **kwargs)
         t._data = data
         t.sample_count = len(data)
-        t._tree = create_decision_tree(
+        t.leaf_count = 0
+        root = create_decision_tree(
             data=data,
             attributes=data.attribute_names,
             class_attr=data.class_attribute_name,
             fitness_func=fitness_func,
             wrapper=t,
         )
+        if not isinstance(root, Node):
+            # Growth stopped at the root, so it's a single leaf.
+            dist = root
+            root = Node(tree=t)
+            root.n = len(data)
+            root._dist = dist
+        t._tree = root
         return t
     
     @property
     def data(self):
         return self._data
     
+    def sample_attributes(self, attributes):
+        """
+        Returns the attributes to consider at a split, limited to a random
+        subset if max_features is set.
+        """
+        if self.max_features is None:
+            return attributes
+        attributes = sorted(attributes)
+        k = get_max_feature_count(self.max_features, len(attributes))
+        if k >= len(attributes):
+            return attributes
+        return self._random.sample(attributes, k)
+    
+    @property
+    def depth(self):
+        """
+        The number of splits on the longest path from the root to a leaf.
+        """
+        if not isinstance(self._tree, Node):
+            return 0
+        return self._tree.get_depth()
+    
+    @property
+    def node_count(self):
+        """
+        The total number of split nodes and leaves in the tree.
+        """
+        if not isinstance(self._tree, Node):
+            return 1
+        return self._tree.get_node_count()
+    
     @property
     def is_continuous_class(self):
         return self.data.is_continuous_class
     
+    def to_python(self):
+        """
+        Returns the source of a standalone Python module whose
+        predict(record) function returns the tree's prediction as plain
+        data, without depending on this module or the training statistics.
+        """
+        writer = _SourceWriter()
+        _write_tree_source(self, writer, 'predict')
+        return writer.get_source(_GENERATED_MODULE_HEADER % dict(
+            class_attr=self.data.class_attribute_name,
+            model='decision tree',
+            returns=_get_returns_doc(self.data)))
+    
+    def compile(self):
+        """
+        Returns a predict(record) function generated from the tree's current
+        structure, which is much faster than predict().
+        
+        It returns a dict of {class_value:probability} for a discrete class,
+        or a tuple of (mean, variance) for a continuous class.
+        Later training does not affect it.
+        """
+        return compile_predict(self.to_python())
+    
     @classmethod
     def load(cls, fn):
         tree = pickle.load(open(fn))
         assert isinstance(tree, cls), "Invalid pickle."
         return tree
     
+    def get_stats(self):
+        """
+        Returns a copy of the additive training statistics of an
+        incrementally grown tree, which can be pickled and merged into
+        another tree with import_stats().
+        """
+        assert isinstance(self.tree, Node), "The tree has no statistics."
+        return dict(sample_count=self.sample_count, root=self.tree.get_stats())
+    
+    def export_delta(self):
+        """
+        Returns the training statistics gained since the last call, for
+        periodically reducing replicas trained on shards of a stream into
+        one tree.
+        """
+        stats = self.get_stats()
+        last = self._exported_stats
+        self._exported_stats = stats
+        if last is None:
+            return stats
+        return dict(
+            sample_count=stats['sample_count'] - last['sample_count'],
+            root=_subtract_stats(stats['root'], last['root']))
+    
+    def import_stats(self, stats):
+        """
+        Adds statistics returned by get_stats() or export_delta() on a tree
+        of the same schema to this tree, re-evaluating its splits.
+        """
+        assert isinstance(self.tree, Node), "The tree has no statistics."
+        self._invalidate_predictions()
+        self.sample_count += stats['sample_count']
+        self.tree.merge_stats(stats['root'])
+        self._out_of_bag_mae_clean = False
+    
+    def merge(self, other):
+        """
+        Adds the training statistics of another incrementally grown tree of
+        the same schema to this tree.
+        """
+        assert self.data.class_attribute_name \
+            == other.data.class_attribute_name \
+        and sorted(self.data.attribute_names) \
+            == sorted(other.data.attribute_names), \
+            "The trees' schemas do not match."
+        self.import_stats(other.get_stats())
+    
     @property
     def out_of_bag_mae(self):
         """
@@ -1360,12 +3819,106 @@ class Tree(object):
         return O(self)
 
     def predict(self, record):
-        record = record.copy()
-        return self._tree.predict(record)
+        cache = self.prediction_cache
+        if cache is None:
+            record = record.copy()
+            return self._tree.predict(record)
+        key = self._get_prediction_key(record)
+        prediction = cache.get(key)
+        if prediction is None:
+            prediction = self._tree.predict(record.copy())
+            cache.set(key, prediction)
+        # Callers may modify the prediction, so the cached one is never
+        # returned itself.
+        return prediction.copy()
+    
+    @property
+    def prediction_cache(self):
+        """
+        The cache of recent predictions, or None if caching is disabled.
+        """
+        if self.prediction_cache_size is None:
+            return
+        if self._prediction_cache is None:
+            self._prediction_cache = PredictionCache(self.prediction_cache_size)
+        return self._prediction_cache
+    
+    @property
+    def split_attributes(self):
+        """
+        The sorted names of the attributes the tree splits on.
+        """
+        if self._split_attributes is None:
+            if isinstance(self._tree, Node):
+                self._split_attributes = \
+                    tuple(sorted(self._tree.get_split_attributes()))
+            else:
+                self._split_attributes = ()
+        return self._split_attributes
+    
+    def _get_prediction_key(self, record):
+        """
+        Returns the projection of the record onto the attributes the tree
+        splits on, which alone determine its prediction.
+        """
+        data = self.data
+        return tuple(data.get_value(record, attr_name)
+            for attr_name in self.split_attributes)
+    
+    def _invalidate_predictions(self):
+        """
+        Clears cached predictions after the tree changes.
+        """
+        self._split_attributes = None
+        if self._prediction_cache is not None:
+            self._prediction_cache.clear()
     
     def save(self, fn):
         pickle.dump(self, open(fn, 'w'))
     
+    def _collapse_root(self):
+        """
+        Turns the root into a leaf predicting from all its samples.
+        """
+        self._tree._prune()
+        self.leaf_count = 1
+    
+    def prune_reduced_error(self, data):
+        """
+        Collapses every branch that doesn't reduce the error on the given
+        held-out data, in a single bottom-up pass.
+        Returns the number of leaves removed.
+        """
+        node = self._tree
+        if not isinstance(node, Node) or not node.attr_name:
+            return 0
+        self._invalidate_predictions()
+        leaf_count = node.get_leaf_count()
+        records = list(data)
+        error = node._prune_reduced_error(records)
+        if node._get_error(node.get_node_dist(), records) <= error:
+            self._collapse_root()
+        return leaf_count - node.get_leaf_count()
+    
+    def prune_cost_complexity(self, alpha=0.0):
+        """
+        Collapses every branch whose reduction in training error, as a
+        fraction of all samples, is no greater than alpha per added leaf,
+        in a single bottom-up pass over the counts stored in each node.
+        Returns the number of leaves removed.
+        """
+        node = self._tree
+        if not isinstance(node, Node) or not node.attr_name or not node.n:
+            return 0
+        self._invalidate_predictions()
+        leaf_count = node.get_leaf_count()
+        total = float(node.n)
+        error, subtree_leaf_count = node._prune_cost_complexity(alpha, total)
+        root_error = Node._get_training_error(node.get_node_dist())/total
+        if root_error + alpha <= error + alpha*subtree_leaf_count:
+            self._collapse_root()
+        return leaf_count - node.get_leaf_count()
+    
     def set_missing_value_policy(self, policy, target_attr_name=None):
         """
         Sets the behavior for one or all attributes to use when traversing the
@@ -1374,6 +3927,7 @@ class Tree(object):
         """
         assert policy in MISSING_VALUE_POLICIES, \
             "Unknown policy: %s" % (policy,)
+        self._invalidate_predictions()
         for attr_name in self.data.attribute_names:
             if target_attr_name is not None and target_attr_name != attr_name:
                 continue
@@ -1386,19 +3940,27 @@ class Tree(object):
         """
 #        assert data.header_types == self._data.header_types, \
 #            "Test data schema does not match the tree's schema."
-        is_cont = self._data.is_continuous_class
-        agg = CDist()
-        for record in data:
-            actual_value = self.predict(record)
-            expected_value = record[self._data.class_attribute_name]
-            if is_cont:
-                assert isinstance(actual_value, CDist)
-                actual_value = actual_value.mean
-                agg += abs(actual_value - expected_value)
-            else:
-                assert isinstance(actual_value, DDist)
-                agg += actual_value.best == expected_value
-        return agg
+        return self.evaluate(data).score
+    
+    def evaluate(self, data):
+        """
+        Returns the Evaluation of the tree's predictions on the data, with
+        all metrics calculated in a single pass.
+        """
+        return evaluate(self, data)
+    
+    def predict_many(self, records):
+        """
+        Returns the predictions for a list of records, routing them through
+        the tree together.
+        
+        Records reaching the same leaf share the same distribution object,
+        which must not be modified.
+        """
+        results = [None]*len(records)
+        self._tree.predict_many(
+            records, six.moves.range(len(records)), results)
+        return results
     
     def to_dict(self):
         return self._tree.to_dict()
@@ -1407,15 +3969,43 @@ class Tree(object):
     def tree(self):
         return self._tree
     
-    def train(self, record):
+    def train(self, record, weight=None):
         """
         Incrementally updates the tree with the given sample record.
+        
+        The record's sample weight is read from the data's weight attribute,
+        unless given explicitly.
         """
         assert self.data.class_attribute_name in record, \
             "The class attribute must be present in the record."
         record = record.copy()
+        weight_attr = self.data.weight_attribute_name
+        if weight_attr is not None:
+            record_weight = record.pop(weight_attr, 1.0)
+            if weight is None:
+                weight = record_weight
+        if weight is None:
+            weight = 1
         self.sample_count += 1
-        self.tree.train(record)
+        error = None
+        if self.drift_detection and self.tree.can_predict(record):
+            error = get_prediction_error(
+                self.predict(record),
+                record[self.data.class_attribute_name])
+        # Only a split changes the split attributes, so they're reset by the
+        # node that splits.
+        if self._prediction_cache is not None:
+            self._prediction_cache.clear()
+        replacement = self.tree.train(record, error=error, weight=weight)
+        if replacement is not None:
+            self._tree = replacement
+    
+    def train_many(self, records):
+        """
+        Incrementally updates the tree with each of the given records.
+        """
+        for record in records:
+            self.train(record)
 
 def _get_defaultdict_cdist():
     return defaultdict(CDist)
@@ -1461,7 +4051,104 @@ class Forest(object):
         # This is a callable that is given a list of all the current trees
         # and returns a list of trees that should be removed.
         self.fell_method = kwargs.get('fell_method', None)
+        
+        # The seed for sampling records and for each tree's choice of
+        # attributes at each split.
+        self._random = random.Random(kwargs.get('seed', None))
+        
+        # The maximum number of predictions cached, keyed on the values of
+        # the attributes any tree splits on. None disables the cache.
+        self.prediction_cache_size = kwargs.get('prediction_cache_size', None)
+        self._prediction_cache = None
+        self._split_attributes = None
     
+    @classmethod
+    def build(cls, data, size=10, bootstrap=True, processes=1,
+        missing_value_policy=USE_MOST_FREQUENT, tree_kwargs=None, **kwargs):
+        """
+        Constructs a forest in a single batch, building each tree with
+        Tree.build() on a sample of the given data.
+        
+        Each tree's sample is an array of row indexes into the shared data,
+        drawn with replacement if bootstrap is true, or otherwise containing
+        each row with probability sample_ratio. Rows are never copied
+        between samples. The rows left out of each sample are then used to
+        calculate every tree's out-of-bag error in a single pass.
+        
+        Trees are built on a pool of processes, unless processes is 1.
+        """
+        assert isinstance(data, Data)
+        forest = cls(data, tree_kwargs=tree_kwargs, size=size, **kwargs)
+        
+        # Draw each tree's sample as an index array, and mark the rows
+        # left out of it.
+        n = sum(1 for _ in data._get_iterator())
+        rand = forest._random
+        tasks = [] # [(indexes, tree_kwargs)]
+        out_of_bag_masks = [] # [bytearray]
+        for _ in six.moves.range(size):
+            if bootstrap:
+                indexes = array('L', [rand.randrange(n) for _ in six.moves.range(n)])
+            else:
+                indexes = array('L', [
+                    i for i in six.moves.range(n)
+                    if rand.random() < forest.sample_ratio
+                ])
+            mask = bytearray([1])*n
+            for i in indexes:
+                mask[i] = 0
+            out_of_bag_masks.append(mask)
+            tree_kwargs = dict(seed=rand.getrandbits(32))
+            tree_kwargs.update(forest.tree_kwargs)
+            tasks.append((indexes, tree_kwargs))
+        
+        if processes == 1:
+            _init_forest_build_worker(data)
+            trees = [_build_forest_tree(task) for task in tasks]
+        else:
+            pool = multiprocessing.Pool(
+                processes,
+                initializer=_init_forest_build_worker,
+                initargs=(data,))
+            try:
+                trees = pool.map(_build_forest_tree, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        for tree in trees:
+            tree._data = data
+            if missing_value_policy:
+                tree.set_missing_value_policy(missing_value_policy)
+            tree._out_of_bag_mae = CDist()
+        forest.trees = trees
+        
+        # Calculate the out-of-bag error of every tree in one pass.
+        class_attr = data.class_attribute_name
+        is_cont = data.is_continuous_class
+        for i, row in enumerate(data._get_iterator()):
+            if not row:
+                continue
+            record = None
+            for tree, mask in zip(trees, out_of_bag_masks):
+                if not mask[i]:
+                    continue
+                if record is None:
+                    record = data.validate_row(row)
+                try:
+                    prediction = tree.predict(record)
+                except NodeNotReadyToPredict:
+                    continue
+                weight = data.get_weight(record)
+                if is_cont:
+                    tree._out_of_bag_mae.add(
+                        abs(prediction.mean - record[class_attr]), weight)
+                else:
+                    tree._out_of_bag_mae.add(
+                        prediction.best == record[class_attr], weight)
+        for tree in trees:
+            tree._out_of_bag_mae_clean = True
+        return forest
+
     def _fell_trees(self):
         """
         Removes trees from the forest according to the specified fell method.
@@ -1517,107 +4204,834 @@ class Forest(object):
         weights = normalize(weights)
         return zip(weights, active_trees)
     
-    def _grow_trees(self):
+    def _grow_trees(self):
+        """
+        Adds new trees to the forest according to the specified growth method.
+        """
+        if self.grow_method == GROW_AUTO_INCREMENTAL:
+            self.tree_kwargs['auto_grow'] = True
+        
+        while len(self.trees) < self.size:
+            tree_kwargs = dict(seed=self._random.getrandbits(32))
+            tree_kwargs.update(self.tree_kwargs)
+            self.trees.append(Tree(data=self.data, **tree_kwargs))
+    
+    @property
+    def data(self):
+        return self._data
+        
+    def predict(self, record):
+        """
+        Attempts to predict the value of the class attribute by aggregating
+        the predictions of each tree.
+        """
+        cache = self.prediction_cache
+        if cache is None:
+            return self._predict(record)
+        key = tuple(self.data.get_value(record, attr_name)
+            for attr_name in self.split_attributes)
+        prediction = cache.get(key)
+        if prediction is None:
+            prediction = self._predict(record)
+            if prediction is None:
+                return
+            cache.set(key, prediction)
+        return prediction.copy()
+    
+    @property
+    def prediction_cache(self):
+        """
+        The cache of recent predictions, or None if caching is disabled.
+        """
+        if self.prediction_cache_size is None:
+            return
+        if self._prediction_cache is None:
+            self._prediction_cache = PredictionCache(self.prediction_cache_size)
+        return self._prediction_cache
+    
+    @property
+    def split_attributes(self):
+        """
+        The sorted names of the attributes any tree splits on.
+        """
+        if self._split_attributes is None:
+            attributes = set()
+            for tree in self.trees:
+                attributes.update(tree.split_attributes)
+            self._split_attributes = tuple(sorted(attributes))
+        return self._split_attributes
+    
+    def _invalidate_predictions(self):
+        """
+        Clears cached predictions after any tree changes.
+        """
+        self._split_attributes = None
+        if self._prediction_cache is not None:
+            self._prediction_cache.clear()
+    
+    def _predict(self, record):
+        """
+        Aggregates the predictions of each tree, weighted by the forest's
+        weighting method.
+        """
+        
+        # Get raw predictions.
+        # {tree:raw prediction}
+        predictions = {}
+        for tree in self.trees:
+            _p = tree.predict(record)
+            if _p is None:
+                continue
+            if isinstance(_p, CDist):
+                if _p.mean is None:
+                    continue
+            elif isinstance(_p, DDist):
+                if not _p.count:
+                    continue
+            predictions[tree] = _p
+        if not predictions:
+            return
+
+        # Normalize weights and aggregate final prediction.
+        weights = self.weighting_method(predictions.keys())
+        if not weights:
+            return
+#        assert sum(weights) == 1.0, "Sum of weights must equal 1."
+        return self._combine(
+            [(weight, predictions[tree]) for weight, tree in weights])
+    
+    def _combine(self, weighted_predictions):
+        """
+        Merges a list of (weight, prediction) with normalized weights into
+        a single prediction.
+        """
+        if self.data.is_continuous_class:
+            # Merge continuous class predictions into a single mixture.
+            mean = sum(w*p.mean for w, p in weighted_predictions)
+            moment = sum(
+                w*((p.variance or 0) + p.mean**2)
+                for w, p in weighted_predictions)
+            return CDist(mean=mean, var=max(0.0, moment - mean**2))
+        # Merge discrete class predictions.
+        total = DDist()
+        for weight, prediction in weighted_predictions:
+            for cls_value, cls_prob in prediction.probs:
+                total.add(cls_value, cls_prob*weight)
+        return total
+    
+    def predict_many(self, records):
+        """
+        Returns the predictions for a list of records, predicting them with
+        each tree together and weighting the trees once for all records.
+        
+        Each record's tree weights are renormalized over the trees giving it
+        a prediction, which only matches predict() for weights proportional
+        to a per-tree statistic, like the default's. With any other weighting
+        method, each record is predicted on its own.
+        """
+        if self.weighting_method != Forest.mean_oob_mae_weight:
+            return [self._predict(record) for record in records]
+        tree_weights = dict(
+            (tree, weight)
+            for weight, tree in self.weighting_method(self.trees) or [])
+        tree_predictions = [
+            (tree_weights[tree], tree.predict_many(records))
+            for tree in self.trees if tree in tree_weights]
+        results = []
+        for i in six.moves.range(len(records)):
+            weighted_predictions = []
+            for weight, predictions in tree_predictions:
+                prediction = predictions[i]
+                if prediction is None:
+                    continue
+                if isinstance(prediction, CDist):
+                    if prediction.mean is None:
+                        continue
+                elif not prediction.count:
+                    continue
+                weighted_predictions.append((weight, prediction))
+            weight_sum = float(sum(w for w, _ in weighted_predictions))
+            if not weighted_predictions or not weight_sum:
+                results.append(None)
+                continue
+            results.append(self._combine([
+                (w/weight_sum, p) for w, p in weighted_predictions]))
+        return results
+    
+    def freeze(self):
+        """
+        Returns an immutable snapshot of the forest for concurrent prediction.
+        """
+        return FrozenForest(self)
+    
+    def predict_parallel(self, records, processes=None):
+        """
+        Returns the predictions for a batch of records, evaluating the trees
+        in parallel worker processes. See ParallelPredictor.
+        """
+        with ParallelPredictor(self, processes=processes) as predictor:
+            return predictor.predict_many(records)
+    
+    def to_python(self):
+        """
+        Returns the source of a standalone Python module whose
+        predict(record) function aggregates the predictions of each tree as
+        plain data, weighting trees as they are weighted now.
+        """
+        weights = self.weighting_method(self.trees) or []
+        writer = _SourceWriter()
+        tree_sources = []
+        for i, (weight, tree) in enumerate(weights):
+            name = '_tree%i' % i
+            _write_tree_source(tree, writer, name)
+            tree_sources.append('(%r, %s)' % (weight, name))
+        writer.line(0, '_TREES = [%s]' % ', '.join(tree_sources))
+        writer.line(0, '')
+        writer.line(0, 'def predict(record):')
+        writer.line(1, 'predictions = []')
+        writer.line(1, 'weight_sum = 0.0')
+        writer.line(1, 'for weight, tree in _TREES:')
+        writer.line(2, 'prediction = tree(record)')
+        if self.data.is_continuous_class:
+            writer.line(2, 'if prediction[0] is not None:')
+        else:
+            writer.line(2, 'if prediction:')
+        writer.line(3, 'predictions.append((weight, prediction))')
+        writer.line(3, 'weight_sum += weight')
+        writer.line(1, 'if not predictions:')
+        writer.line(2, 'return')
+        if self.data.is_continuous_class:
+            writer.line(1, 'mean = moment = 0.0')
+            writer.line(1, 'for weight, (_mean, _variance) in predictions:')
+            writer.line(2, 'weight /= weight_sum')
+            writer.line(2, 'mean += weight*_mean')
+            writer.line(2, 'moment += weight*((_variance or 0) + _mean**2)')
+            writer.line(1, 'return (mean, max(0.0, moment - mean**2))')
+        else:
+            writer.line(1, 'total = {}')
+            writer.line(1, 'for weight, probs in predictions:')
+            writer.line(2, 'weight /= weight_sum')
+            writer.line(2, 'for cls_value, cls_prob in probs.items():')
+            writer.line(3, 'total[cls_value] = '
+                'total.get(cls_value, 0.0) + cls_prob*weight')
+            writer.line(1, 'return total')
+        return writer.get_source(_GENERATED_MODULE_HEADER % dict(
+            class_attr=self.data.class_attribute_name,
+            model='random forest',
+            returns=_get_returns_doc(self.data)))
+    
+    def compile(self):
+        """
+        Returns a predict(record) function generated from the forest's
+        current trees, which is much faster than predict().
+        See Tree.compile().
+        """
+        return compile_predict(self.to_python())
+
+    def set_missing_value_policy(self, policy, target_attr_name=None):
+        self._invalidate_predictions()
+        for tree in self.trees:
+            tree.set_missing_value_policy(policy, target_attr_name)
+    
+    def test(self, data):
+        """
+        Iterates over the data, classifying or regressing each element and then
+        finally returns the classification accuracy or mean-absolute-error.
+        
+        The records are predicted in batches with predict_many(), which
+        gives the same results as predict() for every weighting method.
+        """
+#        assert data.header_types == self._data.header_types, \
+#            "Test data schema does not match the tree's schema."
+        return self.evaluate(data).score
+    
+    def evaluate(self, data):
+        """
+        Returns the Evaluation of the forest's predictions on the data, with
+        all metrics calculated in a single pass.
+        """
+        return evaluate(self, data)
+    
+    def train(self, record, weight=None):
+        """
+        Updates the trees with the given training record, optionally with
+        an explicit sample weight.
+        """
+        self._invalidate_predictions()
+        self._fell_trees()
+        self._grow_trees()
+        for tree in self.trees:
+            if self._random.random() < self.sample_ratio:
+                tree.train(record, weight=weight)
+            else:
+                tree.out_of_bag_samples.append(record)
+                while len(tree.out_of_bag_samples) > self.max_out_of_bag_samples:
+                    tree.out_of_bag_samples.pop(0)
+    
+    def train_many(self, records):
+        """
+        Updates the trees with each of the given training records.
+        """
+        for record in records:
+            self.train(record)
+
+# The dataset shared by all forest building tasks in a worker process.
+_forest_build_state = {}
+
+def _init_forest_build_worker(data):
+    """
+    Stores the dataset once per worker, so that individual tasks only
+    carry a sample's row indexes.
+    """
+    _forest_build_state['data'] = data
+
+def _build_forest_tree(task):
+    """
+    Builds a tree on the rows of the shared dataset at the given indexes.
+    """
+    indexes, tree_kwargs = task
+    data = _forest_build_state['data']
+    tree = Tree.build(DataView(data, indexes=indexes), **tree_kwargs)
+    # Avoid sending the dataset back with the tree.
+    tree._data = None
+    return tree
+
+class FrozenForest(object):
+    """
+    An immutable snapshot of a forest, safe to share between threads
+    without locks.
+    
+    The trees are copied, all lazily calculated statistics are resolved up
+    front and prediction caching is turned off, so prediction only reads the
+    snapshot's state.
+    Later training of the original forest does not affect the snapshot.
+    """
+    
+    def __init__(self, forest):
+        assert isinstance(forest, Forest)
+        self._forest = forest = copy.deepcopy(forest)
+        forest.prediction_cache_size = None
+        forest._prediction_cache = None
+        for tree in forest.trees:
+            # Resolve the lazily calculated out-of-bag error.
+            tree.out_of_bag_mae
+            tree.prediction_cache_size = None
+            tree._prediction_cache = None
+            tree.tree._freeze()
+    
+    @property
+    def data(self):
+        return self._forest.data
+    
+    @property
+    def trees(self):
+        return tuple(self._forest.trees)
+    
+    def predict(self, record):
+        return self._forest.predict(record)
+    
+    def predict_many(self, records):
+        """
+        Returns the predictions for a batch of records.
+        """
+        return [self._forest.predict(record) for record in records]
+    
+    def test(self, data):
+        return self._forest.test(data)
+
+class BatchPredictor(object):
+    """
+    Serves predictions to asyncio code, coalescing concurrent requests into
+    micro-batches that are evaluated on a pool of worker threads.
+    
+    A batch is dispatched as soon as it holds max_batch_size records, or
+    max_delay seconds after its first record arrived, bounding the latency
+    added by batching.
+    """
+    
+    def __init__(self, model, max_batch_size=32, max_delay=0.002,
+        workers=None, executor=None):
+        assert asyncio is not None, \
+            "Batch prediction requires asyncio and concurrent.futures."
+        if isinstance(model, Forest):
+            model = model.freeze()
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._own_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(workers or 4)
+        self._pending = [] # [(record, future)]
+        self._timer = None
+    
+    def predict_async(self, record):
+        """
+        Queues the record for prediction and returns an awaitable future
+        that resolves to its prediction.
+        """
+        # get_running_loop() was added in Python 3.7, and replaces the
+        # deprecated use of get_event_loop() from a coroutine.
+        loop = getattr(
+            asyncio, 'get_running_loop', asyncio.get_event_loop)()
+        future = loop.create_future()
+        self._pending.append((record, future))
+        if len(self._pending) >= self.max_batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self.flush)
+        return future
+    
+    def flush(self):
+        """
+        Immediately dispatches all queued records as one batch.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        records = [record for record, _ in batch]
+        futures = [future for _, future in batch]
+        result = asyncio.wrap_future(
+            self._executor.submit(self.model.predict_many, records))
+        
+        def resolve(result):
+            for i, future in enumerate(futures):
+                if future.cancelled():
+                    continue
+                if result.cancelled():
+                    future.cancel()
+                elif result.exception() is not None:
+                    future.set_exception(result.exception())
+                else:
+                    future.set_result(result.result()[i])
+        
+        result.add_done_callback(resolve)
+    
+    def close(self):
+        """
+        Dispatches any queued records and releases the worker pool.
+        """
+        self.flush()
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+
+# The compiled trees of a forest in each parallel prediction worker.
+_parallel_predict_state = {}
+
+def _get_parallel_predict_state(sources, shm_name, offsets, weights,
+    is_continuous_class):
+    """
+    Returns the state of a predictor over the given trees, reading their
+    generated source from shared memory if given. Trees are compiled on
+    first use, since each worker only evaluates some.
+    """
+    if shm_name is not None:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            sources = [
+                bytes(shm.buf[start:end]).decode('utf-8')
+                for start, end in offsets]
+        finally:
+            shm.close()
+    return dict(
+        sources=sources,
+        predictors=[None]*len(sources),
+        weights=weights,
+        is_continuous_class=is_continuous_class)
+
+def _init_parallel_predict_worker(*args):
+    _parallel_predict_state.update(_get_parallel_predict_state(*args))
+
+def _predict_partial(task, state=None):
+    """
+    Returns the weighted sums of the predictions of a range of trees for
+    each record, to be combined with the sums of the other ranges.
+    
+    The state defaults to that of the pool worker running the task.
+    """
+    lo, hi, records = task
+    if state is None:
+        state = _parallel_predict_state
+    predictors = state['predictors']
+    for i in six.moves.range(lo, hi):
+        if predictors[i] is None:
+            predictors[i] = compile_predict(state['sources'][i])
+    weights = state['weights']
+    ret = []
+    for record in records:
+        weight_sum = 0.0
+        if state['is_continuous_class']:
+            mean = moment = 0.0
+            for i in six.moves.range(lo, hi):
+                _mean, _variance = predictors[i](record)
+                if _mean is None:
+                    continue
+                weight = weights[i]
+                weight_sum += weight
+                mean += weight*_mean
+                moment += weight*((_variance or 0) + _mean**2)
+            ret.append((weight_sum, mean, moment))
+        else:
+            probs = {}
+            for i in six.moves.range(lo, hi):
+                prediction = predictors[i](record)
+                if not prediction:
+                    continue
+                weight = weights[i]
+                weight_sum += weight
+                for cls_value, cls_prob in iteritems(prediction):
+                    probs[cls_value] = probs.get(cls_value, 0.0) \
+                        + weight*cls_prob
+            ret.append((weight_sum, probs))
+    return ret
+
+class ParallelPredictor(object):
+    """
+    Predicts batches of records by evaluating a forest's trees in parallel
+    worker processes.
+    
+    The trees are compiled to Python code, as by Tree.compile(), whose
+    source is placed once in shared memory for the workers to read. Each
+    worker returns only the weighted sums of its trees' predictions.
+    The trees are weighted as they are when the predictor is created.
+    
+    With a single process, the trees are evaluated in this process, and
+    no shared memory is used.
+    """
+    
+    def __init__(self, forest, processes=None):
+        self.data = forest.data
+        self.processes = processes or multiprocessing.cpu_count()
+        weights = list(forest.weighting_method(forest.trees) or [])
+        sources = [tree.to_python() for _, tree in weights]
+        self._tree_count = len(sources)
+        self._shm = None
+        self._state = None
+        self._pool = None
+        weights = [w for w, _ in weights]
+        is_cont = self.data.is_continuous_class
+        if self.processes == 1:
+            self._state = _get_parallel_predict_state(
+                sources, None, None, weights, is_cont)
+            return
+        shm_name = offsets = None
+        if shared_memory is not None and sources:
+            encoded = [source.encode('utf-8') for source in sources]
+            offsets = []
+            start = 0
+            for source in encoded:
+                offsets.append((start, start + len(source)))
+                start += len(source)
+            self._shm = shared_memory.SharedMemory(create=True, size=start)
+            self._shm.buf[:start] = b''.join(encoded)
+            shm_name = self._shm.name
+            sources = None
+        self._pool = multiprocessing.Pool(
+            self.processes,
+            initializer=_init_parallel_predict_worker,
+            initargs=(sources, shm_name, offsets, weights, is_cont))
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def predict_many(self, records):
+        """
+        Returns the forest's prediction for each of the records, or None
+        where no tree could predict.
+        """
+        records = list(records)
+        n = self._tree_count
+        if not n:
+            return [None]*len(records)
+        size = int(math.ceil(n/float(self.processes)))
+        tasks = [
+            (lo, min(n, lo + size), records)
+            for lo in six.moves.range(0, n, size)]
+        if self._pool is None:
+            partials = [_predict_partial(task, self._state) for task in tasks]
+        else:
+            partials = self._pool.map(_predict_partial, tasks)
+        
+        is_cont = self.data.is_continuous_class
+        results = []
+        for i in six.moves.range(len(records)):
+            weight_sum = sum(partial[i][0] for partial in partials)
+            if not weight_sum:
+                results.append(None)
+            elif is_cont:
+                mean = sum(partial[i][1] for partial in partials)/weight_sum
+                moment = sum(partial[i][2] for partial in partials)/weight_sum
+                results.append(
+                    CDist(mean=mean, var=max(0.0, moment - mean**2)))
+            else:
+                total = DDist()
+                for partial in partials:
+                    for cls_value, cls_prob in iteritems(partial[i][1]):
+                        total.add(cls_value, cls_prob/weight_sum)
+                results.append(total)
+        return results
+    
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+class _PreparedData(Data):
+    """
+    Iterates over in-memory rows that have already been validated, without
+    copying them.
+    """
+    
+    def __iter__(self):
+        return iter(self.data)
+
+class BoostedTrees(object):
+    """
+    A gradient-boosted ensemble of shallow regression trees.
+    
+    Each tree is fit to the residuals of the ensemble before it, and its
+    predictions are scaled by the learning rate. Training rows are validated
+    once, and their class values are overwritten in place with the current
+    residuals before each round, so no rows are copied between rounds.
+    """
+    
+    def __init__(self, data, size=100, learning_rate=0.1, max_depth=3,
+        early_stopping_rounds=None, missing_value_policy=USE_NODE_DIST,
+        tree_kwargs=None):
+        assert isinstance(data, Data)
+        assert data.is_continuous_class, \
+            "Boosting requires a continuous class."
+        self._data = data
+        
+        # The maximum number of trees in the ensemble.
+        self.size = size
+        
+        # The factor each tree's prediction is scaled by.
+        self.learning_rate = learning_rate
+        
+        # Stop adding trees once the validation error hasn't improved for
+        # this many rounds.
+        self.early_stopping_rounds = early_stopping_rounds
+        
+        # The policy each tree uses for unseen attribute values.
+        self.missing_value_policy = missing_value_policy
+        
+        # Arguments that will be passed to each tree.
+        self.tree_kwargs = dict(max_depth=max_depth)
+        self.tree_kwargs.update(tree_kwargs or {})
+        
+        # The initial prediction, before any tree is added.
+        self.base_value = 0.0
+        
+        self.trees = []
+        
+        # The mean absolute error on the validation data after each round.
+        self.validation_errors = []
+    
+    @classmethod
+    def build(cls, data, validation_data=None, **kwargs):
         """
-        Adds new trees to the forest according to the specified growth method.
+        Constructs the ensemble, stopping early if the mean absolute error
+        on the given validation data stops improving.
         """
-        if self.grow_method == GROW_AUTO_INCREMENTAL:
-            self.tree_kwargs['auto_grow'] = True
-        
-        while len(self.trees) < self.size:
-            self.trees.append(Tree(data=self.data, **self.tree_kwargs))
+        model = cls(data, **kwargs)
+        model.fit(validation_data=validation_data)
+        return model
     
     @property
     def data(self):
         return self._data
+    
+    def fit(self, validation_data=None):
+        data = self.data
+        class_attr = data.class_attribute_name
+        rows = list(data)
+        targets = array('d', [row[class_attr] for row in rows])
+        if not rows:
+            return
+        self.base_value = CDist(
+            seq=targets, weights=[data.get_weight(row) for row in rows]).mean
+        self.trees = []
+        self.validation_errors = []
         
-    def predict(self, record):
-        """
-        Attempts to predict the value of the class attribute by aggregating
-        the predictions of each tree.
+        # The residual of each training row, updated in place.
+        residuals = array('d', [t - self.base_value for t in targets])
+        modes = {class_attr: CLS}
+        if data.weight_attribute_name is not None:
+            modes[data.weight_attribute_name] = WGT
+        residual_data = _PreparedData(
+            rows,
+            order=data.header_order,
+            types=data.header_types,
+            modes=modes,
+            sparse=data.sparse,
+            sparse_default=data.sparse_default)
         
-        Parameters:
-            weighting_formula := a callable that takes a list of trees and
-                returns a list of weights.
-        """
+        if validation_data is not None:
+            validation_rows = list(validation_data)
+            validation_targets = array('d', [
+                row[class_attr] for row in validation_rows])
+            validation_predictions = array(
+                'd', [self.base_value]*len(validation_rows))
         
-        # Get raw predictions.
-        # {tree:raw prediction}
-        predictions = {}
-        for tree in self.trees:
-            _p = tree.predict(record)
-            if _p is None:
+        best = (1e999999, 0) # (error, tree count)
+        for _ in six.moves.range(self.size):
+            for row, residual in zip(rows, residuals):
+                row[class_attr] = residual
+            tree = Tree.build(residual_data, **self.tree_kwargs)
+            if self.missing_value_policy:
+                tree.set_missing_value_policy(self.missing_value_policy)
+            tree._data = data
+            self.trees.append(tree)
+            for i, row in enumerate(rows):
+                residuals[i] -= self.learning_rate*tree.predict(row).mean
+            
+            if validation_data is None:
                 continue
-            if isinstance(_p, CDist):
-                if _p.mean is None:
-                    continue
-            elif isinstance(_p, DDist):
-                if not _p.count:
-                    continue
-            predictions[tree] = _p
-        if not predictions:
-            return
-
-        # Normalize weights and aggregate final prediction.
-        weights = self.weighting_method(predictions.keys())
-        if not weights:
-            return
-#        assert sum(weights) == 1.0, "Sum of weights must equal 1."
-        if self.data.is_continuous_class:
-            # Merge continuous class predictions.
-            total = sum(w*predictions[tree].mean for w, tree in weights)
-        else:
-            # Merge discrete class predictions.
-            total = DDist()
-            for weight, tree in weights:
-                prediction = predictions[tree]
-                for cls_value, cls_prob in prediction.probs:
-                    total.add(cls_value, cls_prob*weight)
+            error = 0.0
+            for i, row in enumerate(validation_rows):
+                validation_predictions[i] += \
+                    self.learning_rate*tree.predict(row).mean
+                error += abs(validation_predictions[i] - validation_targets[i])
+            error /= max(1, len(validation_rows))
+            self.validation_errors.append(error)
+            best = min(best, (error, len(self.trees)))
+            if self.early_stopping_rounds is not None \
+            and len(self.trees) - best[1] >= self.early_stopping_rounds:
+                break
         
-        return total
+        # Restore the original class values.
+        for row, target in zip(rows, targets):
+            row[class_attr] = target
+        
+        if validation_data is not None and self.early_stopping_rounds is not None:
+            # Keep only the trees up to the best validation error.
+            del self.trees[best[1]:]
     
-    def set_missing_value_policy(self, policy, target_attr_name=None):
+    def predict(self, record):
+        """
+        Returns a CDist whose mean is the ensemble's prediction.
+        """
+        total = self.base_value
         for tree in self.trees:
-            tree.set_missing_value_policy(policy, target_attr_name)
+            total += self.learning_rate*tree.predict(record).mean
+        return CDist(mean=total)
     
     def test(self, data):
         """
-        Iterates over the data, classifying or regressing each element and then
-        finally returns the classification accuracy or mean-absolute-error.
+        Iterates over the data and returns the mean absolute error.
         """
-#        assert data.header_types == self._data.header_types, \
-#            "Test data schema does not match the tree's schema."
-        is_cont = self.data.is_continuous_class
+        class_attr = self.data.class_attribute_name
         agg = CDist()
         for record in data:
-            actual_value = self.predict(record)
-            if actual_value is None:
-                continue
-            expected_value = record[self._data.class_attribute_name]
-            if is_cont:
-                assert isinstance(actual_value, CDist), \
-                    "Invalid prediction type: %s" % (type(actual_value),)
-                actual_value = actual_value.mean
-                agg += abs(actual_value - expected_value)
-            else:
-                assert isinstance(actual_value, DDist), \
-                    "Invalid prediction type: %s" % (type(actual_value),)
-                agg += actual_value.best == expected_value
+            agg.add(abs(self.predict(record).mean - record[class_attr]),
+                self.data.get_weight(record))
         return agg
+
+# The dataset shared by all cross-validation tasks in a worker process.
+_cross_validate_state = {}
+
+def _init_cross_validate_worker(data, k, seed, missing_value_policy):
+    """
+    Stores the dataset once per worker, so that individual tasks only
+    carry a fold number and tree parameters.
+    """
+    _cross_validate_state.update(
+        data=data, k=k, seed=seed,
+        missing_value_policy=missing_value_policy)
+
+def _cross_validate_task(task):
+    """
+    Builds and tests a tree on a single fold with the given parameters.
+    """
+    params_index, fold, params = task
+    state = _cross_validate_state
+    train_data, test_data = state['data'].get_fold(
+        fold, k=state['k'], seed=state['seed'])
+    t0 = time.time()
+    tree = Tree.build(train_data, **params)
+    if state['missing_value_policy']:
+        tree.set_missing_value_policy(state['missing_value_policy'])
+    result = tree.test(test_data)
+    return params_index, fold, result.mean, time.time() - t0
+
+def get_param_grid(params):
+    """
+    Expands a dict of {name:[value1,value2,...]} into a list of dicts
+    containing every combination of values.
+    A list of dicts is returned unchanged.
+    """
+    if not params:
+        return [{}]
+    if isinstance(params, dict):
+        names = sorted(params)
+        return [
+            dict(zip(names, values))
+            for values in itertools.product(*[params[name] for name in names])
+        ]
+    return list(params)
+
+def cross_validate(data, params=None, k=10, seed=0, processes=None,
+    missing_value_policy=USE_NEAREST):
+    """
+    Builds and tests a tree on each of k folds for every combination of
+    tree parameters, distributing the work over a pool of processes.
     
-    def train(self, record):
-        """
-        Updates the trees with the given training record.
-        """
-        self._fell_trees()
-        self._grow_trees()
-        for tree in self.trees:
-            if random.random() < self.sample_ratio:
-                tree.train(record)
-            else:
-                tree.out_of_bag_samples.append(record)
-                while len(tree.out_of_bag_samples) > self.max_out_of_bag_samples:
-                    tree.out_of_bag_samples.pop(0)
+    Parameters:
+    
+    params := either a dict of {name:[value1,value2,...]} or a list of
+        dicts, giving the keyword arguments passed to Tree.build().
+    
+    processes := the number of worker processes, defaulting to the number
+        of CPUs. If 1, all folds are run in the current process.
+    
+    Returns a list with one dict per parameter combination, in grid order,
+    of the form:
+    
+        {
+            'params': {name:value},
+            'score': CDist of the per-fold accuracy or mean absolute error,
+            'seconds': CDist of the per-fold build and test time,
+        }
+    """
+    grid = get_param_grid(params)
+    tasks = [
+        (params_index, fold, grid_params)
+        for params_index, grid_params in enumerate(grid)
+        for fold in six.moves.range(k)
+    ]
+    initargs = (data, k, seed, missing_value_policy)
+    if processes == 1:
+        _init_cross_validate_worker(*initargs)
+        results = [_cross_validate_task(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(
+            processes,
+            initializer=_init_cross_validate_worker,
+            initargs=initargs)
+        try:
+            results = pool.map(_cross_validate_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    ret = [
+        dict(params=grid_params, score=CDist(), seconds=CDist())
+        for grid_params in grid
+    ]
+    for params_index, _, score, seconds in sorted(results):
+        if score is not None:
+            ret[params_index]['score'] += score
+        ret[params_index]['seconds'] += seconds
+    return ret
 
 class Test(unittest.TestCase):
 
@@ -1656,6 +5070,139 @@ class Test(unittest.TestCase):
         
         print('Done.')
 
+    def test_normcdf_many(self):
+        
+        def erfcc_approx(x):
+            # The polynomial approximation of erfc formerly used by erfcc.
+            z = abs(x)
+            t = 1. / (1. + 0.5*z)
+            r = t * math.exp(-z*z-1.26551223+t*(1.00002368+t*(.37409196+
+                t*(.09678418+t*(-.18628806+t*(.27886807+
+                t*(-1.13520398+t*(1.48851587+t*(-.82215223+
+                t*.17087277)))))))))
+            return r if x >= 0. else 2. - r
+        
+        for i in range(-600, 601):
+            x = i/100.
+            self.assertAlmostEqual(erfcc(x), erfcc_approx(x), 6)
+        
+        # Many thresholds match individual queries.
+        dist = CDist(seq=[1, 2, 2, 3, 5, 8])
+        xs = [i/10. for i in range(-20, 100)]
+        lt = dist.probabilities_lt(xs)
+        gt = dist.probabilities_gt(xs)
+        self.assertEqual(len(lt), len(xs))
+        for x, p, q in zip(xs, lt, gt):
+            self.assertAlmostEqual(p, dist.probability_lt(x))
+            self.assertAlmostEqual(q, dist.probability_gt(x))
+        
+        # Many distributions match individual queries.
+        dists = [CDist(seq=[i, i*2, i*3 + 1]) for i in range(1, 20)]
+        for x in (5, [i*1.5 for i in range(1, 20)]):
+            ps = get_probabilities_lt(dists, x)
+            for i, (d, p) in enumerate(zip(dists, ps)):
+                self.assertAlmostEqual(
+                    p, d.probability_lt(x if not isinstance(x, list) else x[i]))
+        self.assertTrue(math.isnan(get_probabilities_lt([CDist()], 0)[0]))
+
+    def test_cdist_merge(self):
+        rnd = random.Random(0)
+        nums = [rnd.gauss(1e6, 1.0) for _ in range(3000)]
+        whole = CDist(seq=nums)
+        
+        # Merging per-shard distributions matches tracking every sample.
+        shards = [CDist(seq=nums[i:i+700]) for i in range(0, len(nums), 700)]
+        merged = CDist()
+        for shard in shards:
+            merged.merge(shard)
+        for dist in (merged, sum(shards), shards[0] + CDist(seq=nums[700:])):
+            self.assertEqual(dist.count, whole.count)
+            self.assertAlmostEqual(dist.mean, whole.mean, 6)
+            self.assertAlmostEqual(dist.variance, whole.variance, 6)
+        self.assertEqual(CDist().merge(whole).variance, whole.variance)
+        self.assertEqual(whole.copy().merge(CDist()).mean, whole.mean)
+        
+        # Samples far from zero don't lose precision.
+        mean = math.fsum(nums)/len(nums)
+        self.assertAlmostEqual(whole.mean, mean, 6)
+        self.assertAlmostEqual(
+            whole.variance,
+            math.fsum((n - mean)**2 for n in nums)/len(nums), 6)
+        self.assertEqual(CDist(seq=[0.9]*1000).mean, 0.9)
+        
+        # Distributions pickled by earlier versions, which kept the sum of
+        # samples, can still be loaded.
+        old = CDist.__new__(CDist)
+        old.__dict__.update(mean_sum=6.0, mean_count=3, last_variance=2.0)
+        loaded = pickle.loads(pickle.dumps(old))
+        self.assertEqual(loaded.mean, 2.0)
+        self.assertEqual(loaded.count, 3)
+        self.assertEqual(repr(loaded), repr(CDist(seq=[1, 2, 3])))
+
+    def test_load_old_pickle(self):
+        # The attributes of each class in the first released version.
+        old_attributes = {
+            Tree: set([
+                '_data', '_mae_clean', '_out_of_bag_mae',
+                '_out_of_bag_mae_clean', '_out_of_bag_samples', '_tree',
+                'auto_grow', 'leaf_count', 'leaf_threshold', 'mae', 'metric',
+                'missing_value_policy', 'out_of_bag_accuracy', 'sample_count',
+                'splitting_n']),
+            Node: set([
+                '_attr_class_value_counts', '_attr_value_cdist',
+                '_attr_value_count_totals', '_attr_value_counts', '_branches',
+                '_class_cdist', '_class_ddist', '_tree', 'attr_name', 'n']),
+            Data: set([
+                '_class_attr_name', 'data', 'filename', 'header_modes',
+                'header_order', 'header_types']),
+        }
+        
+        def make_old(obj, seen):
+            # Strips the attributes added since, in place.
+            if id(obj) in seen:
+                return
+            seen.add(id(obj))
+            if isinstance(obj, CDist):
+                obj.__dict__['mean_sum'] = obj.__dict__.pop('running_mean') \
+                    * obj.mean_count
+            elif isinstance(obj, dict):
+                for value in list(obj.values()):
+                    make_old(value, seen)
+            elif type(obj) in old_attributes:
+                for name in list(obj.__dict__):
+                    if name not in old_attributes[type(obj)]:
+                        del obj.__dict__[name]
+                make_old(obj.__dict__, seen)
+        
+        for fn in ('cdata1', 'rdata2'):
+            data = Data(fn)
+            rows = list(data)
+            expected = Tree.build(data)
+            old = Tree.build(Data(fn))
+            make_old(old, set())
+            self.assertTrue('depth' not in old.tree.__dict__)
+            tree = pickle.loads(pickle.dumps(old))
+            tree.set_missing_value_policy(USE_MOST_FREQUENT)
+            self.assertEqual(tree.depth, expected.depth)
+            self.assertEqual(tree.node_count, expected.node_count)
+            pairs = [(tree.tree, expected.tree)]
+            while pairs:
+                node, expected_node = pairs.pop()
+                self.assertEqual(node.depth, expected_node.depth)
+                self.assertEqual(
+                    node._sorted_values, expected_node._sorted_values)
+                if node.attr_name:
+                    self.assertTrue(node._most_frequent_value is not None)
+                pairs.extend(
+                    (branch, expected_node._branches[value])
+                    for value, branch in iteritems(node._branches))
+            self.assertEqual(
+                [repr(tree.predict(row)) for row in rows],
+                [repr(expected.predict(row)) for row in rows])
+            self.assertEqual(tree.test(data).mean, expected.test(data).mean)
+            self.assertEqual(
+                tree.compile()(rows[0]), expected.compile()(rows[0]))
+
     def test_data(self):
         print('Testing data class...')
         
@@ -1713,6 +5260,222 @@ class Test(unittest.TestCase):
             
         print('Done.')
 
+    def test_infer_schema(self):
+        for fn in ('cdata2', 'rdata3'):
+            data = Data(fn)
+            rows = list(data)
+            
+            # Infer the types of a file with only attribute names.
+            with open(fn) as fin:
+                lines = fin.read().splitlines()
+            names = [el.split(':')[0] for el in lines[0].split(',')]
+            handle, plain_fn = tempfile.mkstemp(suffix='.csv')
+            try:
+                with os.fdopen(handle, 'w') as fout:
+                    fout.write('\n'.join([','.join(names)] + lines[1:]) + '\n')
+                inferred = Data.infer(plain_fn)
+                self.assertEqual(inferred.header_types, data.header_types)
+                self.assertEqual(
+                    inferred.class_attribute_name, data.class_attribute_name)
+                self.assertEqual(list(inferred), list(data))
+            finally:
+                os.remove(plain_fn)
+            
+            # Infer the types of in-memory rows.
+            inferred = Data.infer(rows, order=data.header_order, sample_size=5)
+            self.assertEqual(inferred.header_types, data.header_types)
+            self.assertEqual(
+                inferred.is_continuous_class, data.is_continuous_class)
+            self.assertEqual(
+                sorted(inferred.attribute_names), sorted(data.attribute_names))
+            
+            # The sampled rows of a one-shot iterator aren't lost.
+            inferred = Data.infer(
+                (row for row in rows), order=data.header_order, sample_size=5)
+            self.assertEqual(inferred.header_types, data.header_types)
+            self.assertEqual(list(inferred), rows)
+        
+        self.assertEqual(_infer_type(['1', '2', '3']), ATTR_TYPE_DISCRETE)
+        self.assertEqual(_infer_type(['1', '2.5']), ATTR_TYPE_CONTINUOUS)
+        self.assertEqual(_infer_type([1, 2.5]), ATTR_TYPE_CONTINUOUS)
+        self.assertEqual(_infer_type(['1', 'a']), ATTR_TYPE_NOMINAL)
+        data = Data.infer(
+            [dict(a='x', b='1.5', c='2'), dict(a='y', b='2', c='3')],
+            class_attr='b', weight_attr='c')
+        self.assertEqual(data.header_types, dict(a=NOM, b=CON, c=CON))
+        self.assertEqual(data.weight_attribute_name, 'c')
+        self.assertEqual(list(data)[0], dict(a='x', b=1.5, c=2.0))
+
+    def test_data_views(self):
+        file_data = Data('rdata2')
+        mem_data = Data(
+            list(file_data),
+            order=file_data.header_order,
+            types=file_data.header_types,
+            modes=dict(cls=CLS))
+        all_rows = sorted(repr(sorted(r.items())) for r in file_data)
+        
+        def get_rows(data):
+            return sorted(repr(sorted(r.items())) for r in data)
+        
+        for data in (file_data, mem_data):
+            a, b = data.stream_split(ratio=0.25, seed=123)
+            self.assertEqual(len(a) + len(b), len(data))
+            self.assertEqual(sorted(get_rows(a) + get_rows(b)), all_rows)
+            # Views are re-streamed, so iterating twice gives the same rows.
+            self.assertEqual(get_rows(a), get_rows(a))
+        
+        # Seeded splits can be used for repeated cross-validation, each
+        # epoch holding out a different subset.
+        held_out = set()
+        for epoch in six.moves.range(5):
+            test_data, train_data = mem_data.stream_split(
+                ratio=0.25, seed=epoch)
+            held_out.add(tuple(get_rows(test_data)))
+            tree = Tree.build(train_data)
+            tree.set_missing_value_policy(USE_NEAREST)
+            self.assertEqual(tree.test(test_data).count, len(test_data))
+        self.assertTrue(len(held_out) > 1)
+        
+        # The split is determined only by the seed, not by the source type.
+        for (fa, fb), (ma, mb) in zip(
+            file_data.kfold(k=4, seed=7), mem_data.kfold(k=4, seed=7)):
+            self.assertEqual(get_rows(fa), get_rows(ma))
+            self.assertEqual(get_rows(fb), get_rows(mb))
+            self.assertEqual(sorted(get_rows(fa) + get_rows(fb)), all_rows)
+        
+        # Every row is tested exactly once across all folds.
+        tested = []
+        for train, test in mem_data.kfold(k=4, seed=7):
+            self.assertIsNotNone(train.indexes)
+            tested.extend(get_rows(test))
+            tree = Tree.build(train)
+            tree.set_missing_value_policy(USE_NEAREST)
+            self.assertEqual(tree.test(test).count, len(test))
+        self.assertEqual(sorted(tested), all_rows)
+        
+        # Views can select rows by index, with repeats.
+        for data in (file_data, mem_data):
+            view = DataView(data, indexes=[0, 0, 3])
+            self.assertEqual(len(view), 3)
+            rows = list(view)
+            self.assertEqual(rows[0], rows[1])
+            self.assertEqual(rows[2], list(data)[3])
+
+    def test_compressed_data(self):
+        data = Data('cdata2')
+        rows = list(data)
+        with open('cdata2') as fin:
+            content = fin.read()
+        openers = [('.gz', gzip.open), ('.bz2', bz2.BZ2File)]
+        if lzma is not None:
+            openers.append(('.xz', lzma.open))
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for ext, opener in openers:
+                fn = os.path.join(tmp_dir, 'cdata2.csv' + ext)
+                with opener(fn, 'wb') as fout:
+                    fout.write(content.encode('utf-8'))
+                compressed = Data(fn)
+                self.assertEqual(len(compressed), len(data))
+                self.assertEqual(list(compressed), rows)
+                self.assertEqual(
+                    Data.infer(fn).header_order, data.header_order)
+            
+            # Rows are handed over in chunks through a bounded queue, and
+            # the producer stops when the reader does.
+            itr = iter_csv_threaded(fn, chunk_size=3, queue_size=1)
+            self.assertEqual(len(list(itertools.islice(itr, 5))), 5)
+            itr.close()
+            self.assertEqual(
+                len(list(iter_csv_threaded(fn, chunk_size=3, queue_size=1))),
+                len(rows) + 1)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_data_sources(self):
+        data = Data('rdata3')
+        rows = list(data)
+        handle, db_fn = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        try:
+            connection = sqlite3.connect(db_fn)
+            connection.execute('CREATE TABLE samples (%s)' % ', '.join(
+                '"%s"' % name for name in data.header_order))
+            connection.executemany(
+                'INSERT INTO samples VALUES (%s)'
+                    % ', '.join('?'*len(data.header_order)),
+                [[row[name] for name in data.header_order] for row in rows])
+            connection.commit()
+            connection.close()
+            
+            with SQLiteSource(db_fn, table='samples', batch_size=5) as source:
+                self.assertEqual(source.columns, data.header_order)
+                self.assertEqual(len(source), len(rows))
+                self.assertEqual(
+                    [len(batch) for batch in source.iter_batches()],
+                    [5]*(len(rows)//5) + ([len(rows) % 5] if len(rows) % 5 else []))
+                db_data = Data.infer(source, class_attr='cls')
+                self.assertEqual(db_data.header_types, data.header_types)
+                self.assertEqual(list(db_data), rows)
+                
+                # Splits are filtered inside SQLite, selecting the same rows as
+                # splits of the rows in memory.
+                mem_data = Data(rows, order=data.header_order,
+                    types=data.header_types, modes={'cls': CLS})
+                for a, b in zip(db_data.stream_split(0.3, seed=2),
+                    mem_data.stream_split(0.3, seed=2)):
+                    self.assertEqual(list(a), list(b))
+                
+                # The source can be pickled, reconnecting in each process.
+                loaded = pickle.loads(pickle.dumps(db_data))
+                self.assertEqual(list(loaded), rows)
+                loaded.data.close()
+                
+                # Training on batches matches training on each record.
+                tree = Tree(db_data, auto_grow=True, splitting_n=8)
+                for batch in db_data.iter_batches():
+                    self.assertTrue(len(batch) <= 5)
+                    tree.train_many(batch)
+                expected = Tree(data, auto_grow=True, splitting_n=8)
+                for row in rows:
+                    expected.train(row)
+                self.assertEqual(
+                    repr(tree.to_dict()), repr(expected.to_dict()))
+            self.assertTrue(source._connection is None)
+        finally:
+            os.remove(db_fn)
+        
+        source = IteratorSource(lambda: iter(rows), batch_size=4,
+            columns=data.header_order)
+        it_data = Data.infer(source, class_attr='cls')
+        self.assertEqual(list(it_data), rows)
+        self.assertEqual(list(it_data), rows)
+        self.assertEqual(
+            [len(batch) for batch in it_data.iter_batches()][0], 4)
+        with self.assertRaises(AssertionError):
+            source.filter_range(0, 0.5)
+        with self.assertRaises(TypeError):
+            DataSource()
+
+    def test_cross_validate(self):
+        data = Data('cdata2')
+        params = dict(metric=[ENTROPY1, ENTROPY2], leaf_threshold=[0.9, 1.0])
+        serial = cross_validate(data, params=params, k=4, processes=1)
+        parallel = cross_validate(data, params=params, k=4, processes=2)
+        self.assertEqual(len(serial), 4)
+        self.assertEqual(
+            [r['params'] for r in serial], get_param_grid(params))
+        for a, b in zip(serial, parallel):
+            self.assertEqual(a['params'], b['params'])
+            self.assertEqual(a['score'].count, 4)
+            self.assertEqual(a['seconds'].count, 4)
+            self.assertAlmostEqual(a['score'].mean, b['score'].mean)
+        
+        result, = cross_validate(Data('rdata2'), k=3, processes=1)
+        self.assertEqual(result['params'], {})
+        self.assertTrue(result['score'].mean >= 0)
+
     def test_batch_tree(self):
         print('Testing batch tree...')
         
@@ -1787,6 +5550,550 @@ class Test(unittest.TestCase):
         print(result)
         print('Done.')
 
+    def test_nearest_value(self):
+        rdata2 = Data('rdata2')
+        online_tree = Tree(rdata2, splitting_n=8, auto_grow=True, leaf_threshold=0.0)
+        for _ in six.moves.range(3):
+            for row in rdata2:
+                online_tree.train(row)
+        for tree in (Tree.build(rdata2), online_tree):
+            tree.set_missing_value_policy(USE_NEAREST)
+            node = tree.tree
+            values = node.get_values(node.attr_name)
+            self.assertEqual(node._sorted_values, sorted(values))
+            rand = random.Random(0)
+            for _ in six.moves.range(200):
+                value = rand.randint(-5, 15)
+                expected = min((abs(v - value), v) for v in values)[1]
+                record = {node.attr_name: value}
+                self.assertEqual(
+                    node._get_attribute_value_for_node(record), expected)
+                self.assertTrue(len(node._nearest_cache) <= NEAREST_CACHE_SIZE)
+
+    def test_missing_value_policies(self):
+        cdata1 = Data('cdata1')
+        rows = list(cdata1)
+        tree = Tree.build(cdata1)
+        record = {
+            'Age': 'unknown',
+            'Education': 'masters',
+            'Income': 'high',
+            'Marital Status': 'single',
+        }
+        
+        tree.set_missing_value_policy(USE_MOST_FREQUENT)
+        self.assertEqual(tree.tree._most_frequent_value, '36 - 55')
+        expected = tree.predict(dict(record, Age='36 - 55'))
+        self.assertEqual(tree.predict(record), expected)
+        
+        tree.set_missing_value_policy(USE_NODE_DIST)
+        self.assertEqual(
+            tree.predict(record),
+            DDist([r['Purchase?'] for r in rows]))
+        
+        tree.set_missing_value_policy(USE_WEIGHTED)
+        prediction = tree.predict(record)
+        expected = DDist()
+        for age, count in iteritems(Counter(r['Age'] for r in rows)):
+            for cls_value, cls_prob in tree.predict(dict(record, Age=age)).probs:
+                expected.add(cls_value, cls_prob*count/float(len(rows)))
+        for cls_value, cls_prob in expected.probs:
+            self.assertAlmostEqual(prediction[cls_value], cls_prob)
+        
+        # Online regression trees support the same policies.
+        rdata3 = Data('rdata3')
+        rows = list(rdata3)
+        tree = Tree(rdata3, splitting_n=4, auto_grow=True)
+        for row in rows:
+            tree.train(row)
+        node = tree.tree
+        record = {node.attr_name: 99}
+        tree.set_missing_value_policy(USE_NODE_DIST)
+        prediction = tree.predict(record)
+        self.assertAlmostEqual(
+            prediction.mean, get_mean([r['cls'] for r in rows]))
+        tree.set_missing_value_policy(USE_WEIGHTED)
+        prediction = tree.predict(record)
+        counts = node._branch_counts
+        self.assertEqual(sum(counts.values()), len(rows))
+        self.assertAlmostEqual(prediction.mean, sum(
+            count*tree.predict({node.attr_name: v}).mean
+            for v, count in iteritems(counts))/len(rows))
+        tree.set_missing_value_policy(USE_MOST_FREQUENT)
+        self.assertIn(tree.predict(record).mean, [
+            tree.predict({node.attr_name: v}).mean
+            for v in node.get_values(node.attr_name)])
+
+    def test_tree_limits(self):
+        
+        def get_split_node_count(node):
+            if not isinstance(node, Node) or not node.attr_name:
+                return 0
+            return 1 + sum(
+                get_split_node_count(b) for b in node._branches.values())
+        
+        rdata2 = Data('rdata2')
+        full = Tree.build(rdata2)
+        self.assertEqual(full.leaf_count, 16)
+        self.assertTrue(full.depth > 1)
+        self.assertEqual(
+            full.node_count - get_split_node_count(full.tree), full.leaf_count)
+        
+        tree = Tree.build(rdata2, max_depth=1)
+        self.assertEqual(tree.depth, 1)
+        self.assertEqual(tree.leaf_count, 4)
+        self.assertEqual(tree.node_count, 5)
+        
+        for max_leaf_count in (1, 4, 5, 10):
+            tree = Tree.build(rdata2, max_leaf_count=max_leaf_count)
+            self.assertTrue(tree.leaf_count <= max_leaf_count)
+        
+        tree = Tree.build(rdata2, min_samples_leaf=4)
+        self.assertTrue(tree.leaf_count < full.leaf_count)
+        self.assertEqual(Tree.build(rdata2, min_samples_split=100).leaf_count, 1)
+        
+        # A tree whose growth stops at the root predicts the overall mean.
+        mean = get_mean([r['cls'] for r in rdata2])
+        for kwargs in (
+            dict(max_leaf_count=1), dict(max_depth=0),
+            dict(min_samples_split=100)):
+            tree = Tree.build(rdata2, **kwargs)
+            self.assertEqual(tree.leaf_count, 1)
+            self.assertEqual(tree.node_count, 1)
+            self.assertAlmostEqual(tree.predict({}).mean, mean)
+            self.assertAlmostEqual(
+                [d.mean for d in tree.predict_many(list(rdata2))][0], mean)
+            self.assertTrue(tree.test(rdata2).mean > 0)
+            self.assertAlmostEqual(tree.compile()({})[0], mean)
+        
+        # Incrementally grown trees respect the same limits.
+        cdata5 = Data('cdata5')
+        for kwargs, max_depth, max_leaf_count in (
+            (dict(max_depth=1), 1, None),
+            (dict(max_leaf_count=3), None, 3),
+            (dict(min_samples_leaf=1000), 0, 1),
+        ):
+            tree = Tree(cdata5, metric=ENTROPY2, splitting_n=17, auto_grow=True, **kwargs)
+            for _ in six.moves.range(6):
+                for row in cdata5:
+                    tree.train(row)
+            if max_depth is not None:
+                self.assertEqual(tree.depth, max_depth)
+            if max_leaf_count is not None:
+                self.assertTrue(tree.leaf_count <= max_leaf_count)
+            self.assertEqual(
+                tree.node_count - get_split_node_count(tree.tree),
+                tree.leaf_count)
+        
+        # Values first seen after a split don't grow branches beyond the
+        # limits.
+        rows = list(cdata5)
+        tree = Tree(
+            cdata5, metric=ENTROPY2, splitting_n=17, auto_grow=True,
+            max_leaf_count=5)
+        tree.set_missing_value_policy(USE_MOST_FREQUENT)
+        for _ in six.moves.range(6):
+            for row in rows:
+                tree.train(row.copy())
+        split_attr = tree.tree.attr_name
+        self.assertTrue(split_attr)
+        for i, row in enumerate(rows):
+            row = row.copy()
+            row[split_attr] = 'unseen%i' % i
+            tree.train(row)
+        self.assertEqual(tree.leaf_count, 5)
+        self.assertEqual(tree.tree.get_leaf_count(), tree.leaf_count)
+
+    def test_pruning(self):
+        rdata2 = Data('rdata2')
+        
+        # Without a penalty, only branches that don't reduce the training
+        # error are removed.
+        tree = Tree.build(rdata2)
+        mae = tree.test(rdata2).mean
+        tree.prune_cost_complexity(alpha=0.0)
+        self.assertAlmostEqual(tree.test(rdata2).mean, mae)
+        self.assertEqual(tree.leaf_count, tree.tree.get_leaf_count())
+        
+        # A large enough penalty collapses the whole tree.
+        removed = tree.prune_cost_complexity(alpha=1e10)
+        self.assertTrue(removed > 0)
+        self.assertEqual(tree.leaf_count, 1)
+        self.assertEqual(tree.node_count, 1)
+        self.assertAlmostEqual(
+            tree.predict({}).mean, get_mean([r['cls'] for r in rdata2]))
+        
+        # Reduced error pruning never increases the error on the held-out data.
+        for fn in ('cdata1', 'cdata4', 'rdata2'):
+            data = Data(fn)
+            for seed in six.moves.range(5):
+                train_data, test_data = data.stream_split(ratio=0.7, seed=seed)
+                tree = Tree.build(train_data)
+                tree.set_missing_value_policy(USE_MOST_FREQUENT)
+                node_count = tree.node_count
+                error = tree.test(test_data).mean
+                tree.prune_reduced_error(test_data)
+                self.assertTrue(tree.node_count <= node_count)
+                self.assertEqual(tree.leaf_count, tree.tree.get_leaf_count())
+                self.assertTrue(tree.test(test_data).mean >= error - 1e-9
+                    if not tree.is_continuous_class
+                    else tree.test(test_data).mean <= error + 1e-9)
+        
+        # Online trees can be pruned too.
+        cdata5 = Data('cdata5')
+        tree = Tree(cdata5, metric=ENTROPY2, splitting_n=17, auto_grow=True)
+        for _ in six.moves.range(6):
+            for row in cdata5:
+                tree.train(row)
+        tree.prune_cost_complexity(alpha=1e10)
+        self.assertEqual(tree.node_count, 1)
+
+        # Pruning sticks until splitting_n more samples have been seen.
+        cdata1 = Data('cdata1')
+        rows = list(cdata1)
+        tree = Tree(cdata1, splitting_n=17, auto_grow=True)
+        for _ in six.moves.range(3):
+            for row in rows:
+                tree.train(row)
+        tree.prune_cost_complexity(alpha=1e10)
+        for row in rows[:16]:
+            tree.train(row)
+        self.assertEqual(tree.node_count, 1)
+        tree.train(rows[16])
+        self.assertTrue(tree.node_count > 1)
+
+        # Collapsed branches are kept as leaves rather than regrown.
+        rdata2 = Data('rdata2')
+        rows = list(rdata2)
+        tree = Tree(rdata2, splitting_n=17, auto_grow=True)
+        for _ in six.moves.range(3):
+            for row in rows:
+                tree.train(row)
+        tree.prune_cost_complexity(alpha=0.01)
+        leaf_count = tree.leaf_count
+        for row in rows[:16]:
+            tree.train(row)
+        self.assertEqual(tree.leaf_count, leaf_count)
+        for branch in itervalues(tree.tree._branches):
+            self.assertEqual(branch.attr_name, None)
+
+    def test_merge(self):
+        for fn in ('cdata2', 'rdata3'):
+            data = Data(fn)
+            rows = list(data)
+            half = len(rows)//2
+            
+            # Replicas trained on shards reduce to the same statistics as a
+            # tree trained on the whole stream.
+            whole = Tree(data, auto_grow=False)
+            a = Tree(data, auto_grow=False)
+            b = Tree(data, auto_grow=False)
+            for row in rows:
+                whole.train(row)
+            for row in rows[:half]:
+                a.train(row)
+            for row in rows[half:]:
+                b.train(row)
+            a.merge(b)
+            self.assertEqual(a.sample_count, whole.sample_count)
+            self.assertEqual(a.tree.n, whole.tree.n)
+            for attr_name in data.attribute_names:
+                self.assertAlmostEqual(
+                    a.tree.get_gain(attr_name),
+                    whole.tree.get_gain(attr_name))
+            
+            # Periodically importing a replica's deltas keeps the reduced
+            # tree in step with it, and re-evaluates its splits.
+            replica = Tree(data, auto_grow=True, splitting_n=8)
+            reduced = Tree(data, auto_grow=True, splitting_n=8)
+            for i in range(0, len(rows), 4):
+                for row in rows[i:i+4]:
+                    replica.train(row)
+                delta = pickle.loads(pickle.dumps(replica.export_delta()))
+                reduced.import_stats(delta)
+                self.assertEqual(reduced.tree.n, replica.tree.n)
+                self.assertEqual(reduced.tree.attr_name, replica.tree.attr_name)
+            self.assertEqual(reduced.sample_count, len(rows))
+            self.assertEqual(reduced.leaf_count, replica.leaf_count)
+            for attr_name in data.attribute_names:
+                self.assertAlmostEqual(
+                    reduced.tree.get_gain(attr_name),
+                    replica.tree.get_gain(attr_name))
+            self.assertEqual(
+                repr(reduced.to_dict()), repr(replica.to_dict()))
+            self.assertEqual(replica.export_delta()['root']['n'], 0)
+
+    def test_prediction_cache(self):
+        for fn in ('cdata1', 'rdata3'):
+            data = Data(fn)
+            rows = list(data)
+            plain = Tree.build(data)
+            cached = Tree.build(data, prediction_cache_size=4)
+            self.assertTrue(cached.split_attributes)
+            for row in rows:
+                for _ in range(2):
+                    self.assertEqual(
+                        repr(cached.predict(row)), repr(plain.predict(row)))
+            cache = cached.prediction_cache
+            self.assertTrue(cache.hits)
+            self.assertTrue(len(cache) <= 4)
+            
+            # Attributes the tree doesn't split on don't affect the key.
+            unused = set(data.attribute_names) - set(cached.split_attributes)
+            row = rows[0].copy()
+            cached.predict(row)
+            hits = cache.hits
+            for attr_name in unused:
+                row[attr_name] = 'unseen'
+            cached.predict(row)
+            self.assertEqual(cache.hits, hits + 1)
+            
+            # Modifying a prediction doesn't modify the cached one.
+            prediction = cached.predict(rows[0])
+            if data.is_continuous_class:
+                prediction.add(1e6)
+            else:
+                prediction.add('unseen', 1000)
+            self.assertEqual(
+                repr(cached.predict(rows[0])), repr(plain.predict(rows[0])))
+        
+        # Training invalidates the cache.
+        data = Data('cdata2')
+        tree = Tree(data, auto_grow=True, splitting_n=8,
+            prediction_cache_size=100)
+        forest = Forest(data, size=3, seed=0, prediction_cache_size=100,
+            tree_kwargs=dict(auto_grow=True, splitting_n=8))
+        plain_forest = Forest(data, size=3, seed=0,
+            tree_kwargs=dict(auto_grow=True, splitting_n=8))
+        for row in data:
+            tree.train(row)
+            forest.train(row)
+            plain_forest.train(row)
+        for row in data:
+            tree.predict(row)
+            for other in data:
+                forest.predict(other)
+            self.assertTrue(len(tree.prediction_cache))
+            self.assertTrue(len(forest.prediction_cache))
+            tree.train(row)
+            forest.train(row)
+            plain_forest.train(row)
+            self.assertEqual(len(tree.prediction_cache), 0)
+            self.assertEqual(len(forest.prediction_cache), 0)
+        
+        # The split attributes are only recalculated after a split.
+        split_attributes = tree.split_attributes
+        leaf_count = tree.leaf_count
+        tree.train(list(data)[0])
+        if tree.leaf_count == leaf_count:
+            self.assertTrue(tree.split_attributes is split_attributes)
+        for row in data:
+            self.assertEqual(
+                repr(forest.predict(row)), repr(plain_forest.predict(row)))
+        self.assertTrue(forest.prediction_cache.hits)
+
+    def test_compile(self):
+        
+        def as_plain(dist):
+            if isinstance(dist, CDist):
+                return (dist.mean, dist.variance)
+            return dict(dist.probs) if dist.count else {}
+        
+        for fn in ('cdata1', 'cdata2', 'cdata5', 'rdata3'):
+            data = Data(fn)
+            rows = list(data)
+            batch = Tree.build(data)
+            online = Tree(data, auto_grow=True, splitting_n=8)
+            for row in rows:
+                online.train(row)
+            for tree in (batch, online):
+                predict = tree.compile()
+                for row in rows:
+                    self.assertEqual(predict(row), as_plain(tree.predict(row)))
+                
+                # Unknown values are mapped by the missing value policy.
+                for policy in (USE_MOST_FREQUENT, USE_NODE_DIST):
+                    tree.set_missing_value_policy(policy)
+                    predict = tree.compile()
+                    for row in rows:
+                        row = row.copy()
+                        for attr_name in data.attribute_names[::2]:
+                            row[attr_name] = 'unseen'
+                        self.assertEqual(
+                            predict(row), as_plain(tree.predict(row)))
+            
+            # The generated module runs without this module.
+            namespace = {}
+            six.exec_(online.to_python(), namespace)
+            self.assertEqual(
+                namespace['predict'](rows[0]), online.compile()(rows[0]))
+        
+        for fn in ('cdata2', 'rdata3'):
+            data = Data(fn)
+            forest = Forest.build(data, size=4, seed=0)
+            predict = forest.compile()
+            for row in data:
+                expected = forest.predict(row)
+                actual = predict(row)
+                if data.is_continuous_class:
+                    self.assertAlmostEqual(actual[0], expected.mean)
+                    self.assertAlmostEqual(actual[1], expected.variance)
+                else:
+                    for cls_value, cls_prob in expected.probs:
+                        self.assertAlmostEqual(actual[cls_value], cls_prob)
+
+    def test_evaluate(self):
+        for fn in ('cdata2', 'cdata5', 'rdata3'):
+            data = Data(fn)
+            rows = list(data)
+            class_attr = data.class_attribute_name
+            online = Tree(data, auto_grow=True, splitting_n=8)
+            for row in rows:
+                online.train(row)
+            forest = Forest.build(data, size=4, seed=0)
+            # Other weighting methods fall back to predicting each record,
+            # so they see only the trees that predicted it.
+            def first_tree_weight(trees):
+                trees = list(trees)
+                return [(1.0, trees[0])] if trees else None
+            first = Forest.build(data, size=4, seed=0,
+                weighting_method=first_tree_weight)
+            abstaining = first.trees[0]
+            abstaining.predict = lambda record: None \
+                if record in rows[::2] else Tree.predict(abstaining, record)
+            abstaining.predict_many = lambda records: [
+                abstaining.predict(record) for record in records]
+            for model in (Tree.build(data), online, forest, first):
+                model.set_missing_value_policy(USE_MOST_FREQUENT)
+                predictions = [model.predict(row) for row in rows]
+                bulk = model.predict_many(rows)
+                if model is not forest:
+                    self.assertEqual(repr(bulk), repr(predictions))
+                
+                evaluation = model.evaluate(data)
+                self.assertEqual(evaluation.count, len(rows))
+                if data.is_continuous_class:
+                    errors = [p.mean - row[class_attr]
+                        for p, row in zip(predictions, rows)]
+                    self.assertAlmostEqual(
+                        evaluation.mae, get_mean([abs(e) for e in errors]))
+                    self.assertAlmostEqual(evaluation.rmse, math.sqrt(
+                        get_mean([e*e for e in errors])))
+                    continue
+                for a, b in zip(bulk, predictions):
+                    self.assertEqual(a.best, b.best)
+                actual = [row[class_attr] for row in rows]
+                best = [p.best for p in predictions]
+                self.assertAlmostEqual(evaluation.accuracy.mean, get_mean(
+                    [a == b for a, b in zip(actual, best)]))
+                self.assertEqual(
+                    evaluation.accuracy.mean, model.test(data).mean)
+                for cls_value in set(actual):
+                    tp = sum(1 for a, b in zip(actual, best)
+                        if a == b == cls_value)
+                    self.assertEqual(
+                        evaluation.confusion_matrix[cls_value][cls_value], tp)
+                    self.assertAlmostEqual(evaluation.recall(cls_value),
+                        tp/float(actual.count(cls_value)))
+                    if cls_value in best:
+                        self.assertAlmostEqual(evaluation.precision(cls_value),
+                            tp/float(best.count(cls_value)))
+                self.assertAlmostEqual(evaluation.log_loss.mean, get_mean([
+                    -math.log(max(dict(p.probs).get(a, 0), LOG_LOSS_EPSILON))
+                    for p, a in zip(predictions, actual)]))
+
+    def test_concept_drift(self):
+        data = Data(
+            [],
+            order=['a', 'b', 'c', 'cls'],
+            types=dict(a=DIS, b=DIS, c=DIS, cls=NOM),
+            modes=dict(cls=CLS))
+        rand = random.Random(0)
+        
+        def get_rows(n, class_attr):
+            for _ in six.moves.range(n):
+                row = dict(
+                    a=rand.randint(0, 1),
+                    b=rand.randint(0, 1),
+                    c=rand.randint(0, 3))
+                row['cls'] = str(row[class_attr])
+                yield row
+        
+        trees = {}
+        for drift_detection in (False, True):
+            tree = Tree(data, splitting_n=30, auto_grow=True,
+                drift_detection=drift_detection, drift_window=100)
+            for row in get_rows(500, 'a'):
+                tree.train(row)
+            self.assertEqual(tree.tree.attr_name, 'a')
+            # The class now depends on a different attribute.
+            swaps = 0
+            for row in get_rows(2000, 'b'):
+                root = tree.tree
+                alternate = root._alternate
+                alternate_n = alternate and alternate.n
+                tree.train(row)
+                if alternate is not None and tree.tree is alternate:
+                    # The sample that triggered the swap is counted once.
+                    swaps += 1
+                    self.assertEqual(alternate.n, alternate_n + 1)
+                    self.assertEqual(alternate._class_ddist.total, alternate.n)
+                    self.assertTrue(root._branches is not alternate._branches)
+            self.assertEqual(swaps, int(drift_detection))
+            self.assertEqual(tree.test(list(get_rows(100, 'b'))).mean, 1.0)
+            trees[drift_detection] = tree
+        
+        # Without drift detection, the old split is kept and the tree grows
+        # to compensate. With it, the stale subtree is replaced.
+        self.assertEqual(trees[False].tree.attr_name, 'a')
+        self.assertEqual(trees[True].tree.attr_name, 'b')
+        self.assertEqual(trees[True].leaf_count, 2)
+        self.assertTrue(trees[True].node_count < trees[False].node_count)
+
+    def test_max_features(self):
+        self.assertEqual(get_max_feature_count(None, 100), 100)
+        self.assertEqual(get_max_feature_count('sqrt', 100), 10)
+        self.assertEqual(get_max_feature_count('log2', 100), 6)
+        self.assertEqual(get_max_feature_count(0.25, 100), 25)
+        self.assertEqual(get_max_feature_count(0.001, 100), 1)
+        self.assertEqual(get_max_feature_count(500, 100), 100)
+        
+        cdata1 = Data('cdata1')
+        full = Tree.build(cdata1)
+        roots = set()
+        for seed in six.moves.range(20):
+            a = Tree.build(cdata1, max_features=1, seed=seed)
+            b = Tree.build(cdata1, max_features=1, seed=seed)
+            # The same seed always builds the same tree.
+            self.assertEqual(repr(a.to_dict()), repr(b.to_dict()))
+            roots.add(a.tree.attr_name)
+        # Different seeds consider different attributes.
+        self.assertTrue(len(roots) > 1)
+        self.assertEqual(
+            Tree.build(cdata1, max_features=4, seed=1).to_dict(), full.to_dict())
+        
+        # Online trees subsample too.
+        cdata5 = Data('cdata5')
+        roots = set()
+        for seed in six.moves.range(20):
+            tree = Tree(cdata5, splitting_n=8, auto_grow=True,
+                max_features=1, seed=seed)
+            for row in cdata5:
+                tree.train(row)
+            roots.add(tree.tree.attr_name)
+        self.assertTrue(len(roots) > 1)
+        
+        # Each tree in a forest gets its own seed.
+        forest = Forest(
+            data=cdata5,
+            size=10,
+            seed=0,
+            grow_method=GROW_AUTO_INCREMENTAL,
+            tree_kwargs=dict(splitting_n=17, max_features='sqrt'))
+        for row in cdata5:
+            forest.train(row)
+        self.assertEqual(len(set(t._random.random() for t in forest.trees)), 10)
+
     def test_online_tree(self):
         print('Testing online tree...')
         
@@ -1908,6 +6215,129 @@ class Test(unittest.TestCase):
         self.assertEqual(mae.mean, 0.0)
         print('Done.')
 
+    def test_gain_cache(self):
+        
+        def get_uncached_gain(node, attr_name):
+            subset_entropy = 0.0
+            for value in iterkeys(node._attr_value_counts[attr_name]):
+                subset_entropy += node.get_value_prob(attr_name, value) \
+                    * node.get_entropy(attr_name, value)
+            return node.get_entropy() - subset_entropy
+        
+        for fn, metrics in (('cdata2', DISCRETE_METRICS), ('rdata3', CONTINUOUS_METRICS)):
+            data = Data(fn)
+            for metric in metrics:
+                tree = Tree(data, metric=metric)
+                node = tree.tree
+                for row in data:
+                    tree.train(row)
+                    # Only the terms touched by the last record are stale.
+                    self.assertTrue(node._dirty_entropy_terms)
+                    for attr_name in node.attributes:
+                        self.assertAlmostEqual(
+                            node.get_gain(attr_name),
+                            get_uncached_gain(node, attr_name))
+                    self.assertFalse(node._dirty_entropy_terms)
+
+    def test_sample_weights(self):
+        
+        # A weighted sample matches the same sample repeated.
+        a = CDist(seq=[1, 2, 2, 3, 3, 3])
+        b = CDist(seq=[1, 2, 3], weights=[1, 2, 3])
+        self.assertAlmostEqual(a.mean, b.mean)
+        self.assertAlmostEqual(a.variance, b.variance)
+        self.assertEqual(
+            DDist(seq='abb').probs, DDist(seq='ab', weights=[1, 2]).probs)
+        
+        for fn in ('cdata2', 'rdata3'):
+            data = Data(fn)
+            rows = list(data)
+            repeated_rows = []
+            weighted_rows = []
+            for i, row in enumerate(rows):
+                weight = i % 3 + 1
+                repeated_rows.extend(row.copy() for _ in range(weight))
+                row = row.copy()
+                row['weight'] = weight
+                weighted_rows.append(row)
+            types = dict(data.header_types, weight=ATTR_TYPE_CONTINUOUS)
+            modes = {data.class_attribute_name: CLS}
+            repeated_data = Data(
+                repeated_rows, order=data.header_order, types=types,
+                modes=modes)
+            weighted_data = Data(
+                weighted_rows, order=data.header_order + ['weight'],
+                types=types, modes=dict(modes, weight=WGT))
+            self.assertEqual(weighted_data.weight_attribute_name, 'weight')
+            self.assertTrue('weight' not in weighted_data.attribute_names)
+            
+            # Batch trees make the same splits and predictions.
+            repeated_tree = Tree.build(repeated_data)
+            weighted_tree = Tree.build(weighted_data)
+            self.assertEqual(
+                repeated_tree.tree.attr_name, weighted_tree.tree.attr_name)
+            for row in rows:
+                a = repeated_tree.predict(row)
+                b = weighted_tree.predict(row)
+                if data.is_continuous_class:
+                    self.assertAlmostEqual(a.mean, b.mean)
+                else:
+                    self.assertEqual(a.best, b.best)
+            self.assertAlmostEqual(
+                repeated_tree.test(repeated_data).mean,
+                weighted_tree.test(weighted_data).mean)
+            
+            # Online trees see the same statistics.
+            repeated_tree = Tree(repeated_data, auto_grow=False)
+            weighted_tree = Tree(weighted_data, auto_grow=False)
+            for row in repeated_data:
+                repeated_tree.train(row)
+            for row in weighted_data:
+                weighted_tree.train(row)
+            self.assertEqual(repeated_tree.tree.n, weighted_tree.tree.n)
+            for attr_name in data.attribute_names:
+                self.assertAlmostEqual(
+                    repeated_tree.tree.get_gain(attr_name),
+                    weighted_tree.tree.get_gain(attr_name))
+            
+            # An explicit weight overrides the record's.
+            tree = Tree(weighted_data, auto_grow=False)
+            tree.train(weighted_rows[0], weight=0.5)
+            self.assertEqual(tree.tree.n, 0.5)
+
+    def test_sparse(self):
+        
+        for fn in ('cdata2', 'cdata5', 'rdata3'):
+            dense_data = Data(fn)
+            sparse_data = Data(fn, sparse=True, sparse_default=1)
+            self.assertTrue(all(1 not in row.values() for row in sparse_data))
+            
+            # Online trees see the same statistics.
+            dense_tree = Tree(dense_data, splitting_n=17, auto_grow=True)
+            sparse_tree = Tree(sparse_data, splitting_n=17, auto_grow=True)
+            for _ in six.moves.range(3):
+                for dense_row, sparse_row in zip(dense_data, sparse_data):
+                    dense_tree.train(dense_row)
+                    sparse_tree.train(sparse_row)
+                    for attr_name in dense_data.attribute_names:
+                        self.assertAlmostEqual(
+                            dense_tree.tree.get_gain(attr_name),
+                            sparse_tree.tree.get_gain(attr_name))
+            self.assertEqual(
+                repr(dense_tree.to_dict()), repr(sparse_tree.to_dict()))
+            self.assertEqual(
+                dense_tree.test(dense_data).mean,
+                sparse_tree.test(sparse_data).mean)
+            
+            # Batch trees make the same splits.
+            dense_tree = Tree.build(dense_data)
+            sparse_tree = Tree.build(sparse_data)
+            self.assertEqual(
+                repr(dense_tree.to_dict()), repr(sparse_tree.to_dict()))
+            self.assertEqual(
+                dense_tree.test(dense_data).mean,
+                sparse_tree.test(sparse_data).mean)
+
     def test_forest(self):
         print('Testing forest...')
         print('Growing forest incrementally...')
@@ -1943,6 +6373,249 @@ class Test(unittest.TestCase):
 #            pprint(tree.to_dict(), indent=4)
         print('Done.')
         
+    def test_frozen_forest(self):
+        
+        cdata2 = Data('cdata2')
+        rows = list(cdata2)
+        forest = Forest(
+            data=cdata2,
+            size=5,
+            grow_method=GROW_AUTO_INCREMENTAL,
+            prediction_cache_size=10,
+            tree_kwargs=dict(metric=ENTROPY2, prediction_cache_size=10))
+        for _ in six.moves.range(5):
+            for row in rows:
+                forest.train(row)
+        frozen = forest.freeze()
+        state = pickle.dumps(frozen)
+        expected = [forest.predict(row) for row in rows]
+        self.assertEqual(frozen.predict_many(rows), expected)
+        
+        # Predicting doesn't modify the snapshot, not even its caches.
+        self.assertEqual(frozen._forest.prediction_cache, None)
+        self.assertEqual(pickle.dumps(frozen), state)
+        nodes = [tree.tree for tree in frozen.trees]
+        while nodes:
+            node = nodes.pop()
+            self.assertEqual(node._nearest_cache, None)
+            nodes.extend(itervalues(node._branches))
+        
+        # Predicting from many threads at once gives the same results.
+        results = {}
+        def worker(i):
+            results[i] = frozen.predict_many(rows)
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(8):
+            self.assertEqual(results[i], expected)
+        
+        # Further training doesn't change the snapshot.
+        for row in rows:
+            forest.train(row)
+        self.assertEqual(pickle.dumps(frozen), state)
+        
+        if asyncio is None:
+            return
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            predictor = BatchPredictor(forest, max_batch_size=5)
+            # Records are queued from inside the running loop, as they are
+            # by coroutines.
+            result = loop.create_future()
+            def queue():
+                futures = [predictor.predict_async(row) for row in rows*3]
+                asyncio.gather(*futures).add_done_callback(
+                    lambda gathered: result.set_result(gathered.result()))
+            loop.call_soon(queue)
+            predictions = loop.run_until_complete(result)
+            self.assertEqual(len(predictions), len(rows)*3)
+            self.assertEqual(
+                predictions, predictor.model.predict_many(rows*3))
+            predictor.close()
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_forest_build(self):
+        for fn in ('cdata1', 'rdata2'):
+            data = Data(fn)
+            rows = list(data)
+            serial = Forest.build(data, size=6, seed=0)
+            parallel = Forest.build(data, size=6, seed=0, processes=2)
+            self.assertEqual(len(serial.trees), 6)
+            for a, b in zip(serial.trees, parallel.trees):
+                self.assertEqual(repr(a.to_dict()), repr(b.to_dict()))
+                self.assertIs(b.data, data)
+                self.assertEqual(
+                    a.out_of_bag_mae.count, b.out_of_bag_mae.count)
+            # Roughly a third of the rows are left out of each bootstrap sample.
+            oob_counts = [t.out_of_bag_mae.count for t in serial.trees]
+            self.assertTrue(0 < sum(oob_counts) < len(rows)*6)
+            result = serial.test(rows)
+            if serial.data.is_continuous_class:
+                self.assertTrue(result.mean < 0.05)
+            else:
+                self.assertTrue(result.mean > 0.5)
+        
+        # Without bootstrapping, each tree gets a subset of rows.
+        cdata1 = Data('cdata1')
+        forest = Forest.build(
+            cdata1, size=3, bootstrap=False, sample_ratio=0.5, seed=1)
+        for tree in forest.trees:
+            self.assertEqual(
+                tree.sample_count + tree.out_of_bag_mae.count, len(list(cdata1)))
+
+    def test_parallel_predictor(self):
+        for fn in ('cdata2', 'rdata3'):
+            data = Data(fn)
+            rows = list(data)
+            forest = Forest.build(data, size=6, seed=0)
+            expected = forest.predict_many(rows)
+            for processes in (1, 2):
+                with ParallelPredictor(forest, processes=processes) as predictor:
+                    predictions = predictor.predict_many(rows)
+                self.assertEqual(len(predictions), len(rows))
+                for a, b in zip(predictions, expected):
+                    if data.is_continuous_class:
+                        self.assertAlmostEqual(a.mean, b.mean)
+                        self.assertAlmostEqual(a.variance, b.variance)
+                    else:
+                        self.assertEqual(a.best, b.best)
+                        for cls_value, cls_prob in b.probs:
+                            self.assertAlmostEqual(
+                                dict(a.probs)[cls_value], cls_prob)
+            self.assertEqual(
+                [p.mean if data.is_continuous_class else p.best
+                    for p in forest.predict_parallel(rows, processes=2)],
+                [p.mean if data.is_continuous_class else p.best
+                    for p in predictions])
+        
+        # Predictors in this process don't share their trees.
+        predictors = []
+        for fn in ('cdata2', 'rdata3'):
+            data = Data(fn)
+            forest = Forest.build(data, size=3, seed=0)
+            predictors.append((
+                ParallelPredictor(forest, processes=1), list(data),
+                forest.predict_many(list(data))))
+        for predictor, rows, expected in predictors:
+            self.assertTrue(predictor._shm is None)
+            self.assertEqual(
+                [repr(p) for p in predictor.predict_many(rows)],
+                [repr(p) for p in expected])
+            predictor.close()
+
+    def test_numeric_summary(self):
+        rand = random.Random(0)
+        for is_continuous_class in (False, True):
+            rows = []
+            for _ in range(2000):
+                x = rand.uniform(0, 100)
+                y = rand.choice('abc')
+                if is_continuous_class:
+                    cls = x/10. + rand.random()
+                else:
+                    cls = 'hi' if x > 60 else 'lo'
+                rows.append(dict(x=x, y=y, cls=cls))
+            data = Data(
+                rows, order=['x', 'y', 'cls'],
+                types=dict(
+                    x=ATTR_TYPE_CONTINUOUS, y=ATTR_TYPE_NOMINAL,
+                    cls=ATTR_TYPE_CONTINUOUS if is_continuous_class
+                        else ATTR_TYPE_NOMINAL),
+                modes=dict(cls=CLS))
+            tree = Tree(
+                data, auto_grow=True, splitting_n=100,
+                numeric_summary_size=8)
+            tree.set_missing_value_policy(USE_NEAREST)
+            for row in rows:
+                tree.train(row.copy())
+            
+            # Each node keeps at most 8 bins of the numeric attribute, while
+            # the nominal attribute keeps every value.
+            nodes = [tree.tree]
+            while nodes:
+                node = nodes.pop()
+                x_counts = node._attr_value_counts.get('x', {})
+                self.assertTrue(len(x_counts) <= 8)
+                if x_counts:
+                    self.assertEqual(sum(x_counts.values()), node.n)
+                if node._attr_value_counts.get('y'):
+                    self.assertEqual(len(node._attr_value_counts['y']), 3)
+                nodes.extend(node._branches.values())
+            self.assertEqual(tree.tree.attr_name, 'x')
+            self.assertTrue(len(tree.tree._branches) <= 8)
+            
+            # Unseen values are routed to the nearest bin, by both the tree
+            # and its generated code.
+            predict = tree.compile()
+            for row in rows[:200]:
+                dist = tree.predict(row)
+                if is_continuous_class:
+                    self.assertTrue(abs(dist.mean - row['cls']) < 3)
+                    self.assertAlmostEqual(predict(row)[0], dist.mean)
+                else:
+                    self.assertAlmostEqual(
+                        predict(row)[dist.best], dict(dist.probs)[dist.best])
+            if not is_continuous_class:
+                self.assertTrue(tree.test(data).mean > 0.9)
+            self.assertEqual(
+                [repr(tree.predict(row)) for row in rows[:50]],
+                [repr(dist) for dist in tree.predict_many(rows[:50])])
+            
+            # Merging trees with different bins keeps the first tree's bins.
+            trees = []
+            for shard in (rows[:1000], rows[1000:]):
+                shard_tree = Tree(
+                    data, auto_grow=True, splitting_n=100,
+                    numeric_summary_size=8)
+                shard_tree.set_missing_value_policy(USE_NEAREST)
+                for row in shard:
+                    shard_tree.train(row.copy())
+                trees.append(shard_tree)
+            merged, other = trees
+            bins = list(merged.tree._sorted_values)
+            merged.merge(other)
+            root = merged.tree
+            self.assertEqual(root._sorted_values, bins)
+            self.assertEqual(sorted(root._branches), bins)
+            self.assertEqual(sorted(root._attr_value_counts['x']), bins)
+            self.assertEqual(root.n, len(rows))
+            self.assertAlmostEqual(
+                sum(root._attr_value_counts['x'].values()), len(rows))
+            self.assertEqual(merged.leaf_count, root.get_leaf_count())
+            if not is_continuous_class:
+                self.assertTrue(merged.test(data).mean > 0.9)
+
+    def test_boosted_trees(self):
+        rdata1 = Data('rdata1')
+        rdata2 = Data('rdata2')
+        stump = Tree.build(rdata2, max_depth=1)
+        stump_mae = stump.test(rdata2).mean
+        model = BoostedTrees.build(
+            rdata2, size=50, learning_rate=0.3, max_depth=1)
+        self.assertEqual(len(model.trees), 50)
+        self.assertTrue(model.test(rdata2).mean < stump_mae/2)
+        self.assertTrue(all(t.depth <= 1 for t in model.trees))
+        # Training rows keep their original class values.
+        self.assertEqual(
+            [r['cls'] for r in model.data], [r['cls'] for r in rdata2])
+        
+        # Early stopping keeps only the trees up to the best validation error.
+        model = BoostedTrees.build(
+            rdata2, validation_data=rdata1, size=200, learning_rate=0.5,
+            max_depth=2, early_stopping_rounds=5)
+        self.assertEqual(
+            len(model.trees),
+            model.validation_errors.index(min(model.validation_errors)) + 1)
+        self.assertTrue(len(model.validation_errors) < 200)
+        self.assertAlmostEqual(
+            model.test(rdata1).mean, min(model.validation_errors))
+
     def test_milksets(self):
         try:
             from milksets import wine, yeast